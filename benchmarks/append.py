@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for appending to StimSeries and StimTable during acquisition.
+"""
+import os
+import tempfile
+import time
+
+import numpy as np
+from pynwb import NWBHDF5IO
+
+from ndx_electrical_stim import StimTable
+from ndx_electrical_stim.append import (StimSeriesAppender, StimTableAppender,
+                                        create_appendable_stim_series,
+                                        make_appendable)
+
+from .common import make_nwbfile, make_bipolar_region
+
+
+class StimSeriesAppendSuite:
+    """
+    Append 10 s of waveform, delivered in 1 ms blocks as an acquisition
+    loop would, to an open file.
+    """
+    params = ([1000., 30000.], [2, 16])
+    param_names = ['rate', 'n_pairs']
+    duration = 10.
+
+    def setup(self, rate, n_pairs):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'append.nwb')
+        nwbfile = make_nwbfile(n_pairs)
+        nwbfile.add_acquisition(create_appendable_stim_series(
+            name='stim',
+            bipolar_electrodes=make_bipolar_region(nwbfile),
+            rate=rate))
+        with NWBHDF5IO(self.path, 'w') as io:
+            io.write(nwbfile)
+        block_size = int(rate / 1000)
+        self.block = np.random.randn(block_size, n_pairs)
+        self.n_blocks = int(self.duration * 1000)
+
+    def teardown(self, rate, n_pairs):
+        self.tmpdir.cleanup()
+
+    def _append(self):
+        with NWBHDF5IO(self.path, 'a', load_namespaces=True) as io:
+            stim_series = io.read().acquisition['stim']
+            with StimSeriesAppender(stim_series,
+                                    flush_samples=len(self.block) * 100) as appender:
+                for _ in range(self.n_blocks):
+                    appender.append(self.block)
+
+    def time_append(self, rate, n_pairs):
+        self._append()
+
+    def track_samples_per_second(self, rate, n_pairs):
+        start = time.perf_counter()
+        self._append()
+        return self.n_blocks * len(self.block) / (time.perf_counter() - start)
+
+    track_samples_per_second.unit = 'samples/s'
+
+
+class StimTableAppendSuite:
+    """
+    Append runs one at a time to a StimTable in an open file.
+    """
+    params = [1000, 10000]
+    param_names = ['n_runs']
+
+    def setup(self, n_runs):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'append.nwb')
+        nwbfile = make_nwbfile()
+        stim_table = StimTable(name='stimtable')
+        nwbfile.add_time_intervals(stim_table)
+        stim_table.add_run(start_time=0., stop_time=.5, frequency=50.,
+                           amplitude=1e-3, pulse_width=1e-4, bipolar_pair=0)
+        make_appendable(stim_table)
+        with NWBHDF5IO(self.path, 'w') as io:
+            io.write(nwbfile)
+
+    def teardown(self, n_runs):
+        self.tmpdir.cleanup()
+
+    def _append(self, n_runs):
+        with NWBHDF5IO(self.path, 'a', load_namespaces=True) as io:
+            stim_table = io.read().intervals['stimtable']
+            with StimTableAppender(stim_table) as appender:
+                for i in range(n_runs):
+                    appender.add_run(start_time=float(i), stop_time=i + .5,
+                                     frequency=50., amplitude=1e-3,
+                                     pulse_width=1e-4, bipolar_pair=i % 2)
+
+    def time_append(self, n_runs):
+        self._append(n_runs)
+
+    def track_runs_per_second(self, n_runs):
+        start = time.perf_counter()
+        self._append(n_runs)
+        return n_runs / (time.perf_counter() - start)
+
+    track_runs_per_second.unit = 'runs/s'
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for removing stimulation artifacts from a recording.
+"""
+import os
+import tempfile
+
+import numpy as np
+from hdmf.backends.hdf5 import H5DataIO
+from pynwb import NWBHDF5IO
+from pynwb.ecephys import ElectricalSeries
+
+from ndx_electrical_stim import StimTable
+from ndx_electrical_stim.artifacts import (get_artifact_templates,
+                                           get_artifact_windows,
+                                           iter_clean_blocks)
+from ndx_electrical_stim.data_utils import time_to_index
+
+from .common import make_nwbfile
+
+RECORDING_RATE = 30000.
+N_CHANNELS = 32
+
+
+class ArtifactSuite:
+    """
+    Subtract the artifact templates of 6000 pulses from 60 s of 32-channel,
+    gzip-compressed int16 recording at 30 kHz, pulse by pulse over the
+    recording loaded in memory, or block by block with the windows computed
+    up front, in the calling thread or with 4 threads.
+    """
+    params = (['loop', 'blocks'], [None, 4])
+    param_names = ['method', 'n_workers']
+    number = 1
+    timeout = 600
+
+    def setup(self, method, n_workers):
+        if method == 'loop' and n_workers is not None:
+            raise NotImplementedError
+        self.tmpdir = tempfile.TemporaryDirectory()
+        nwbfile = make_nwbfile(4)
+        stim_table = StimTable(name='stimtable')
+        nwbfile.add_time_intervals(stim_table)
+        starts = np.arange(.01, 60., 1.)
+        stim_table.add_runs(
+            start_time=starts, stop_time=starts + .5,
+            frequency=np.full(len(starts), 200.),
+            amplitude=np.full(len(starts), 1e-3),
+            pulse_width=np.full(len(starts), 1e-4),
+            bipolar_pair=np.arange(len(starts)) % 4)
+        rng = np.random.default_rng(0)
+        recording = rng.integers(-100, 100, (int(60 * RECORDING_RATE),
+                                             N_CHANNELS), dtype=np.int16)
+        electrodes = nwbfile.create_electrode_table_region(
+            list(range(8)) * (N_CHANNELS // 8), 'recorded channels')
+        nwbfile.add_acquisition(ElectricalSeries(
+            name='recording', electrodes=electrodes, rate=RECORDING_RATE,
+            data=H5DataIO(recording, compression='gzip',
+                          chunks=(int(RECORDING_RATE) // 10, N_CHANNELS))))
+        self.path = os.path.join(self.tmpdir.name, 'recording.nwb')
+        with NWBHDF5IO(self.path, 'w') as io:
+            io.write(nwbfile, cache_spec=False)
+
+    def teardown(self, method, n_workers):
+        self.tmpdir.cleanup()
+
+    def time_remove_artifacts(self, method, n_workers):
+        with NWBHDF5IO(self.path, 'r') as io:
+            nwbfile = io.read()
+            recording = nwbfile.acquisition['recording']
+            stim_table = nwbfile.intervals['stimtable']
+            if method == 'blocks':
+                windows = get_artifact_windows(recording, stim_table,
+                                               post=.002, pre=.0005)
+                templates = get_artifact_templates(recording, windows,
+                                                   n_workers=n_workers)
+                for _ in iter_clean_blocks(recording.data, windows,
+                                           templates=templates,
+                                           n_workers=n_workers):
+                    pass
+                return
+            data = recording.data[:].astype(float)
+            df = stim_table.to_dataframe(index=True)
+            onsets = list()
+            for run in df.itertuples():
+                for onset in np.arange(run.start_time, run.stop_time,
+                                       1. / run.frequency):
+                    onsets.append((onset, run.bipolar_pair))
+            n_pre, n_samples = 15, 75
+            sums, counts = dict(), dict()
+            for onset, pair in onsets:
+                first = time_to_index(recording, onset) - n_pre
+                window = data[first:first + n_samples]
+                sums[pair] = sums.get(pair, 0.) + window
+                counts[pair] = counts.get(pair, 0) + 1
+            for onset, pair in onsets:
+                first = time_to_index(recording, onset) - n_pre
+                data[first:first + n_samples] -= sums[pair] / counts[pair]
+            np.rint(data).astype(np.int16)
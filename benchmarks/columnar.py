@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for exporting StimTable runs to Parquet and reading them back.
+"""
+import os
+import tempfile
+
+from pynwb import NWBHDF5IO
+
+from .stim_table import make_stim_table_file
+
+try:
+    from ndx_electrical_stim.columnar import (read_stim_runs,
+                                              write_stim_table_parquet)
+except ImportError:
+    # pyarrow is an optional dependency
+    write_stim_table_parquet = None
+
+
+class ParquetExportSuite:
+    """
+    Exporting the runs of a StimTable read from a file, compared with
+    StimTableIOSuite.time_to_dataframe_read, and a filtered read of the
+    export.
+    """
+    params = [10000, 100000, 1000000]
+    param_names = ['n_runs']
+    number = 1
+    timeout = 300
+
+    def setup(self, n_runs):
+        if write_stim_table_parquet is None:
+            raise NotImplementedError('pyarrow is not installed')
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.nwb_path = os.path.join(self.tmpdir.name, 'runs.nwb')
+        self.parquet_path = os.path.join(self.tmpdir.name, 'runs.parquet')
+        self.export_path = os.path.join(self.tmpdir.name, 'export.parquet')
+        with NWBHDF5IO(self.nwb_path, 'w') as io:
+            io.write(make_stim_table_file(n_runs))
+        with NWBHDF5IO(self.nwb_path, 'r', load_namespaces=True) as io:
+            write_stim_table_parquet(io.read().intervals['stimtable'],
+                                     self.parquet_path, session_id='session')
+
+    def teardown(self, n_runs):
+        self.tmpdir.cleanup()
+
+    def time_export(self, n_runs):
+        with NWBHDF5IO(self.nwb_path, 'r', load_namespaces=True) as io:
+            write_stim_table_parquet(io.read().intervals['stimtable'],
+                                     self.export_path, session_id='session')
+
+    def peakmem_export(self, n_runs):
+        self.time_export(n_runs)
+
+    def time_read_filtered(self, n_runs):
+        read_stim_runs(self.parquet_path, amplitude=(1.5e-3, 2.5e-3),
+                       time=(0., n_runs / 2.))
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""
+Shared fixtures for the ndx-electrical-stim benchmarks.
+"""
+from datetime import datetime
+
+import numpy as np
+from hdmf.common import DynamicTableRegion
+from ndx_bipolar_scheme import BipolarSchemeTable, EcephysExt
+from pynwb import NWBFile
+
+
+def make_nwbfile(n_pairs=2):
+    """
+    Create an NWBFile with 2 * *n_pairs* electrodes and a BipolarSchemeTable
+    with *n_pairs* rows stored in lab_meta_data['ecephys_ext'].
+    """
+    nwbfile = NWBFile('description', 'id', datetime.now().astimezone())
+    device = nwbfile.create_device('device')
+    group = nwbfile.create_electrode_group(
+        name='electrodes',
+        description='label',
+        device=device,
+        location='brain')
+    for i in range(2 * n_pairs):
+        nwbfile.add_electrode(x=float(i), y=float(i), z=float(i), imp=np.nan,
+                              location='', filtering='', group=group)
+
+    bipolar_scheme_table = BipolarSchemeTable(name='bipolar_scheme_table',
+                                              description='desc')
+    bipolar_scheme_table.anodes.table = nwbfile.electrodes
+    bipolar_scheme_table.cathodes.table = nwbfile.electrodes
+    for i in range(n_pairs):
+        bipolar_scheme_table.add_row(anodes=[2 * i], cathodes=[2 * i + 1])
+
+    ecephys_ext = EcephysExt(name='ecephys_ext')
+    ecephys_ext.bipolar_scheme_table = bipolar_scheme_table
+    nwbfile.add_lab_meta_data(ecephys_ext)
+    return nwbfile
+
+
+def make_bipolar_region(nwbfile):
+    """
+    Create a bipolar_electrodes region over every pair of *nwbfile*.
+    """
+    bipolar_scheme_table = nwbfile.lab_meta_data['ecephys_ext'].bipolar_scheme_table
+    return DynamicTableRegion(name='bipolar_electrodes',
+                              data=np.arange(len(bipolar_scheme_table)),
+                              description='stimulated pairs',
+                              table=bipolar_scheme_table)
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for the overhead of instrumenting StimTable and StimSeries I/O.
+"""
+import contextlib
+import os
+import tempfile
+
+import numpy as np
+from pynwb import NWBHDF5IO
+
+from ndx_electrical_stim import StimSeries, StimTable
+from ndx_electrical_stim.instrumentation import instrument
+
+from .common import make_nwbfile, make_bipolar_region
+from .stim_table import make_runs
+
+N_RUNS = 10000
+
+
+class InstrumentationSuite:
+    """
+    Add 10000 runs one at a time to a StimTable, and write it with 60 s of
+    1 kHz waveform written block by block, with instrumentation disabled or
+    enabled.
+    """
+    params = ['disabled', 'enabled']
+    param_names = ['instrumentation']
+    number = 1
+    timeout = 300
+
+    def setup(self, instrumentation):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'instrumentation.nwb')
+        runs = make_runs(N_RUNS)
+        self.rows = [{k: v[i].item() for k, v in runs.items()}
+                     for i in range(N_RUNS)]
+        self.waveform = np.random.randn(60000, 2)
+
+    def teardown(self, instrumentation):
+        self.tmpdir.cleanup()
+
+    def _context(self, instrumentation):
+        if instrumentation == 'enabled':
+            return instrument()
+        return contextlib.nullcontext()
+
+    def time_add_run(self, instrumentation):
+        stim_table = StimTable(name='stimtable')
+        make_nwbfile().add_time_intervals(stim_table)
+        with self._context(instrumentation):
+            for row in self.rows:
+                stim_table.add_run(**row)
+
+    def time_write(self, instrumentation):
+        nwbfile = make_nwbfile()
+        stim_table = StimTable(name='stimtable')
+        nwbfile.add_time_intervals(stim_table)
+        with self._context(instrumentation):
+            stim_table.add_runs(**make_runs(N_RUNS))
+            nwbfile.add_acquisition(StimSeries.from_blocks(
+                blocks=(self.waveform[i:i + 1000]
+                        for i in range(0, len(self.waveform), 1000)),
+                name='stim', rate=1000.,
+                bipolar_electrodes=make_bipolar_region(nwbfile)))
+            with NWBHDF5IO(self.path, 'w') as io:
+                io.write(nwbfile, cache_spec=False)
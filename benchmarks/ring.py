@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for handing StimSeries samples from an acquisition process to a
+consumer process.
+"""
+import multiprocessing
+import time
+
+import numpy as np
+from hdmf.common import DynamicTableRegion
+
+from ndx_electrical_stim import StimSeries
+from ndx_electrical_stim.ring import StimRingBuffer, StimRingReader
+
+from .common import make_nwbfile
+
+RATE = 30000.
+BLOCK_SAMPLES = 30
+
+
+def _consume_queue(queue, results):
+    latencies = list()
+    n_samples = 0
+    while True:
+        block = queue.get()
+        if block is None:
+            break
+        latencies.append(time.perf_counter() - block[:, 0])
+        n_samples += len(block)
+    results.put((n_samples, np.median(np.concatenate(latencies))))
+
+
+def _consume_ring(name, results):
+    latencies = list()
+    n_samples = 0
+    with StimRingReader(name) as reader:
+        for block in reader.iter_blocks():
+            latencies.append(time.perf_counter() - block.data[:, 0])
+            n_samples += len(block.data)
+        results.put((n_samples, np.median(np.concatenate(latencies))))
+
+
+class StimRingSuite:
+    """
+    Send 5 s of 30 kHz waveform in 1 ms blocks to another process, pickled
+    through a multiprocessing.Queue or through a StimRingBuffer holding 1 s,
+    either paced at 1 block per ms as acquisition delivers it or as fast as
+    possible. The first column of every sample holds the time it was sent.
+    """
+    params = (['queue', 'ring'], [2, 16])
+    param_names = ['method', 'n_pairs']
+    number = 1
+    timeout = 600
+    duration = 5.
+
+    def setup(self, method, n_pairs):
+        nwbfile = make_nwbfile(n_pairs)
+        bipolar_scheme_table = \
+            nwbfile.lab_meta_data['ecephys_ext'].bipolar_scheme_table
+        self.stim_series = StimSeries(
+            name='stim', data=np.zeros((0, n_pairs)), rate=RATE,
+            bipolar_electrodes=DynamicTableRegion(
+                name='bipolar_electrodes', data=np.arange(n_pairs),
+                description='desc', table=bipolar_scheme_table))
+        self.block = np.random.randn(BLOCK_SAMPLES, n_pairs)
+        self.n_blocks = int(self.duration * RATE / BLOCK_SAMPLES)
+
+    def _send(self, method, paced):
+        """Send the blocks, and return the time until the last one was
+        received and the median latency of the samples."""
+        results = multiprocessing.Queue()
+        if method == 'ring':
+            ring = StimRingBuffer(self.stim_series, int(RATE))
+            write = ring.write
+            consumer = multiprocessing.Process(target=_consume_ring,
+                                               args=(ring.name, results))
+        else:
+            queue = multiprocessing.Queue()
+            write = queue.put
+            consumer = multiprocessing.Process(target=_consume_queue,
+                                               args=(queue, results))
+        consumer.start()
+        start = time.perf_counter()
+        for i in range(self.n_blocks):
+            if paced:
+                while time.perf_counter() < start + i * BLOCK_SAMPLES / RATE:
+                    pass
+            self.block[:, 0] = time.perf_counter()
+            write(self.block)
+        if method == 'ring':
+            ring.close()
+        else:
+            queue.put(None)
+        n_samples, latency = results.get()
+        seconds = time.perf_counter() - start
+        consumer.join()
+        return n_samples, seconds, latency
+
+    def track_latency(self, method, n_pairs):
+        return self._send(method, True)[2] * 1e6
+
+    track_latency.unit = 'us'
+
+    def track_samples_per_second(self, method, n_pairs):
+        n_samples, seconds, _ = self._send(method, False)
+        return n_samples / seconds
+
+    track_samples_per_second.unit = 'samples/s'
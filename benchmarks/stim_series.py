@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for writing and reading StimSeries waveforms.
+"""
+import os
+import tempfile
+
+import numpy as np
+from hdmf.backends.hdf5 import H5DataIO
+from pynwb import NWBHDF5IO
+
+from ndx_electrical_stim import SparseStimSeries, StimSeries
+
+from .common import make_nwbfile, make_bipolar_region
+
+RATE = 1000.
+
+
+def make_waveform(duration, n_pairs):
+    """
+    A sparse pulse-train-like waveform of *duration* seconds at 1 kHz.
+    """
+    waveform = np.zeros((int(duration * RATE), n_pairs))
+    waveform[::20] = 1e-3
+    waveform[1::20] = -1e-3
+    return waveform
+
+
+class StimSeriesIOSuite:
+    """
+    Writing and reading minutes to hours of multi-pair waveform.
+    """
+    params = ([60., 3600.], [2, 8])
+    param_names = ['duration', 'n_pairs']
+    number = 1
+    timeout = 600
+
+    def setup(self, duration, n_pairs):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.waveform = make_waveform(duration, n_pairs)
+        self.read_path = os.path.join(self.tmpdir.name, 'read.nwb')
+        self.write_path = os.path.join(self.tmpdir.name, 'write.nwb')
+        with NWBHDF5IO(self.read_path, 'w') as io:
+            io.write(self._make_file(self.waveform))
+
+    def teardown(self, duration, n_pairs):
+        self.tmpdir.cleanup()
+
+    def _make_file(self, data=None, blocks=None):
+        nwbfile = make_nwbfile(self.waveform.shape[1])
+        region = make_bipolar_region(nwbfile)
+        if blocks is None:
+            stim_series = StimSeries(name='stim', data=data,
+                                     bipolar_electrodes=region, rate=RATE)
+        else:
+            stim_series = StimSeries.from_blocks(
+                blocks=blocks, name='stim', bipolar_electrodes=region,
+                chunk_shape=(int(RATE) * 10, self.waveform.shape[1]),
+                rate=RATE)
+        nwbfile.add_acquisition(stim_series)
+        return nwbfile
+
+    def _blocks(self):
+        block_rows = int(RATE) * 60
+        for start in range(0, len(self.waveform), block_rows):
+            yield self.waveform[start:start + block_rows]
+
+    def time_write(self, duration, n_pairs):
+        with NWBHDF5IO(self.write_path, 'w') as io:
+            io.write(self._make_file(self.waveform))
+
+    def peakmem_write(self, duration, n_pairs):
+        self.time_write(duration, n_pairs)
+
+    def time_write_streamed(self, duration, n_pairs):
+        with NWBHDF5IO(self.write_path, 'w') as io:
+            io.write(self._make_file(blocks=self._blocks()))
+
+    def peakmem_write_streamed(self, duration, n_pairs):
+        self.time_write_streamed(duration, n_pairs)
+
+    def time_read(self, duration, n_pairs):
+        with NWBHDF5IO(self.read_path, 'r', load_namespaces=True) as io:
+            io.read().acquisition['stim'].data[:]
+
+    def peakmem_read(self, duration, n_pairs):
+        self.time_read(duration, n_pairs)
+
+
+SPARSE_RATE = 30000.
+
+
+def make_stim_waveform(duration, n_pairs):
+    """
+    A waveform of *duration* seconds at 30 kHz with a one-second train of
+    biphasic 100 us pulses at 50 Hz every 10 seconds, cycling through the
+    pairs: non-zero for about 0.1 % of the samples.
+    """
+    waveform = np.zeros((int(duration * SPARSE_RATE), n_pairs),
+                        dtype=np.float32)
+    period = int(SPARSE_RATE) // 50
+    for i, run_start in enumerate(range(0, len(waveform), int(SPARSE_RATE) * 10)):
+        pulses = np.arange(run_start, min(run_start + int(SPARSE_RATE),
+                                          len(waveform) - 6), period)
+        for phase, value in ((0, 1e-3), (3, -1e-3)):
+            for j in range(3):
+                waveform[pulses + phase + j, i % n_pairs] = value
+    return waveform
+
+
+class SparseStimSeriesSuite:
+    """
+    Writing and reading a low duty cycle waveform stored densely (as is, or
+    gzip-compressed) and as a SparseStimSeries.
+    """
+    params = ([600.], ['dense', 'gzip', 'sparse'])
+    param_names = ['duration', 'storage']
+    number = 1
+    timeout = 600
+
+    def setup(self, duration, storage):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.waveform = make_stim_waveform(duration, 4)
+        self.path = os.path.join(self.tmpdir.name, 'stim.nwb')
+        self.time_write(duration, storage)
+
+    def teardown(self, duration, storage):
+        self.tmpdir.cleanup()
+
+    def _make_file(self, storage):
+        nwbfile = make_nwbfile(self.waveform.shape[1])
+        region = make_bipolar_region(nwbfile)
+        kwargs = dict(name='stim', bipolar_electrodes=region,
+                      rate=SPARSE_RATE)
+        if storage == 'dense':
+            stim_series = StimSeries(data=self.waveform, **kwargs)
+        elif storage == 'gzip':
+            stim_series = StimSeries(
+                data=H5DataIO(self.waveform, compression='gzip',
+                              chunks=(int(SPARSE_RATE), self.waveform.shape[1])),
+                **kwargs)
+        else:
+            stim_series = SparseStimSeries.from_dense(data=self.waveform,
+                                                      **kwargs)
+        nwbfile.add_acquisition(stim_series)
+        return nwbfile
+
+    def time_write(self, duration, storage):
+        with NWBHDF5IO(self.path, 'w') as io:
+            io.write(self._make_file(storage), cache_spec=False)
+
+    def track_file_size(self, duration, storage):
+        return os.path.getsize(self.path)
+
+    track_file_size.unit = 'bytes'
+
+    def time_read(self, duration, storage):
+        with NWBHDF5IO(self.path, 'r') as io:
+            np.array(io.read().acquisition['stim'].get_lazy_data()[:])
+
+    def time_read_window(self, duration, storage):
+        with NWBHDF5IO(self.path, 'r') as io:
+            io.read().acquisition['stim'].get_data_in_window(100., 101.)
+
+    def time_max(self, duration, storage):
+        with NWBHDF5IO(self.path, 'r') as io:
+            io.read().acquisition['stim'].get_lazy_data().max()
+
+
+class OverviewSuite:
+    """
+    Drawing views of 10 minutes of 4-pair waveform at 30 kHz from its
+    min/max pyramid, and the cost of computing the pyramid while the
+    waveform is written ('from_blocks') or once it is written
+    ('add_overview').
+    """
+    params = ['none', 'from_blocks', 'add_overview']
+    param_names = ['overview']
+    number = 1
+    timeout = 600
+
+    def setup(self, overview):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        rng = np.random.default_rng(0)
+        self.waveform = rng.standard_normal(
+            (int(600 * SPARSE_RATE), 4)).astype(np.float32)
+        self.path = os.path.join(self.tmpdir.name, 'stim.nwb')
+        self.time_write(overview)
+
+    def teardown(self, overview):
+        self.tmpdir.cleanup()
+
+    def _blocks(self):
+        block_rows = int(SPARSE_RATE) * 10
+        for start in range(0, len(self.waveform), block_rows):
+            yield self.waveform[start:start + block_rows]
+
+    def time_write(self, overview):
+        nwbfile = make_nwbfile(self.waveform.shape[1])
+        stim_series = StimSeries.from_blocks(
+            blocks=self._blocks(), name='stim',
+            bipolar_electrodes=make_bipolar_region(nwbfile),
+            chunk_shape=(int(SPARSE_RATE), self.waveform.shape[1]),
+            rate=SPARSE_RATE,
+            overview_bin_size=256 if overview == 'from_blocks' else None)
+        nwbfile.add_acquisition(stim_series)
+        with NWBHDF5IO(self.path, 'w') as io:
+            io.write(nwbfile, cache_spec=False)
+        if overview == 'add_overview':
+            with NWBHDF5IO(self.path, 'a') as io:
+                nwbfile = io.read()
+                nwbfile.acquisition['stim'].add_overview()
+                io.write(nwbfile, cache_spec=False)
+
+    def time_overview_session(self, overview):
+        with NWBHDF5IO(self.path, 'r') as io:
+            io.read().acquisition['stim'].get_overview(0., 600., 2000)
+
+    def time_overview_minute(self, overview):
+        with NWBHDF5IO(self.path, 'r') as io:
+            io.read().acquisition['stim'].get_overview(120., 180., 2000)
+
+    def time_overview_second(self, overview):
+        with NWBHDF5IO(self.path, 'r') as io:
+            io.read().acquisition['stim'].get_overview(120., 121., 2000)
+
+
+class ParallelReadSuite:
+    """
+    Extracting epochs from 10 minutes of gzip-compressed 8-pair waveform at
+    30 kHz with pools of threads of increasing size. None is the serial
+    read through h5py.
+    """
+    params = [None, 1, 2, 4, 8]
+    param_names = ['n_workers']
+    number = 1
+    timeout = 600
+
+    def setup(self, n_workers):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        rng = np.random.default_rng(0)
+        waveform = rng.standard_normal(
+            (int(600 * SPARSE_RATE), 8)).astype(np.float32)
+        nwbfile = make_nwbfile(waveform.shape[1])
+        nwbfile.add_acquisition(StimSeries(
+            name='stim', bipolar_electrodes=make_bipolar_region(nwbfile),
+            data=H5DataIO(waveform, compression='gzip', shuffle=True,
+                          chunks=(int(SPARSE_RATE) // 10, waveform.shape[1])),
+            rate=SPARSE_RATE))
+        self.path = os.path.join(self.tmpdir.name, 'stim.nwb')
+        with NWBHDF5IO(self.path, 'w') as io:
+            io.write(nwbfile, cache_spec=False)
+        self.onsets = np.sort(rng.uniform(0., 599., 2000))
+
+    def teardown(self, n_workers):
+        self.tmpdir.cleanup()
+
+    def time_extract_epochs(self, n_workers):
+        with NWBHDF5IO(self.path, 'r') as io:
+            io.read().acquisition['stim'].extract_epochs(
+                self.onsets, .05, .05, n_workers=n_workers)
+
+    def time_get_data_in_window(self, n_workers):
+        with NWBHDF5IO(self.path, 'r') as io:
+            io.read().acquisition['stim'].get_data_in_window(
+                0., 300., n_workers=n_workers)
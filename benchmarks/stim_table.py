@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for building, writing and reading StimTable.
+"""
+import os
+import tempfile
+import time
+
+import numpy as np
+from pynwb import NWBHDF5IO
+
+from ndx_electrical_stim import CompactStimTable, StimTable
+
+from .common import make_nwbfile
+
+
+def make_runs(n_runs, n_pairs=2):
+    """
+    Parameters of *n_runs* one-second stimulation runs, as arrays.
+    """
+    start_time = np.arange(n_runs, dtype=float) * 2.
+    return dict(
+        start_time=start_time,
+        stop_time=start_time + 1.,
+        frequency=np.full(n_runs, 50.),
+        amplitude=np.tile([1e-3, 2e-3, 3e-3], n_runs // 3 + 1)[:n_runs],
+        pulse_width=np.full(n_runs, 1e-4),
+        bipolar_pair=np.arange(n_runs) % n_pairs
+    )
+
+
+def make_stim_table_file(n_runs, table_class=StimTable):
+    """
+    Create an NWBFile with a StimTable (or *table_class*) of *n_runs* runs.
+    """
+    nwbfile = make_nwbfile()
+    stim_table = table_class(name='stimtable')
+    nwbfile.add_time_intervals(stim_table)
+    stim_table.add_runs(**make_runs(n_runs))
+    return nwbfile
+
+
+class AddRunSuite:
+    """
+    Throughput of adding runs to an in-memory StimTable.
+    """
+    params = [1000, 10000, 100000]
+    param_names = ['n_runs']
+    number = 1
+    timeout = 300
+
+    def setup(self, n_runs):
+        self.nwbfile = make_nwbfile()
+        self.stim_table = StimTable(name='stimtable')
+        self.nwbfile.add_time_intervals(self.stim_table)
+        self.runs = make_runs(n_runs)
+        self.rows = [{k: v[i].item() for k, v in self.runs.items()}
+                     for i in range(n_runs)]
+
+    def time_add_run(self, n_runs):
+        for row in self.rows:
+            self.stim_table.add_run(**row)
+
+    def peakmem_add_run(self, n_runs):
+        self.time_add_run(n_runs)
+
+    def time_add_runs(self, n_runs):
+        self.stim_table.add_runs(**self.runs)
+
+    def track_add_run_rate(self, n_runs):
+        start = time.perf_counter()
+        self.time_add_run(n_runs)
+        return n_runs / (time.perf_counter() - start)
+
+    track_add_run_rate.unit = 'runs/s'
+
+
+class StimTableIOSuite:
+    """
+    Writing and reading a StimTable with NWBHDF5IO, and converting it to a
+    DataFrame with the bipolar_pair region expanded.
+    """
+    params = [1000, 10000, 100000, 1000000]
+    param_names = ['n_runs']
+    number = 1
+    timeout = 300
+
+    def setup(self, n_runs):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.nwbfile = make_stim_table_file(n_runs)
+        self.read_path = os.path.join(self.tmpdir.name, 'read.nwb')
+        self.write_path = os.path.join(self.tmpdir.name, 'write.nwb')
+        with NWBHDF5IO(self.read_path, 'w') as io:
+            io.write(make_stim_table_file(n_runs))
+
+    def teardown(self, n_runs):
+        self.tmpdir.cleanup()
+
+    def time_write(self, n_runs):
+        with NWBHDF5IO(self.write_path, 'w') as io:
+            io.write(self.nwbfile)
+
+    def peakmem_write(self, n_runs):
+        self.time_write(n_runs)
+
+    def time_read(self, n_runs):
+        with NWBHDF5IO(self.read_path, 'r', load_namespaces=True) as io:
+            stim_table = io.read().intervals['stimtable']
+            for name in stim_table.colnames:
+                stim_table[name].data[:]
+
+    def time_to_dataframe(self, n_runs):
+        self.nwbfile.intervals['stimtable'].to_dataframe()
+
+    def peakmem_to_dataframe(self, n_runs):
+        self.time_to_dataframe(n_runs)
+
+    def time_to_dataframe_read(self, n_runs):
+        with NWBHDF5IO(self.read_path, 'r', load_namespaces=True) as io:
+            io.read().intervals['stimtable'].to_dataframe()
+
+
+class CompactStimTableSuite:
+    """
+    Writing runs that repeat a few parameter sets (see make_runs) as a
+    StimTable and as a CompactStimTable, and the size of the files.
+    """
+    params = ([10000, 1000000, 10000000], ['StimTable', 'CompactStimTable'])
+    param_names = ['n_runs', 'table_class']
+    number = 1
+    timeout = 300
+
+    def setup(self, n_runs, table_class):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'write.nwb')
+        self.table_class = {'StimTable': StimTable,
+                            'CompactStimTable': CompactStimTable}[table_class]
+        self.nwbfile = make_stim_table_file(n_runs, self.table_class)
+
+    def teardown(self, n_runs, table_class):
+        self.tmpdir.cleanup()
+
+    def time_add_runs(self, n_runs, table_class):
+        make_stim_table_file(n_runs, self.table_class)
+
+    def time_write(self, n_runs, table_class):
+        with NWBHDF5IO(self.path, 'w') as io:
+            io.write(self.nwbfile, cache_spec=False)
+
+    def track_file_size(self, n_runs, table_class):
+        self.time_write(n_runs, table_class)
+        return os.path.getsize(self.path)
+
+    track_file_size.unit = 'bytes'
+
+    def time_to_dataframe(self, n_runs, table_class):
+        self.nwbfile.intervals['stimtable'].to_dataframe()
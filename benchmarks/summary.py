@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for summarizing the waveform of every StimTable run.
+"""
+import os
+import tempfile
+
+import numpy as np
+from hdmf.backends.hdf5 import H5DataIO
+from pynwb import NWBHDF5IO
+
+from ndx_electrical_stim import StimSeries, StimTable
+from ndx_electrical_stim.summary import summarize_runs
+
+from .common import make_nwbfile, make_bipolar_region
+from .stim_series import SPARSE_RATE, make_stim_waveform
+
+
+class RunSummarySuite:
+    """
+    The charge, peak, RMS and pulse count of 6000 runs over 10 minutes of
+    4-pair, gzip-compressed waveform at 30 kHz, in one streaming pass or
+    with a read per run.
+    """
+    params = ['loop', 'summarize_runs']
+    param_names = ['method']
+    number = 1
+    timeout = 600
+
+    def setup(self, method):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        waveform = make_stim_waveform(600., 4)
+        nwbfile = make_nwbfile(waveform.shape[1])
+        region = make_bipolar_region(nwbfile)
+        nwbfile.add_acquisition(StimSeries(
+            name='stim', bipolar_electrodes=region, rate=SPARSE_RATE,
+            data=H5DataIO(waveform, compression='gzip',
+                          chunks=(int(SPARSE_RATE), waveform.shape[1]))))
+        stim_table = StimTable(name='stimtable')
+        nwbfile.add_time_intervals(stim_table)
+        starts = np.arange(0., 600., .1)
+        stim_table.add_runs(
+            start_time=starts, stop_time=starts + .05,
+            frequency=np.full(len(starts), 50.),
+            amplitude=np.full(len(starts), 1e-3),
+            pulse_width=np.full(len(starts), 1e-4),
+            bipolar_pair=np.arange(len(starts)) % waveform.shape[1])
+        self.path = os.path.join(self.tmpdir.name, 'stim.nwb')
+        with NWBHDF5IO(self.path, 'w') as io:
+            io.write(nwbfile, cache_spec=False)
+
+    def teardown(self, method):
+        self.tmpdir.cleanup()
+
+    def time_summarize(self, method):
+        with NWBHDF5IO(self.path, 'r') as io:
+            nwbfile = io.read()
+            stim_series = nwbfile.acquisition['stim']
+            stim_table = nwbfile.intervals['stimtable']
+            if method == 'summarize_runs':
+                summarize_runs(stim_series, stim_table, threshold=5e-4,
+                               add_columns=False)
+                return
+            df = stim_table.to_dataframe(index=True)
+            for start, stop, pair in zip(df['start_time'], df['stop_time'],
+                                         df['bipolar_pair']):
+                x = stim_series.get_data_in_window(start, stop,
+                                                   pairs=[pair])[:, 0]
+                above = np.abs(x) > 5e-4
+                (np.abs(x).sum() / SPARSE_RATE, np.abs(x).max(),
+                 np.sqrt(np.mean(np.square(x))),
+                 above[0] + np.sum(above[1:] & ~above[:-1]))
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for rendering StimTable runs into pulse trains.
+"""
+import os
+import tempfile
+
+import numpy as np
+from pynwb import NWBHDF5IO
+
+from ndx_electrical_stim import StimTable
+from ndx_electrical_stim.synthesis import (iter_pulse_train_blocks,
+                                           synthesize_stim_series)
+
+from .common import make_nwbfile
+
+
+class SynthesisSuite:
+    """
+    Render an hour-long session with a 1 s, 100 Hz run every 2 s on each of
+    4 pairs.
+    """
+    params = [1000., 10000.]
+    param_names = ['rate']
+    number = 1
+    timeout = 300
+    duration = 3600.
+    n_pairs = 4
+
+    def setup(self, rate):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.nwbfile = make_nwbfile(self.n_pairs)
+        self.stim_table = StimTable(name='stimtable')
+        self.nwbfile.add_time_intervals(self.stim_table)
+        start_time = np.arange(0., self.duration, 2.)
+        self.stim_table.add_runs(
+            start_time=start_time,
+            stop_time=start_time + 1.,
+            frequency=np.full(len(start_time), 100.),
+            amplitude=np.full(len(start_time), 1e-3),
+            pulse_width=np.full(len(start_time), 1e-4 * 10000. / rate),
+            bipolar_pair=np.arange(len(start_time)) % self.n_pairs)
+
+    def teardown(self, rate):
+        self.tmpdir.cleanup()
+
+    def time_render(self, rate):
+        for _ in iter_pulse_train_blocks(stim_table=self.stim_table,
+                                         rate=rate,
+                                         pairs=np.arange(self.n_pairs)):
+            pass
+
+    def time_synthesize_streamed(self, rate):
+        self.nwbfile.add_acquisition(synthesize_stim_series(
+            stim_table=self.stim_table, rate=rate, name='stim', stream=True))
+        with NWBHDF5IO(os.path.join(self.tmpdir.name, 'synthesis.nwb'),
+                       'w') as io:
+            io.write(self.nwbfile)
+
+    def peakmem_synthesize_streamed(self, rate):
+        self.time_synthesize_streamed(rate)
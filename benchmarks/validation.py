@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for validating the StimTables and StimSeries of many files.
+"""
+import os
+import tempfile
+
+import numpy as np
+from hdmf.backends.hdf5 import H5DataIO
+from pynwb import NWBHDF5IO
+
+from ndx_electrical_stim import StimSeries, StimTable
+from ndx_electrical_stim.validation import validate_files
+
+from .common import make_nwbfile, make_bipolar_region
+
+N_FILES = 8
+N_RUNS = 20000
+
+
+class ValidationSuite:
+    """
+    Check 8 files of 20000 runs over 4 pairs and 10 minutes of waveform each,
+    row by row through pynwb or with validate_files.
+    """
+    params = ['rows', 'validate_files']
+    param_names = ['method']
+    number = 1
+    timeout = 600
+
+    def setup(self, method):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.paths = list()
+        for i in range(N_FILES):
+            nwbfile = make_nwbfile(4)
+            region = make_bipolar_region(nwbfile)
+            nwbfile.add_acquisition(StimSeries(
+                name='stim', bipolar_electrodes=region, rate=1000.,
+                data=H5DataIO(np.zeros((600000, 4)), compression='gzip')))
+            stim_table = StimTable(name='stimtable')
+            nwbfile.add_time_intervals(stim_table)
+            starts = np.linspace(0., 599., N_RUNS)
+            stim_table.add_runs(
+                start_time=starts, stop_time=starts + .02,
+                frequency=np.full(N_RUNS, 50.),
+                amplitude=np.full(N_RUNS, 1e-3),
+                pulse_width=np.full(N_RUNS, 1e-4),
+                bipolar_pair=np.arange(N_RUNS) % 4)
+            path = os.path.join(self.tmpdir.name, 's%d.nwb' % i)
+            with NWBHDF5IO(path, 'w') as io:
+                io.write(nwbfile, cache_spec=False)
+            self.paths.append(path)
+
+    def teardown(self, method):
+        self.tmpdir.cleanup()
+
+    def time_validate(self, method):
+        if method == 'validate_files':
+            validate_files(self.paths, n_workers=0)
+            return
+        for path in self.paths:
+            with NWBHDF5IO(path, 'r') as io:
+                nwbfile = io.read()
+                stim_series = nwbfile.acquisition['stim']
+                stim_table = nwbfile.intervals['stimtable']
+                n_pairs = len(stim_table['bipolar_pair'].table)
+                region = stim_series.bipolar_electrodes
+                assert all(0 <= pair < n_pairs for pair in region.data)
+                assert stim_series.data.shape[1] == len(region)
+                end = stim_series.starting_time \
+                    + len(stim_series.data) / stim_series.rate
+                for row in stim_table.to_dataframe(index=True).itertuples():
+                    assert 0 <= row.bipolar_pair < n_pairs
+                    assert row.start_time < row.stop_time
+                    assert stim_series.starting_time <= row.start_time
+                    assert row.stop_time <= end
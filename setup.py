@@ -17,12 +17,22 @@ setup_args = {
     'install_requires': [
         'pynwb>=1.3.0'
     ],
+    'extras_require': {
+        'arrow': ['pyarrow'],
+    },
     'packages': find_packages('src/pynwb'),
     'package_dir': {'': 'src/pynwb'},
     'package_data': {'ndx_electrical_stim': [
         'spec/ndx-electrical-stim.namespace.yaml',
         'spec/ndx-electrical-stim.extensions.yaml',
     ]},
+    'entry_points': {
+        'console_scripts': [
+            'ndx-electrical-stim-convert=ndx_electrical_stim.convert:main',
+            'ndx-electrical-stim-validate='
+            'ndx_electrical_stim.validation:main',
+        ],
+    },
     'classifiers': [
         "Intended Audience :: Developers",
         "Intended Audience :: Science/Research",
@@ -1,32 +1,24 @@
 # -*- coding: utf-8 -*-
 """
-Initialize the StimSeries and StimTable classes.
-"""
-# Standard libraries
-import os
-
-# Third party libraries
-from pynwb import load_namespaces
+Initialize the StimSeries, SparseStimSeries, StimTable and CompactStimTable
+classes.
 
-# Set path of the namespace.yaml file to the expected install location
-ndx_electrical_stim_specpath = os.path.join(
-    os.path.dirname(__file__),
-    'spec',
-    'ndx-electrical-stim.namespace.yaml'
-)
+Importing the package loads the namespace and registers the classes with
+PyNWB, so that files that use them can be read.
+"""
+from .namespace import get_namespace_path, load_namespace
 
-# If the extension has not been installed yet but we are running directly from
-# the git repo
-if not os.path.exists(ndx_electrical_stim_specpath):
-    ndx_electrical_stim_specpath = os.path.abspath(os.path.join(
-        os.path.dirname(__file__),
-        '..', '..', '..',
-        'spec',
-        'ndx-electrical-stim.namespace.yaml'
-    ))
+# Set path of the namespace.yaml file to the installed copy, or to the one in
+# the git repo when running from a source checkout
+ndx_electrical_stim_specpath = get_namespace_path()
 
 # Load the namespace
-load_namespaces(ndx_electrical_stim_specpath)
+load_namespace()
+
 
+from .ndx_electrical_stim import (BipolarTableNotFoundError,  # noqa: E402
+                                  CompactStimTable, SparseStimSeries,
+                                  StimParameterTable, StimSeries, StimTable)
 
-from .ndx_electrical_stim import StimSeries, StimTable
+__all__ = ['StimSeries', 'SparseStimSeries', 'StimTable', 'CompactStimTable',
+           'StimParameterTable', 'BipolarTableNotFoundError']
@@ -0,0 +1,409 @@
+# -*- coding: utf-8 -*-
+"""
+Append stimulation waveform samples and StimTable runs to an NWB file that is
+open for writing, e.g. during closed-loop experiments.
+
+The datasets being appended to must be resizable. Create the StimSeries with
+*create_appendable_stim_series* (or *StimSeries.from_blocks*) and call
+*make_appendable* on the StimTable before the file is first written. Then
+re-open the file in append mode and wrap the objects read from it in a
+*StimSeriesAppender* or *StimTableAppender*.
+"""
+import time
+
+import h5py
+import numpy as np
+from hdmf.backends.hdf5 import H5DataIO
+from hdmf.common import VectorIndex
+from hdmf.utils import docval, getargs, popargs, get_docval
+
+from .instrumentation import instrumented, record
+from .ndx_electrical_stim import StimSeries, StimTable
+from .ring import StimRingBuffer
+
+
+@docval(
+    *get_docval(StimSeries.__init__, 'name', 'bipolar_electrodes'),
+    {
+        'name': 'chunk_rows',
+        'type': int,
+        'doc': 'number of samples per HDF5 chunk',
+        'default': 4096
+    },
+    {
+        'name': 'compression',
+        'type': str,
+        'doc': "compression filter to apply, 'gzip' or 'lzf'",
+        'default': None
+    },
+    {
+        'name': 'dtype',
+        'type': (type, np.dtype, str),
+        'doc': 'dtype of the waveform samples',
+        'default': 'float64'
+    },
+    {
+        'name': 'rate',
+        'type': float,
+        'doc': 'sampling rate in Hz. If not given, a timestamp must be '
+               'appended with every sample',
+        'default': None
+    },
+    {
+        'name': 'starting_time',
+        'type': float,
+        'doc': 'the time of the first sample, in seconds. Requires *rate*',
+        'default': None
+    },
+    *get_docval(StimSeries.__init__, 'resolution', 'conversion', 'comments',
+                'description', 'control', 'control_description'),
+    returns='an empty StimSeries with resizable datasets', rtype=StimSeries,
+    is_method=False
+)
+def create_appendable_stim_series(**kwargs):
+    """
+    Create an empty StimSeries whose waveform (and timestamps, if no *rate*
+    is given) are written as resizable datasets that a StimSeriesAppender
+    can grow.
+    """
+    chunk_rows, compression, dtype, rate, starting_time = popargs(
+        'chunk_rows', 'compression', 'dtype', 'rate', 'starting_time', kwargs)
+    if rate is None and starting_time is not None:
+        raise ValueError('starting_time requires a rate; without one, the '
+                         'time of every sample is given by its timestamp')
+    n_pairs = len(kwargs['bipolar_electrodes'])
+    kwargs['data'] = H5DataIO(data=np.empty((0, n_pairs), dtype=dtype),
+                              maxshape=(None, n_pairs),
+                              chunks=(chunk_rows, n_pairs),
+                              compression=compression)
+    if rate is None:
+        kwargs['timestamps'] = H5DataIO(data=np.empty(0),
+                                        maxshape=(None,),
+                                        chunks=(chunk_rows,))
+    else:
+        kwargs['rate'] = rate
+        kwargs['starting_time'] = starting_time
+    return StimSeries(**kwargs)
+
+
+@docval(
+    {
+        'name': 'stim_table',
+        'type': StimTable,
+        'doc': 'the StimTable to make appendable, before it is first written'
+    },
+    {
+        'name': 'chunk_rows',
+        'type': int,
+        'doc': 'number of rows per HDF5 chunk',
+        'default': 1024
+    },
+    is_method=False
+)
+def make_appendable(**kwargs):
+    """
+    Write the ID and columns of *stim_table* as resizable datasets so that a
+    StimTableAppender can add runs to them later.
+
+    Call this after all columns have been added and before the file is
+    written.
+    """
+    stim_table, chunk_rows = getargs('stim_table', 'chunk_rows', kwargs)
+    for column in (stim_table.id,) + tuple(stim_table.columns):
+        if isinstance(column, VectorIndex):
+            raise ValueError("ragged column '%s' cannot be appended to"
+                             % column.target.name)
+        column.set_dataio(H5DataIO(maxshape=(None,), chunks=(chunk_rows,)))
+
+
+class StimSeriesAppender(object):
+    """
+    Buffer stimulation waveform samples and append them to the data of a
+    StimSeries that was read from a file opened in append mode.
+
+    Samples are collected in a preallocated buffer and written with a single
+    resize and write once *flush_samples* samples are buffered or
+    *flush_interval* seconds have passed since the last flush. The interval is
+    checked whenever samples are appended. If a *ring* is given, every block
+    is also written to it as soon as it is appended, for other processes to
+    read while it is buffered.
+    """
+
+    @docval(
+        {
+            'name': 'stim_series',
+            'type': StimSeries,
+            'doc': 'the StimSeries to append to, read from a file opened in '
+                   'append mode'
+        },
+        {
+            'name': 'flush_samples',
+            'type': int,
+            'doc': 'number of buffered samples that triggers a flush',
+            'default': 4096
+        },
+        {
+            'name': 'flush_interval',
+            'type': float,
+            'doc': 'maximum number of seconds between flushes',
+            'default': None
+        },
+        {
+            'name': 'ring',
+            'type': StimRingBuffer,
+            'doc': 'a ring buffer created from the StimSeries that appended '
+                   'samples are also written to',
+            'default': None
+        }
+    )
+    def __init__(self, **kwargs):
+        stim_series, flush_samples, flush_interval, ring = getargs(
+            'stim_series', 'flush_samples', 'flush_interval', 'ring', kwargs)
+        data = stim_series.data
+        _check_resizable(data, 'data of StimSeries %s' % stim_series.name)
+        n_pairs = len(stim_series.bipolar_electrodes)
+        if data.shape[1:] != (n_pairs,):
+            raise ValueError('data of StimSeries %s has shape %s but '
+                             'bipolar_electrodes has %d pairs'
+                             % (stim_series.name, str(data.shape), n_pairs))
+        self.__data = data
+        self.__timestamps = None
+        if stim_series.timestamps is not None:
+            _check_resizable(stim_series.timestamps,
+                             'timestamps of StimSeries %s' % stim_series.name)
+            self.__timestamps = stim_series.timestamps
+        if ring is not None:
+            if ring.n_pairs != n_pairs \
+                    or ring.has_timestamps != (self.__timestamps is not None):
+                raise ValueError('ring buffer %s was not created from '
+                                 'StimSeries %s'
+                                 % (ring.name, stim_series.name))
+            if ring.first_sample + ring.n_written != len(data):
+                raise ValueError('ring buffer %s is at sample %d but '
+                                 'StimSeries %s has %d samples'
+                                 % (ring.name, ring.first_sample
+                                    + ring.n_written, stim_series.name,
+                                    len(data)))
+        self.__ring = ring
+        self.__flush_interval = flush_interval
+        self.__buffer = np.empty((flush_samples, n_pairs), dtype=data.dtype)
+        self.__timestamps_buffer = np.empty(flush_samples, dtype=float)
+        self.__n_buffered = 0
+        self.__last_flush = time.monotonic()
+
+    @property
+    def n_samples(self):
+        """The number of samples written or buffered so far"""
+        return self.__data.shape[0] + self.__n_buffered
+
+    @docval(
+        {
+            'name': 'samples',
+            'type': 'array_data',
+            'doc': 'waveform samples of shape (n_samples, n_pairs)'
+        },
+        {
+            'name': 'timestamps',
+            'type': 'array_data',
+            'doc': 'timestamps of the samples, required if the StimSeries '
+                   'uses timestamps instead of a rate',
+            'default': None
+        }
+    )
+    def append(self, **kwargs):
+        """
+        Append a block of waveform samples.
+        """
+        samples, timestamps = getargs('samples', 'timestamps', kwargs)
+        samples = np.asarray(samples)
+        if samples.ndim != 2 or samples.shape[1] != self.__buffer.shape[1]:
+            raise ValueError('samples must have shape (n_samples, %d), found '
+                             '%s' % (self.__buffer.shape[1],
+                                     str(samples.shape)))
+        if (timestamps is None) != (self.__timestamps is None):
+            raise ValueError('timestamps must be given if and only if the '
+                             'StimSeries uses timestamps')
+        if timestamps is not None:
+            timestamps = np.asarray(timestamps)
+            if timestamps.shape != samples.shape[:1]:
+                raise ValueError('found %d timestamps for %d samples'
+                                 % (len(timestamps), len(samples)))
+
+        if self.__ring is not None:
+            self.__ring.write(samples, timestamps)
+        capacity = len(self.__buffer)
+        if self.__n_buffered + len(samples) > capacity:
+            self.flush()
+        if len(samples) >= capacity:
+            # too large to buffer, write it straight through
+            self.__write(samples, timestamps)
+        else:
+            end = self.__n_buffered + len(samples)
+            self.__buffer[self.__n_buffered:end] = samples
+            if timestamps is not None:
+                self.__timestamps_buffer[self.__n_buffered:end] = timestamps
+            self.__n_buffered = end
+            if end == capacity:
+                self.flush()
+        if (self.__flush_interval is not None
+                and time.monotonic() - self.__last_flush >= self.__flush_interval):
+            self.flush()
+
+    def flush(self):
+        """
+        Write all buffered samples to the file.
+        """
+        if self.__n_buffered:
+            timestamps = None
+            if self.__timestamps is not None:
+                timestamps = self.__timestamps_buffer[:self.__n_buffered]
+            self.__write(self.__buffer[:self.__n_buffered], timestamps)
+            self.__n_buffered = 0
+        self.__data.file.flush()
+        self.__last_flush = time.monotonic()
+
+    @instrumented('StimSeriesAppender.hdf5_write')
+    def __write(self, samples, timestamps):
+        _append_to_dataset(self.__data, samples)
+        if timestamps is not None:
+            _append_to_dataset(self.__timestamps, timestamps)
+        record('StimSeriesAppender.hdf5_write', calls=0,
+               bytes_written=samples.nbytes + (0 if timestamps is None
+                                               else timestamps.nbytes),
+               buffer_bytes=self.__buffer.nbytes)
+
+    def close(self):
+        """
+        Flush any buffered samples.
+        """
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class StimTableAppender(object):
+    """
+    Buffer stimulation runs and append them to a StimTable that was read
+    from a file opened in append mode.
+
+    Runs are collected in preallocated column buffers and added with a
+    single *StimTable.add_runs* once *flush_runs* runs are buffered or
+    *flush_interval* seconds have passed since the last flush.
+    """
+
+    @docval(
+        {
+            'name': 'stim_table',
+            'type': StimTable,
+            'doc': 'the StimTable to append to, read from a file opened in '
+                   'append mode'
+        },
+        {
+            'name': 'flush_runs',
+            'type': int,
+            'doc': 'number of buffered runs that triggers a flush',
+            'default': 256
+        },
+        {
+            'name': 'flush_interval',
+            'type': float,
+            'doc': 'maximum number of seconds between flushes',
+            'default': None
+        }
+    )
+    def __init__(self, **kwargs):
+        stim_table, flush_runs, flush_interval = getargs(
+            'stim_table', 'flush_runs', 'flush_interval', kwargs)
+        _check_resizable(stim_table.id.data,
+                         'id of StimTable %s' % stim_table.name)
+        self.__buffers = dict()
+        for name in stim_table.colnames:
+            column = stim_table[name]
+            _check_resizable(column.data, "column '%s' of StimTable %s"
+                             % (name, stim_table.name))
+            self.__buffers[name] = np.empty(flush_runs,
+                                            dtype=column.data.dtype)
+        bipolar_table = stim_table['bipolar_pair'].table
+        self.__n_pairs = None if bipolar_table is None else len(bipolar_table)
+        self.__stim_table = stim_table
+        self.__flush_interval = flush_interval
+        self.__n_buffered = 0
+        self.__last_flush = time.monotonic()
+
+    @property
+    def n_runs(self):
+        """The number of runs written or buffered so far"""
+        return len(self.__stim_table) + self.__n_buffered
+
+    @docval(
+        *get_docval(StimTable.add_run),
+        {
+            'name': 'bipolar_pair',
+            'type': int,
+            'doc': 'the row of the BipolarSchemeTable used for this run'
+        },
+        allow_extra=True
+    )
+    def add_run(self, **kwargs):
+        """
+        Buffer the stimulation parameters of a single run.
+        """
+        if set(kwargs) != set(self.__buffers):
+            raise ValueError('run data keys %s do not match the columns of '
+                             'StimTable %s'
+                             % (sorted(kwargs), self.__stim_table.name))
+        bipolar_pair = kwargs['bipolar_pair']
+        if self.__n_pairs is not None and not 0 <= bipolar_pair < self.__n_pairs:
+            raise IndexError('bipolar_pair %d is out of range for a '
+                             'BipolarSchemeTable with %d rows'
+                             % (bipolar_pair, self.__n_pairs))
+        for name, value in kwargs.items():
+            self.__buffers[name][self.__n_buffered] = value
+        self.__n_buffered += 1
+        if (self.__n_buffered == len(self.__buffers['start_time'])
+                or (self.__flush_interval is not None
+                    and time.monotonic() - self.__last_flush >= self.__flush_interval)):
+            self.flush()
+
+    def flush(self):
+        """
+        Write all buffered runs to the file.
+        """
+        if self.__n_buffered:
+            self.__stim_table.add_runs(
+                **{name: buffer[:self.__n_buffered]
+                   for name, buffer in self.__buffers.items()})
+            self.__n_buffered = 0
+        self.__stim_table.id.data.file.flush()
+        self.__last_flush = time.monotonic()
+
+    def close(self):
+        """
+        Flush any buffered runs.
+        """
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def _check_resizable(data, what):
+    if not isinstance(data, h5py.Dataset):
+        raise ValueError('%s must be read from an HDF5 file opened in append '
+                         'mode' % what)
+    if data.maxshape[0] is not None:
+        raise ValueError('%s is not resizable, see create_appendable_stim_'
+                         'series and make_appendable' % what)
+
+
+def _append_to_dataset(dset, values):
+    start = dset.shape[0]
+    dset.resize(start + len(values), axis=0)
+    dset[start:] = values
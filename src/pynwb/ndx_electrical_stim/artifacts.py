@@ -0,0 +1,500 @@
+# -*- coding: utf-8 -*-
+"""
+Remove stimulation artifacts from ElectricalSeries recordings, using the
+timing of the pulses of the runs of a StimTable.
+
+The onset of every pulse is either computed from the parameters of its run,
+like synthesize_stim_series renders it, or detected in the waveform of a
+StimSeries that recorded the delivered pulses. Around each onset, a window of
+the recording is either blanked or has the mean artifact of the pulses with
+the same bipolar pair, amplitude and pulse width subtracted from it.
+
+The windows are converted to sample indices once, sorted and made
+disjoint, so the recording can then be cleaned one block of samples at a
+time, and optionally one block of channels per thread, with array
+operations over all the windows of a block. The cleaned recording is
+streamed to a new ElectricalSeries as it is written.
+"""
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from hdmf.utils import docval, getargs, popargs, get_docval
+from pynwb.ecephys import ElectricalSeries
+
+from .data_utils import (StimBlockIterator, get_readable_data, time_to_index,
+                         wrap_waveform_data)
+from .ndx_electrical_stim import StimSeries, StimTable
+from .parallel import get_parallel_data, iter_read_segments
+from .pulses import (PhaseTracker, SampleTimes, get_default_threshold,
+                     get_rate)
+
+# target number of bytes of recording cleaned at a time
+_BLOCK_BYTES = 8 * 1024 ** 2
+
+ArtifactWindows = namedtuple('ArtifactWindows', [
+    'starts', 'stops', 'groups', 'n_samples', 'n_groups'])
+ArtifactWindows.__doc__ = """
+The windows of a recording around every stimulation pulse, sorted by their
+first sample. Window i covers the samples [starts[i], stops[i]) of the
+recording, at positions 0 to stops[i] - starts[i] of a window of *n_samples*
+samples. Windows are cut short where the next window starts, so they never
+overlap, and *starts* may be negative for pulses at the very beginning of the
+recording. *groups* is the group of the pulse of each window, among
+*n_groups* groups of runs with the same bipolar pair, amplitude and pulse
+width.
+"""
+
+
+@docval(
+    {
+        'name': 'electrical_series',
+        'type': ElectricalSeries,
+        'doc': 'the recording with the artifacts'
+    },
+    {
+        'name': 'stim_table',
+        'type': StimTable,
+        'doc': 'the runs whose pulses caused the artifacts'
+    },
+    {
+        'name': 'post',
+        'type': float,
+        'doc': 'the end of the window of each pulse, in seconds after its '
+               'onset'
+    },
+    {
+        'name': 'pre',
+        'type': float,
+        'doc': 'the start of the window of each pulse, in seconds before its '
+               'onset',
+        'default': 0.
+    },
+    {
+        'name': 'stim_series',
+        'type': StimSeries,
+        'doc': 'the delivered waveform to detect the onsets of the pulses in. '
+               'By default, the onsets are computed from the start time and '
+               'frequency of the runs',
+        'default': None
+    },
+    {
+        'name': 'threshold',
+        'type': float,
+        'doc': 'the absolute value of *stim_series* above which a sample is '
+               'part of a pulse. Defaults to half of the largest absolute '
+               'value of the waveform, which costs an extra pass over the data',
+        'default': None
+    },
+    returns='the window of every pulse', rtype=ArtifactWindows,
+    is_method=False
+)
+def get_artifact_windows(**kwargs):
+    """
+    Find the sample-index windows of a recording around the pulses of the
+    runs of a StimTable.
+
+    With a StimSeries, the onsets are those of the pulses detected in its
+    waveform, like detect_runs detects them, that fall within a run on the
+    same bipolar pair; this accounts for delays between the commanded and the
+    delivered pulses. Runs with NaN times or without a positive frequency
+    have no pulses.
+    """
+    electrical_series, stim_table, post, pre, stim_series, threshold = getargs(
+        'electrical_series', 'stim_table', 'post', 'pre', 'stim_series',
+        'threshold', kwargs)
+    if pre < 0 or post <= -pre:
+        raise ValueError('the windows must not be empty and pre must not be '
+                         'negative, got pre=%g and post=%g' % (pre, post))
+    runs = _read_runs(stim_table)
+    if stim_series is None:
+        onsets, run_of_pulse = _commanded_onsets(runs)
+    else:
+        onsets, run_of_pulse = _detected_onsets(runs, stim_series, threshold)
+
+    # runs with the same parameters share a group, and an artifact template
+    parameters = np.column_stack([runs['bipolar_pair'], runs['amplitude'],
+                                  runs['pulse_width']])
+    _, run_groups = np.unique(parameters, axis=0, return_inverse=True)
+    run_groups = run_groups.reshape(-1)
+    n_groups = int(run_groups.max(initial=-1)) + 1
+
+    rate = get_rate(electrical_series)
+    n_pre = int(round(pre * rate))
+    n_samples = max(n_pre + int(round(post * rate)), 1)
+    n_recording = len(get_readable_data(electrical_series.data))
+    starts = time_to_index(electrical_series, onsets, 'left') - n_pre
+    order = np.argsort(starts, kind='stable')
+    starts = starts[order]
+    groups = run_groups[run_of_pulse[order]]
+    stops = np.minimum(np.r_[starts[1:], n_recording], starts + n_samples)
+    stops = np.clip(stops, np.clip(starts, 0, n_recording), n_recording)
+    return ArtifactWindows(starts, stops, groups, n_samples, n_groups)
+
+
+@docval(
+    {
+        'name': 'electrical_series',
+        'type': ElectricalSeries,
+        'doc': 'the recording with the artifacts'
+    },
+    {
+        'name': 'windows',
+        'type': ArtifactWindows,
+        'doc': 'the windows of the pulses, from get_artifact_windows'
+    },
+    {
+        'name': 'n_workers',
+        'type': int,
+        'doc': 'the number of threads to read the windows with. By default, '
+               'they are read in the calling thread',
+        'default': None
+    },
+    returns='the template of every group, of shape (n_groups, n_samples, '
+            'n_channels)', rtype=np.ndarray,
+    is_method=False
+)
+def get_artifact_templates(**kwargs):
+    """
+    Average the recording over the windows of the pulses of each group, in
+    units of the recording, without its *conversion*.
+
+    The windows are read a few at a time, so memory does not depend on the
+    number of pulses. A position of a template that no window of its group
+    covers is 0.
+    """
+    electrical_series, windows, n_workers = getargs(
+        'electrical_series', 'windows', 'n_workers', kwargs)
+    data = get_readable_data(electrical_series.data)
+    n_channels = data.shape[1] if data.ndim > 1 else 1
+    shape = (windows.n_groups, windows.n_samples, n_channels)
+    sums = np.zeros(shape)
+    counts = np.zeros(shape, dtype=np.int64)
+    # windows less than an HDF5 chunk apart are read together, since their
+    # chunks are decompressed anyway
+    chunks = getattr(data, 'chunks', None)
+    segments = iter_read_segments(data, windows.starts, windows.stops,
+                                  windows.n_samples, fill_value=np.nan,
+                                  max_gap=chunks[0] if chunks else 0,
+                                  n_workers=n_workers or 0)
+    for indices, values in segments:
+        groups = windows.groups[indices]
+        order = np.argsort(groups, kind='stable')
+        groups, values = groups[order], values[order]
+        found = np.isfinite(values)
+        first = np.flatnonzero(np.r_[True, groups[1:] != groups[:-1]])
+        sums[groups[first]] += np.add.reduceat(np.where(found, values, 0.),
+                                               first, axis=0)
+        counts[groups[first]] += np.add.reduceat(found, first, axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(counts > 0, sums / counts, 0.)
+
+
+def iter_clean_blocks(data, windows, templates=None, fill_value=0.,
+                      block_rows=None, channel_block=None, n_workers=None):
+    """
+    Remove the artifacts from a recording one block of samples at a time,
+    yielding the cleaned blocks.
+
+    The samples of the windows are set to *fill_value* or, with *templates*,
+    have the template of the group of their window subtracted. The rows of
+    the windows in a block are computed once for all its channels. Blocks of
+    an integer dtype keep it, and subtracted samples are rounded.
+
+    With threads, every block of channels of every block of samples is read
+    and cleaned by one of the threads, and up to *n_workers* blocks of
+    samples are in flight at once, so that threads are kept busy even when
+    there is a single block of channels.
+
+    :param data: array or h5py.Dataset of shape (n_samples,) or
+                 (n_samples, n_channels)
+    :param windows: the ArtifactWindows of the pulses
+    :param templates: the artifact templates, from get_artifact_templates.
+                      By default, the windows are blanked
+    :param fill_value: the value of blanked samples
+    :param block_rows: the number of samples per block. Defaults to about
+                       8 MiB of whole HDF5 chunks
+    :param channel_block: the number of channels cleaned at a time. Defaults
+                          to the channels of an HDF5 chunk, so that each
+                          chunk is decompressed by one thread, or to an even
+                          split between the threads
+    :param n_workers: the number of threads. By default, blocks are cleaned
+                      in the calling thread
+    """
+    if data.ndim not in (1, 2):
+        raise ValueError('the recording must be 1D or 2D (time x channels), '
+                         'found shape %s' % str(data.shape))
+    if n_workers is not None and n_workers < 0:
+        raise ValueError('n_workers must be non-negative, got %d' % n_workers)
+    source = get_parallel_data(data) if n_workers else None
+    if source is None:
+        source = data
+        n_workers = 0
+    block_rows, channel_block = _clean_block_shape(data, block_rows,
+                                                   channel_block, n_workers)
+    n_channels = data.shape[1] if data.ndim > 1 else 1
+    column_starts = range(0, n_channels, channel_block)
+
+    def clean_block(first, submit):
+        last = min(len(data), first + block_rows)
+        rows, windows_of_rows = _window_rows(windows, first, last)
+        return [submit(_clean_part, source, windows, templates, fill_value,
+                       first, last, rows, windows_of_rows,
+                       slice(c0, c0 + channel_block))
+                for c0 in column_starts]
+
+    def join(parts):
+        block = np.concatenate(parts, axis=1) if len(parts) > 1 else parts[0]
+        return block[:, 0] if data.ndim == 1 else block
+
+    firsts = range(0, len(data), block_rows)
+    if not n_workers:
+        for first in firsts:
+            yield join(clean_block(first, lambda func, *args: func(*args)))
+        return
+    executor = ThreadPoolExecutor(max_workers=n_workers)
+    pending = deque()
+    try:
+        for first in firsts:
+            pending.append(clean_block(first, executor.submit))
+            if len(pending) >= n_workers:
+                yield join([part.result() for part in pending.popleft()])
+        while pending:
+            yield join([part.result() for part in pending.popleft()])
+    finally:
+        # stop cleaning if the caller stops iterating early
+        for parts in pending:
+            for part in parts:
+                part.cancel()
+        executor.shutdown(wait=True)
+
+
+@docval(
+    *get_docval(get_artifact_windows, 'electrical_series', 'stim_table',
+                'post', 'pre', 'stim_series', 'threshold'),
+    {
+        'name': 'method',
+        'type': str,
+        'doc': "'blank' to set the samples of the windows to *fill_value*, "
+               "or 'template' to subtract the mean artifact of the pulses "
+               'with the same bipolar pair, amplitude and pulse width',
+        'default': 'blank'
+    },
+    {
+        'name': 'fill_value',
+        'type': float,
+        'doc': "the value of the blanked samples, for method='blank'",
+        'default': 0.
+    },
+    {
+        'name': 'name',
+        'type': str,
+        'doc': 'the name of the cleaned ElectricalSeries. Defaults to the '
+               'name of *electrical_series*',
+        'default': None
+    },
+    {
+        'name': 'block_rows',
+        'type': int,
+        'doc': 'the number of samples to clean at a time. Defaults to about '
+               '8 MiB of recording',
+        'default': None
+    },
+    {
+        'name': 'channel_block',
+        'type': int,
+        'doc': 'the number of channels cleaned by each thread. Defaults to '
+               'an even split between the threads',
+        'default': None
+    },
+    {
+        'name': 'n_workers',
+        'type': int,
+        'doc': 'the number of threads to read and clean the recording with. '
+               'By default, it is cleaned in the calling thread',
+        'default': None
+    },
+    *get_docval(StimSeries.from_blocks, 'chunk_shape', 'compression',
+                'compression_opts', 'shuffle'),
+    returns='the cleaned recording', rtype=ElectricalSeries,
+    is_method=False
+)
+def remove_artifacts(**kwargs):
+    """
+    Remove the stimulation artifacts of the pulses of a StimTable from an
+    ElectricalSeries.
+
+    The cleaned recording is written block by block when its file is written
+    with NWBHDF5IO, as a chunked, compressed dataset, so memory is bounded by
+    the block size however long the recording is. The file of
+    *electrical_series* must stay open until then. The cleaned
+    ElectricalSeries shares the electrodes, time base and conversion of the
+    original one, and can be added to a processing module.
+    """
+    electrical_series, method, fill_value, name, block_rows, channel_block, \
+        n_workers, chunk_shape, compression, compression_opts, shuffle = \
+        popargs('electrical_series', 'method', 'fill_value', 'name',
+                'block_rows', 'channel_block', 'n_workers', 'chunk_shape',
+                'compression', 'compression_opts', 'shuffle', kwargs)
+    if method not in ('blank', 'template'):
+        raise ValueError("method must be 'blank' or 'template', found '%s'"
+                         % method)
+    windows = get_artifact_windows(electrical_series=electrical_series,
+                                   **kwargs)
+    templates = None
+    if method == 'template':
+        templates = get_artifact_templates(electrical_series, windows,
+                                           n_workers=n_workers)
+    data = get_readable_data(electrical_series.data)
+    blocks = iter_clean_blocks(data, windows, templates=templates,
+                               fill_value=fill_value, block_rows=block_rows,
+                               channel_block=channel_block,
+                               n_workers=n_workers)
+    iterator = StimBlockIterator(blocks=blocks, dtype=data.dtype,
+                                 chunk_shape=chunk_shape)
+    time_base = dict(timestamps=electrical_series) \
+        if electrical_series.rate is None \
+        else dict(rate=electrical_series.rate,
+                  starting_time=electrical_series.starting_time)
+    return ElectricalSeries(
+        name=name or electrical_series.name,
+        data=wrap_waveform_data(iterator, chunk_shape, compression,
+                                compression_opts, shuffle),
+        electrodes=electrical_series.electrodes,
+        channel_conversion=electrical_series.channel_conversion,
+        filtering=electrical_series.filtering,
+        resolution=electrical_series.resolution,
+        conversion=electrical_series.conversion,
+        comments=electrical_series.comments,
+        description='%s, with stimulation artifacts removed (%s)'
+                    % (electrical_series.description, method),
+        **time_base)
+
+
+def _read_runs(stim_table):
+    """
+    The columns of the runs of a StimTable that have pulses.
+    """
+    runs = {name: np.asarray(get_readable_data(stim_table[name].data)[:])
+            for name in ('start_time', 'stop_time', 'frequency', 'amplitude',
+                         'pulse_width', 'bipolar_pair')}
+    with np.errstate(invalid='ignore'):
+        valid = (np.isfinite(runs['start_time'])
+                 & np.isfinite(runs['stop_time']) & (runs['frequency'] > 0))
+    return {name: values[valid] for name, values in runs.items()}
+
+
+def _commanded_onsets(runs):
+    """
+    The onset of every pulse of the runs, and the run of each pulse.
+    """
+    start, stop, frequency = (runs['start_time'], runs['stop_time'],
+                              runs['frequency'])
+    counts = np.maximum(np.ceil((stop - start) * frequency), 0).astype(np.int64)
+    run_of_pulse = np.repeat(np.arange(len(start)), counts)
+    k = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    onsets = start[run_of_pulse] + k / frequency[run_of_pulse]
+    keep = onsets < stop[run_of_pulse]
+    return onsets[keep], run_of_pulse[keep]
+
+
+def _detected_onsets(runs, stim_series, threshold):
+    """
+    The onsets of the pulses of a StimSeries that fall within a run on the
+    same bipolar pair, and the run of each pulse.
+    """
+    data = stim_series.get_lazy_data()
+    if data.ndim != 2:
+        raise ValueError('the waveform of StimSeries %s must be 2D (time x '
+                         'pairs)' % stim_series.name)
+    if threshold is None:
+        threshold = get_default_threshold(data)
+    trackers = [PhaseTracker(threshold) for _ in range(data.shape[1])]
+    for start, block in data.iter_blocks():
+        for column, tracker in enumerate(trackers):
+            tracker.consume(block[:, column], start)
+    times = SampleTimes(stim_series, len(data))
+    # the first sample of a pulse can be up to a sample after its onset
+    tolerance = 1. / times.rate
+    pairs = np.asarray(get_readable_data(stim_series.bipolar_electrodes.data)[:])
+    all_onsets, all_runs = [np.empty(0)], [np.empty(0, dtype=np.int64)]
+    for column, tracker in enumerate(trackers):
+        starts, _, _, before, _ = tracker.finish(len(data))
+        onsets = times(starts[before == 0].astype(np.int64))
+        # the runs of the pair, by start time
+        pair_runs = np.flatnonzero(runs['bipolar_pair'] == pairs[column])
+        if not len(pair_runs):
+            continue
+        pair_runs = pair_runs[np.argsort(runs['start_time'][pair_runs],
+                                         kind='stable')]
+        # the last run that starts before each onset, if it is still going
+        position = np.searchsorted(runs['start_time'][pair_runs],
+                                   onsets + tolerance, side='right') - 1
+        run = pair_runs[np.maximum(position, 0)]
+        found = (position >= 0) & (onsets < runs['stop_time'][run])
+        all_onsets.append(onsets[found])
+        all_runs.append(run[found])
+    return np.concatenate(all_onsets), np.concatenate(all_runs)
+
+
+def _clean_block_shape(data, block_rows, channel_block, n_workers):
+    """
+    The number of samples and of channels of the blocks that
+    *iter_clean_blocks* cleans at a time, filling in their defaults.
+    """
+    n_channels = data.shape[1] if data.ndim > 1 else 1
+    chunks = getattr(data, 'chunks', None)
+    if block_rows is None:
+        block_rows = max(1, _BLOCK_BYTES
+                         // max(1, n_channels * data.dtype.itemsize))
+        if chunks is not None:
+            block_rows = max(chunks[0], block_rows - block_rows % chunks[0])
+    if channel_block is None:
+        channel_block = chunks[-1] if chunks is not None and data.ndim > 1 \
+            else -(-n_channels // max(1, n_workers))
+    return block_rows, max(1, channel_block)
+
+
+def _clean_part(source, windows, templates, fill_value, first, last, rows,
+                windows_of_rows, columns):
+    """
+    Read the rows *first* to *last* and the *columns* slice of a recording
+    and clean the *rows* in windows, which are in *windows_of_rows*.
+    """
+    if source.ndim == 1:
+        block = np.array(source[first:last],
+                         copy=isinstance(source, np.ndarray))[:, None]
+    else:
+        block = np.array(source[first:last, columns],
+                         copy=isinstance(source, np.ndarray))
+    if templates is None:
+        block[rows - first] = fill_value
+        return block
+    positions = rows - windows.starts[windows_of_rows]
+    template = templates[windows.groups[windows_of_rows], positions,
+                         columns.start:columns.start + block.shape[1]]
+    values = block[rows - first] - template
+    if np.issubdtype(block.dtype, np.integer):
+        info = np.iinfo(block.dtype)
+        values = np.clip(np.rint(values), info.min, info.max)
+    block[rows - first] = values
+    return block
+
+
+def _window_rows(windows, first, last):
+    """
+    The rows from *first* to *last* that are in a window, and the window of
+    each of them.
+    """
+    # windows are sorted and disjoint, so their stops are sorted too
+    lo = np.searchsorted(windows.stops, first, side='right')
+    hi = np.searchsorted(windows.starts, last, side='left')
+    index = np.arange(lo, hi)
+    a = np.maximum(windows.starts[index], first)
+    b = np.minimum(windows.stops[index], last)
+    lengths = np.maximum(b - a, 0)
+    windows_of_rows = np.repeat(index, lengths)
+    rows = np.arange(lengths.sum()) \
+        - np.repeat(np.cumsum(lengths) - lengths, lengths) \
+        + np.repeat(a, lengths)
+    return rows, windows_of_rows
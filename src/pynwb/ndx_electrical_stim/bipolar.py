@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+Resolve rows of a BipolarSchemeTable to the electrodes they reference.
+"""
+from collections import namedtuple
+
+import numpy as np
+
+from .data_utils import get_readable_data
+from .instrumentation import instrumented
+
+
+class BipolarElectrodes(namedtuple('BipolarElectrodes', [
+        'anode_offsets', 'anode_indices',
+        'cathode_offsets', 'cathode_indices'])):
+    """
+    The anode and cathode electrodes of a sequence of bipolar pairs, stored
+    in CSR form: the anodes of pair *i* are
+    anode_indices[anode_offsets[i]:anode_offsets[i + 1]], and likewise for the
+    cathodes. The indices are rows of the electrodes table.
+    """
+
+    __slots__ = ()
+
+    def anodes(self, i):
+        """The electrode indices of the anodes of pair *i*"""
+        return self.anode_indices[self.anode_offsets[i]:self.anode_offsets[i + 1]]
+
+    def cathodes(self, i):
+        """The electrode indices of the cathodes of pair *i*"""
+        return self.cathode_indices[self.cathode_offsets[i]:self.cathode_offsets[i + 1]]
+
+
+@instrumented('bipolar.resolve_pairs')
+def resolve_bipolar_pairs(bipolar_table, pairs):
+    """
+    Resolve the rows *pairs* of *bipolar_table* to the electrodes of their
+    anodes and cathodes, all at once.
+
+    The ragged *anodes* and *cathodes* columns of the table are each read
+    once, so no DataFrames are built.
+
+    :param bipolar_table: the BipolarSchemeTable that *pairs* indexes
+    :param pairs: 1D array of row indices into *bipolar_table*
+    :return: BipolarElectrodes with one entry per element of *pairs*
+    """
+    pairs = np.asarray(pairs, dtype=np.int64)
+    if len(pairs) and (pairs.min() < 0 or pairs.max() >= len(bipolar_table)):
+        raise IndexError('bipolar pairs out of range for a BipolarSchemeTable '
+                         'with %d rows' % len(bipolar_table))
+    anode_offsets, anode_indices = _gather_ragged(bipolar_table['anodes'],
+                                                  pairs)
+    cathode_offsets, cathode_indices = _gather_ragged(bipolar_table['cathodes'],
+                                                      pairs)
+    return BipolarElectrodes(anode_offsets, anode_indices,
+                             cathode_offsets, cathode_indices)
+
+
+def _gather_ragged(vector_index, rows):
+    """
+    Gather the elements of the ragged column *vector_index* for *rows* and
+    return them as CSR offsets and values.
+    """
+    ends = np.asarray(get_readable_data(vector_index.data), dtype=np.int64)
+    values = np.asarray(get_readable_data(vector_index.target.data),
+                        dtype=np.int64)
+    starts = np.r_[0, ends[:-1]]
+    counts = ends[rows] - starts[rows]
+    offsets = np.r_[0, np.cumsum(counts)]
+    positions = (np.arange(offsets[-1])
+                 + np.repeat(starts[rows] - offsets[:-1], counts))
+    return offsets, values[positions]
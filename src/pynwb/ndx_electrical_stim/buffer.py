@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+"""
+Growable NumPy arrays for accumulating table columns in memory.
+"""
+import copy
+
+import numpy as np
+from hdmf.backends.hdf5 import H5DataIO
+from hdmf.data_utils import DataIO
+
+from .instrumentation import record
+
+# the capacity of a buffer when the first values are added to it
+_MIN_CAPACITY = 1024
+
+
+class GrowableArray(object):
+    """
+    A 1D NumPy array that values can be appended to in amortized constant
+    time.
+
+    Values are stored in a preallocated array whose capacity doubles
+    whenever it is full. *view* is the filled part of that array; it is
+    replaced by a new view after every append, and the table column, which
+    is bound to the buffer through a *BufferedData*, sees it as its data, a
+    plain, contiguous NumPy array with a compact dtype instead of a list of
+    Python objects.
+    """
+
+    def __init__(self, dtype, data=None):
+        """
+        :param dtype: the dtype of the values
+        :param data: the initial values, copied into the buffer
+        """
+        data = np.asarray(data if data is not None else [], dtype=dtype)
+        self.__buffer = np.empty(max(_MIN_CAPACITY, 2 * len(data)),
+                                 dtype=dtype)
+        self.__buffer[:len(data)] = data
+        self.__size = len(data)
+        self.__view = self.__buffer[:self.__size]
+
+    @property
+    def view(self):
+        """The values appended so far, as a view of the buffer"""
+        return self.__view
+
+    @property
+    def dtype(self):
+        return self.__buffer.dtype
+
+    def __len__(self):
+        return self.__size
+
+    def __reserve(self, size):
+        if size > len(self.__buffer):
+            buffer = np.empty(max(size, 2 * len(self.__buffer)),
+                              dtype=self.__buffer.dtype)
+            buffer[:self.__size] = self.__buffer[:self.__size]
+            self.__buffer = buffer
+            record('ColumnBuffers.grow', buffer_bytes=buffer.nbytes)
+
+    def append(self, value):
+        """Append a single value."""
+        self.__reserve(self.__size + 1)
+        self.__buffer[self.__size] = value
+        self.__size += 1
+        self.__view = self.__buffer[:self.__size]
+
+    def extend(self, values):
+        """Append all the values of a 1D array."""
+        values = np.asarray(values)
+        self.__reserve(self.__size + len(values))
+        self.__buffer[self.__size:self.__size + len(values)] = values
+        self.__size += len(values)
+        self.__view = self.__buffer[:self.__size]
+
+
+class _BufferedDataMixin(object):
+    """
+    The data of a DataIO bound to a GrowableArray: the current values of the
+    buffer, which values appended to the DataIO are added to.
+    """
+
+    @property
+    def buffer(self):
+        """The GrowableArray that holds the data"""
+        return self._buffer
+
+    @property
+    def data(self):
+        return self._buffer.view
+
+    def append(self, arg):
+        self._buffer.append(arg)
+
+    def extend(self, arg):
+        self._buffer.extend(arg)
+
+    def __copy__(self):
+        return DataIO(data=self.data)
+
+    def __deepcopy__(self, memo):
+        result = DataIO(data=copy.deepcopy(self.data, memo))
+        memo[id(self)] = result
+        return result
+
+
+class BufferedData(_BufferedDataMixin, DataIO):
+    """
+    A DataIO whose data is the values of a GrowableArray, so that a column
+    bound to it once sees every value appended to the buffer.
+    """
+
+    def __init__(self, buffer):
+        """
+        :param buffer: the GrowableArray that holds the data
+        """
+        self._buffer = buffer
+        super(BufferedData, self).__init__(data=buffer.view)
+
+
+class BufferedH5DataIO(_BufferedDataMixin, H5DataIO):
+    """
+    An H5DataIO whose data is the values of a GrowableArray, like
+    *BufferedData*, written with the I/O settings of the H5DataIO it replaces.
+    """
+
+    def __init__(self, buffer, old):
+        """
+        :param buffer: the GrowableArray that holds the data
+        :param old: the H5DataIO whose I/O settings are used
+        """
+        self._buffer = buffer
+        super(BufferedH5DataIO, self).__init__(
+            data=buffer.view, link_data=old.link_data,
+            allow_plugin_filters=True, **old.io_settings)
+
+
+class ColumnBuffers(object):
+    """
+    The growable buffers that hold the in-memory data of the columns of a
+    table, keyed by column name.
+
+    A column is bound to a buffer, seeded with its current data, the first
+    time values are added to it, and again whenever its data was replaced
+    outside of the buffer. Its data is then a *BufferedData* (or a
+    *BufferedH5DataIO* if it was an H5DataIO), so values appended to the
+    buffer do not have to be set on the column. Columns that are not in
+    *dtypes*, or whose data is not held in memory (e.g. a dataset read from
+    a file) or is wrapped in a DataIO other than DataIO and H5DataIO, have
+    no buffer.
+    """
+
+    def __init__(self, dtypes):
+        """
+        :param dtypes: the dtype of each buffered column, keyed by name
+        """
+        self.__dtypes = {name: np.dtype(dtype)
+                         for name, dtype in dtypes.items()}
+        self.__buffers = dict()
+
+    def get(self, column):
+        """
+        The growable buffer that holds the data of *column*, or None if it
+        has none.
+        """
+        dtype = self.__dtypes.get(column.name)
+        if dtype is None:
+            return None
+        data = column.data
+        buffer = self.__buffers.get(column.name)
+        if buffer is not None and isinstance(data, _BufferedDataMixin) \
+                and data.buffer is buffer:
+            return buffer
+        if isinstance(data, DataIO):
+            if type(data) not in (DataIO, H5DataIO):
+                # other DataIO types cannot be rebuilt around a new buffer
+                return None
+            data = data.data
+        if not isinstance(data, (list, np.ndarray)):
+            return None
+        # the column was created or changed outside of the buffer
+        buffer = GrowableArray(dtype, data)
+        self.__buffers[column.name] = buffer
+        column.transform(lambda old: _bind(old, buffer))
+        return buffer
+
+    def append(self, column, value):
+        """
+        Append a single value to *column* through its buffer. Returns False,
+        without changing the column, if it has no buffer.
+        """
+        buffer = self.get(column)
+        if buffer is None:
+            return False
+        buffer.append(value)
+        return True
+
+    def extend(self, column, values):
+        """
+        Append a 1D array of values to *column* through its buffer. Returns
+        False, without changing the column, if it has no buffer.
+        """
+        buffer = self.get(column)
+        if buffer is None:
+            return False
+        buffer.extend(values)
+        return True
+
+
+def _bind(data, buffer):
+    """
+    Data that replaces *data* as the data of a column bound to *buffer*.
+    Data wrapped in an H5DataIO keeps its I/O settings.
+    """
+    if isinstance(data, H5DataIO):
+        return BufferedH5DataIO(buffer, data)
+    return BufferedData(buffer)
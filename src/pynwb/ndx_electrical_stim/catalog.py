@@ -0,0 +1,382 @@
+# -*- coding: utf-8 -*-
+"""
+A SQLite catalog of the stimulation runs of a whole archive of NWB files.
+
+The catalog stores, for every StimTable in every file, the parameters of its
+runs and the electrodes of the bipolar pairs they reference, so that questions
+like "all runs on electrode 12 above 2 mA at 50 Hz" can be answered without
+opening any NWB file. Files are read directly with h5py, and only the
+StimTable columns and the BipolarSchemeTable they reference are read.
+
+Updating the catalog is incremental: a file is read again only if its
+modification time or size changed (and, with *verify_hash*, only if its
+content hash changed too), and files that no longer exist are removed.
+"""
+import fnmatch
+import hashlib
+import os
+import sqlite3
+import time
+from collections import namedtuple
+
+import h5py
+import numpy as np
+from hdmf.utils import docval, getargs
+
+from .data_utils import find_groups
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    file_id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    mtime REAL NOT NULL,
+    size INTEGER NOT NULL,
+    sha256 TEXT,
+    indexed_at REAL NOT NULL,
+    error TEXT
+);
+CREATE TABLE IF NOT EXISTS runs (
+    file_id INTEGER NOT NULL,
+    stim_table TEXT NOT NULL,
+    row INTEGER NOT NULL,
+    id INTEGER,
+    start_time REAL,
+    stop_time REAL,
+    frequency REAL,
+    amplitude REAL,
+    pulse_width REAL,
+    bipolar_pair INTEGER,
+    PRIMARY KEY (file_id, stim_table, row)
+);
+CREATE TABLE IF NOT EXISTS pair_electrodes (
+    file_id INTEGER NOT NULL,
+    bipolar_table TEXT NOT NULL,
+    pair INTEGER NOT NULL,
+    electrode INTEGER NOT NULL,
+    role TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS stim_tables (
+    file_id INTEGER NOT NULL,
+    stim_table TEXT NOT NULL,
+    bipolar_table TEXT,
+    PRIMARY KEY (file_id, stim_table)
+);
+CREATE INDEX IF NOT EXISTS runs_frequency ON runs (frequency);
+CREATE INDEX IF NOT EXISTS runs_amplitude ON runs (amplitude);
+CREATE INDEX IF NOT EXISTS runs_start_time ON runs (start_time);
+CREATE INDEX IF NOT EXISTS pair_electrodes_electrode
+    ON pair_electrodes (electrode, file_id, bipolar_table, pair);
+CREATE INDEX IF NOT EXISTS pair_electrodes_pair
+    ON pair_electrodes (file_id, bipolar_table, pair);
+"""
+
+_RUN_COLUMNS = ('start_time', 'stop_time', 'frequency', 'amplitude',
+                'pulse_width')
+
+RunReference = namedtuple('RunReference', [
+    'path', 'stim_table', 'row', 'id', 'start_time', 'stop_time',
+    'frequency', 'amplitude', 'pulse_width', 'bipolar_pair'])
+RunReference.__doc__ = """
+A run found in the catalog: the NWB file, the HDF5 path of its StimTable,
+its row in the table, and its parameters.
+"""
+
+CatalogUpdate = namedtuple('CatalogUpdate', [
+    'added', 'updated', 'unchanged', 'removed', 'failed'])
+CatalogUpdate.__doc__ = """
+The number of files added, re-indexed, left unchanged, removed and failed by
+an update of the catalog.
+"""
+
+
+class StimCatalog(object):
+    """
+    An incremental SQLite index of the StimTable runs of many NWB files.
+    """
+
+    @docval(
+        {
+            'name': 'path',
+            'type': str,
+            'doc': "the SQLite database file, created if it does not exist. "
+                   "Use ':memory:' for a temporary catalog"
+        }
+    )
+    def __init__(self, **kwargs):
+        path = getargs('path', kwargs)
+        self.__connection = sqlite3.connect(path)
+        self.__connection.executescript(_SCHEMA)
+
+    def close(self):
+        """Close the database."""
+        self.__connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @docval(
+        {
+            'name': 'directory',
+            'type': str,
+            'doc': 'the directory to index the NWB files of, recursively'
+        },
+        {
+            'name': 'pattern',
+            'type': str,
+            'doc': 'the file name pattern of NWB files',
+            'default': '*.nwb'
+        },
+        {
+            'name': 'verify_hash',
+            'type': bool,
+            'doc': 'when the modification time or size of a file changed, '
+                   'compare the SHA-256 of its content before reading it '
+                   'again, e.g. after files are copied',
+            'default': False
+        },
+        returns='the numbers of files added, updated, unchanged, removed and '
+                'failed', rtype=CatalogUpdate
+    )
+    def update(self, **kwargs):
+        """
+        Bring the catalog up to date with the NWB files under *directory*.
+
+        Files that cannot be read are recorded with their error, so they are
+        retried only once they change, and their runs are not cataloged.
+        """
+        directory, pattern, verify_hash = getargs('directory', 'pattern',
+                                                  'verify_hash', kwargs)
+        directory = os.path.abspath(directory)
+        paths = set()
+        for root, _, names in os.walk(directory):
+            for name in fnmatch.filter(names, pattern):
+                paths.add(os.path.join(root, name))
+
+        known = dict()
+        prefix = os.path.join(directory, '')
+        for file_id, path, mtime, size, sha256 in self.__connection.execute(
+                'SELECT file_id, path, mtime, size, sha256 FROM files '
+                'WHERE substr(path, 1, ?) = ?', (len(prefix), prefix)):
+            known[path] = (file_id, mtime, size, sha256)
+
+        counts = dict(added=0, updated=0, unchanged=0, removed=0, failed=0)
+        with self.__connection:
+            for path in sorted(set(known) - paths):
+                self.__delete_file(known[path][0])
+                counts['removed'] += 1
+            for path in sorted(paths):
+                stat = os.stat(path)
+                entry = known.get(path)
+                sha256 = None
+                if entry is not None:
+                    file_id, mtime, size, old_sha256 = entry
+                    if mtime == stat.st_mtime and size == stat.st_size:
+                        counts['unchanged'] += 1
+                        continue
+                    if verify_hash:
+                        sha256 = _sha256(path)
+                        if sha256 == old_sha256:
+                            self.__connection.execute(
+                                'UPDATE files SET mtime = ?, size = ? '
+                                'WHERE file_id = ?',
+                                (stat.st_mtime, stat.st_size, file_id))
+                            counts['unchanged'] += 1
+                            continue
+                    self.__delete_file(file_id)
+                    counts['updated'] += 1
+                else:
+                    counts['added'] += 1
+                if verify_hash and sha256 is None:
+                    sha256 = _sha256(path)
+                if not self.__index_file(path, stat, sha256):
+                    counts['failed'] += 1
+        return CatalogUpdate(**counts)
+
+    def __delete_file(self, file_id):
+        for table in ('runs', 'pair_electrodes', 'stim_tables', 'files'):
+            self.__connection.execute('DELETE FROM %s WHERE file_id = ?'
+                                      % table, (file_id,))
+
+    def __index_file(self, path, stat, sha256):
+        try:
+            tables = _read_stim_tables(path)
+            error = None
+        except Exception as e:
+            tables = list()
+            error = '%s: %s' % (type(e).__name__, e)
+        cursor = self.__connection.execute(
+            'INSERT INTO files (path, mtime, size, sha256, indexed_at, error) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            (path, stat.st_mtime, stat.st_size, sha256, time.time(), error))
+        file_id = cursor.lastrowid
+        bipolar_tables = dict()
+        for table in tables:
+            self.__connection.execute(
+                'INSERT INTO stim_tables VALUES (?, ?, ?)',
+                (file_id, table['name'], table['bipolar_table']))
+            columns = [table[name].tolist() for name in
+                       ('id',) + _RUN_COLUMNS + ('bipolar_pair',)]
+            self.__connection.executemany(
+                'INSERT INTO runs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                ((file_id, table['name'], row) + values
+                 for row, values in enumerate(zip(*columns))))
+            if table['bipolar_table'] is not None:
+                bipolar_tables[table['bipolar_table']] = table['electrodes']
+        for name, electrodes in bipolar_tables.items():
+            self.__connection.executemany(
+                'INSERT INTO pair_electrodes VALUES (?, ?, ?, ?, ?)',
+                ((file_id, name, pair, electrode, role)
+                 for role, pairs, values in electrodes
+                 for pair, electrode in zip(pairs.tolist(), values.tolist())))
+        return error is None
+
+    @docval(
+        {
+            'name': 'frequency',
+            'type': (tuple, list),
+            'doc': 'the (min, max) frequency, in Hz. Either bound may be None',
+            'default': None
+        },
+        {
+            'name': 'amplitude',
+            'type': (tuple, list),
+            'doc': 'the (min, max) amplitude',
+            'default': None
+        },
+        {
+            'name': 'pulse_width',
+            'type': (tuple, list),
+            'doc': 'the (min, max) pulse width',
+            'default': None
+        },
+        {
+            'name': 'time',
+            'type': (tuple, list),
+            'doc': 'the (t0, t1) window, in seconds, that runs must overlap',
+            'default': None
+        },
+        {
+            'name': 'electrodes',
+            'type': (tuple, list),
+            'doc': 'electrode indices. Only runs whose bipolar pair includes '
+                   'one of them are returned',
+            'default': None
+        },
+        {
+            'name': 'role',
+            'type': str,
+            'doc': "restrict *electrodes* to 'anode' or 'cathode'",
+            'default': None
+        },
+        returns='the matching runs, ordered by file and row', rtype=list
+    )
+    def query(self, **kwargs):
+        """
+        Find the runs, across all cataloged files, that match all of the
+        given conditions.
+        """
+        time_window, electrodes, role = getargs('time', 'electrodes', 'role',
+                                                kwargs)
+        conditions = list()
+        params = list()
+        for name in ('frequency', 'amplitude', 'pulse_width'):
+            bounds = kwargs[name]
+            if bounds is None:
+                continue
+            low, high = bounds
+            if low is not None:
+                conditions.append('runs.%s >= ?' % name)
+                params.append(low)
+            if high is not None:
+                conditions.append('runs.%s <= ?' % name)
+                params.append(high)
+        if time_window is not None:
+            t0, t1 = time_window
+            conditions.append('runs.start_time <= ? AND runs.stop_time >= ?')
+            params.extend([t1, t0])
+        if electrodes is not None:
+            if role not in (None, 'anode', 'cathode'):
+                raise ValueError("role must be 'anode' or 'cathode', got '%s'"
+                                 % role)
+            electrodes = [int(e) for e in electrodes]
+            condition = (
+                'EXISTS (SELECT 1 FROM pair_electrodes AS pe '
+                'WHERE pe.file_id = runs.file_id '
+                'AND pe.bipolar_table = stim_tables.bipolar_table '
+                'AND pe.pair = runs.bipolar_pair '
+                'AND pe.electrode IN (%s)' % ', '.join('?' * len(electrodes)))
+            params.extend(electrodes)
+            if role is not None:
+                condition += ' AND pe.role = ?'
+                params.append(role)
+            conditions.append(condition + ')')
+        sql = ('SELECT files.path, runs.stim_table, runs.row, runs.id, '
+               'runs.start_time, runs.stop_time, runs.frequency, '
+               'runs.amplitude, runs.pulse_width, runs.bipolar_pair '
+               'FROM runs JOIN files USING (file_id) '
+               'JOIN stim_tables USING (file_id, stim_table)')
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' ORDER BY files.path, runs.stim_table, runs.row'
+        return [RunReference(*row)
+                for row in self.__connection.execute(sql, params)]
+
+    @docval(returns='the files that could not be read, with their errors',
+            rtype=list)
+    def failed_files(self):
+        """The (path, error) of every cataloged file that could not be read"""
+        return self.__connection.execute(
+            'SELECT path, error FROM files WHERE error IS NOT NULL '
+            'ORDER BY path').fetchall()
+
+
+def _sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 ** 2), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _read_stim_tables(path):
+    """
+    Read the StimTable columns of an NWB file, and the electrodes of the
+    bipolar pairs they reference.
+    """
+    tables = list()
+    with h5py.File(path, 'r') as f:
+        for group in find_groups(f, ('StimTable',))['StimTable']:
+            table = dict(name=group.name)
+            n_rows = len(group['id'])
+            table['id'] = group['id'][:].astype(np.int64)
+            for name in _RUN_COLUMNS:
+                if name in group:
+                    table[name] = group[name][:].astype(float)
+                else:
+                    table[name] = np.full(n_rows, np.nan)
+            bipolar_pair = group['bipolar_pair']
+            table['bipolar_pair'] = bipolar_pair[:].astype(np.int64)
+            table['bipolar_table'] = None
+            reference = bipolar_pair.attrs.get('table')
+            if reference:
+                bipolar_table = f[reference]
+                table['bipolar_table'] = bipolar_table.name
+                table['electrodes'] = [
+                    (role,) + _read_ragged(bipolar_table, column)
+                    for role, column in (('anode', 'anodes'),
+                                         ('cathode', 'cathodes'))]
+            tables.append(table)
+    return tables
+
+
+def _read_ragged(group, column):
+    """
+    The row of each element of a ragged column, and the elements.
+    """
+    values = group[column][:].astype(np.int64)
+    ends = group[column + '_index'][:].astype(np.int64)
+    rows = np.repeat(np.arange(len(ends)), np.diff(np.r_[0, ends]))
+    return rows, values
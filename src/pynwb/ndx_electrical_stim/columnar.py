@@ -0,0 +1,361 @@
+# -*- coding: utf-8 -*-
+"""
+Export StimTable runs and decimated StimSeries summaries to Apache Arrow and
+Parquet, and read them back with filters pushed down to the Parquet reader.
+
+Runs are exported one typed record batch at a time, straight from the
+column arrays of the StimTable, with the anode and cathode electrodes of each
+run resolved into list columns, so no pandas DataFrame is ever built. Written
+as one Parquet file per session (e.g. ``runs/<session_id>.parquet``), the
+runs of a whole cohort can then be scanned as a single dataset with
+*read_stim_runs*, which skips every file and row group whose statistics rule
+out the requested frequency, amplitude and time ranges.
+
+Requires the optional dependency pyarrow (``pip install pyarrow``).
+"""
+import numpy as np
+from hdmf.common import VectorIndex
+from hdmf.utils import docval, getargs, popargs, get_docval
+
+from .bipolar import resolve_bipolar_pairs
+from .data_utils import get_readable_data
+from .ndx_electrical_stim import StimSeries, StimTable
+
+# the StimTable columns that are exported with a fixed type
+_RUN_COLUMNS = ('start_time', 'stop_time', 'frequency', 'amplitude',
+                'pulse_width')
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.dataset  # noqa: F401
+        import pyarrow.parquet  # noqa: F401
+    except ImportError:
+        raise ImportError('pyarrow is required to export to Arrow and '
+                          'Parquet: pip install pyarrow')
+    return pyarrow
+
+
+def stim_runs_schema():
+    """
+    The Arrow schema of exported StimTable runs, without the extra columns
+    of a particular StimTable.
+    """
+    pa = _import_pyarrow()
+    return pa.schema(
+        [('session_id', pa.string()), ('id', pa.int64())]
+        + [(name, pa.float64()) for name in _RUN_COLUMNS]
+        + [('bipolar_pair', pa.int64()),
+           ('anodes', pa.list_(pa.int64())),
+           ('cathodes', pa.list_(pa.int64()))])
+
+
+@docval(
+    {
+        'name': 'stim_table',
+        'type': StimTable,
+        'doc': 'the StimTable to export'
+    },
+    {
+        'name': 'session_id',
+        'type': str,
+        'doc': 'the session identifier to store with every run, so that '
+               'the runs of many sessions can be queried together',
+        'default': None
+    },
+    {
+        'name': 'batch_size',
+        'type': int,
+        'doc': 'the number of runs per record batch',
+        'default': 65536
+    },
+    is_method=False
+)
+def iter_stim_table_batches(**kwargs):
+    """
+    Yield the runs of a StimTable as Arrow record batches.
+
+    Every batch reads only its own rows from each column, and the
+    *bipolar_pair* of its runs is resolved to *anodes* and *cathodes* list
+    columns of electrode indices. Extra, non-ragged columns of the table are
+    exported after the standard ones, with the Arrow type inferred from
+    their data. Ragged columns (e.g. *tags*) are not exported.
+    """
+    stim_table, session_id, batch_size = getargs('stim_table', 'session_id',
+                                                 'batch_size', kwargs)
+    pa = _import_pyarrow()
+    if batch_size <= 0:
+        raise ValueError('batch_size must be positive, got %d' % batch_size)
+    bipolar_col = stim_table['bipolar_pair']
+    if bipolar_col.table is None:
+        raise ValueError("the 'bipolar_pair' column of StimTable %s does not "
+                         "reference a BipolarSchemeTable" % stim_table.name)
+    schema = stim_runs_schema()
+    extra = [name for name in stim_table.colnames
+             if name not in _RUN_COLUMNS and name != 'bipolar_pair'
+             and not _is_ragged(stim_table, name)]
+    ids = get_readable_data(stim_table.id.data)
+    columns = {name: get_readable_data(stim_table[name].data)
+               for name in _RUN_COLUMNS + ('bipolar_pair',) + tuple(extra)}
+    for start in range(0, len(stim_table), batch_size):
+        stop = min(start + batch_size, len(stim_table))
+        pairs = np.asarray(columns['bipolar_pair'][start:stop], dtype=np.int64)
+        electrodes = resolve_bipolar_pairs(bipolar_col.table, pairs)
+        arrays = [
+            pa.array(np.full(stop - start, session_id, dtype=object),
+                     type=pa.string()),
+            pa.array(np.asarray(ids[start:stop], dtype=np.int64))]
+        arrays += [pa.array(np.asarray(columns[name][start:stop], dtype=float))
+                   for name in _RUN_COLUMNS]
+        arrays += [
+            pa.array(pairs),
+            pa.ListArray.from_arrays(
+                pa.array(electrodes.anode_offsets.astype(np.int32)),
+                pa.array(electrodes.anode_indices)),
+            pa.ListArray.from_arrays(
+                pa.array(electrodes.cathode_offsets.astype(np.int32)),
+                pa.array(electrodes.cathode_indices))]
+        arrays += [pa.array(np.asarray(columns[name][start:stop]))
+                   for name in extra]
+        names = schema.names + extra
+        yield pa.RecordBatch.from_arrays(arrays, names=names)
+
+
+@docval(
+    {
+        'name': 'stim_series',
+        'type': StimSeries,
+        'doc': 'the StimSeries to summarize'
+    },
+    {
+        'name': 'session_id',
+        'type': str,
+        'doc': 'the session identifier to store with every row',
+        'default': None
+    },
+    {
+        'name': 'decimation',
+        'type': int,
+        'doc': 'the number of samples summarized by each row',
+        'default': 1000
+    },
+    {
+        'name': 'block_rows',
+        'type': int,
+        'doc': 'the number of samples to read at a time, rounded down to a '
+               'multiple of *decimation*',
+        'default': 1000000
+    },
+    is_method=False
+)
+def iter_stim_series_summary_batches(**kwargs):
+    """
+    Yield Arrow record batches summarizing the waveform of a StimSeries: for
+    every *decimation* samples of every bipolar pair, the time of the first
+    sample and the minimum, maximum, mean and root mean square of the
+    samples. One record batch is yielded per block of samples read, so the
+    waveform is never loaded whole.
+    """
+    stim_series, session_id, decimation, block_rows = getargs(
+        'stim_series', 'session_id', 'decimation', 'block_rows', kwargs)
+    pa = _import_pyarrow()
+    if decimation <= 0:
+        raise ValueError('decimation must be positive, got %d' % decimation)
+    data = stim_series.get_lazy_data()
+    if data.ndim != 2:
+        raise ValueError('the waveform of StimSeries %s must be 2D (time x '
+                         'pairs)' % stim_series.name)
+    pairs = np.asarray(get_readable_data(stim_series.bipolar_electrodes.data)[:],
+                       dtype=np.int64)
+    timestamps = None
+    if stim_series.rate is None:
+        timestamps = get_readable_data(stim_series.timestamps)
+    block_rows = max(decimation, block_rows - block_rows % decimation)
+    n_pairs = data.shape[1]
+    for start, block in data.iter_blocks(block_rows):
+        n_bins = -(-len(block) // decimation)
+        if timestamps is None:
+            bin_starts = np.arange(start, start + len(block), decimation)
+            times = stim_series.starting_time + bin_starts / stim_series.rate
+        else:
+            times = np.asarray(
+                timestamps[start:start + len(block):decimation], dtype=float)
+        block = block.astype(float, copy=False)
+        # bin boundaries within the block, the last bin may be partial
+        edges = np.arange(0, len(block), decimation)
+        counts = np.diff(np.r_[edges, len(block)])[:, np.newaxis]
+        minimum = np.minimum.reduceat(block, edges, axis=0)
+        maximum = np.maximum.reduceat(block, edges, axis=0)
+        mean = np.add.reduceat(block, edges, axis=0) / counts
+        rms = np.sqrt(np.add.reduceat(np.square(block), edges, axis=0) / counts)
+        yield pa.RecordBatch.from_arrays([
+            pa.array(np.full(n_bins * n_pairs, session_id, dtype=object),
+                     type=pa.string()),
+            pa.array(np.repeat(times, n_pairs)),
+            pa.array(np.tile(pairs, n_bins)),
+            pa.array(minimum.ravel()),
+            pa.array(maximum.ravel()),
+            pa.array(mean.ravel()),
+            pa.array(rms.ravel())],
+            names=['session_id', 'time', 'bipolar_pair', 'min', 'max', 'mean',
+                   'rms'])
+
+
+@docval(
+    *get_docval(iter_stim_table_batches, 'stim_table'),
+    {
+        'name': 'path',
+        'type': str,
+        'doc': 'the Parquet file to write'
+    },
+    *get_docval(iter_stim_table_batches, 'session_id', 'batch_size'),
+    {
+        'name': 'compression',
+        'type': str,
+        'doc': 'the Parquet compression codec',
+        'default': 'zstd'
+    },
+    is_method=False
+)
+def write_stim_table_parquet(**kwargs):
+    """
+    Write the runs of a StimTable to a Parquet file, one row group per
+    record batch of *iter_stim_table_batches*.
+    """
+    path, compression = popargs('path', 'compression', kwargs)
+    _write_parquet(path, iter_stim_table_batches(**kwargs),
+                   stim_runs_schema(), compression)
+
+
+@docval(
+    *get_docval(iter_stim_series_summary_batches, 'stim_series'),
+    *get_docval(write_stim_table_parquet, 'path'),
+    *get_docval(iter_stim_series_summary_batches, 'session_id', 'decimation',
+                'block_rows'),
+    *get_docval(write_stim_table_parquet, 'compression'),
+    is_method=False
+)
+def write_stim_series_summary_parquet(**kwargs):
+    """
+    Write the decimated summary of a StimSeries waveform to a Parquet file,
+    one row group per block of samples.
+    """
+    path, compression = popargs('path', 'compression', kwargs)
+    pa = _import_pyarrow()
+    schema = pa.schema([('session_id', pa.string()), ('time', pa.float64()),
+                        ('bipolar_pair', pa.int64())]
+                       + [(name, pa.float64())
+                          for name in ('min', 'max', 'mean', 'rms')])
+    _write_parquet(path, iter_stim_series_summary_batches(**kwargs), schema,
+                   compression)
+
+
+def _write_parquet(path, batches, schema, compression):
+    """
+    Write record *batches* to a Parquet file as they are produced. *schema*
+    is used only if there are no batches.
+    """
+    pa = _import_pyarrow()
+    writer = None
+    try:
+        for batch in batches:
+            if writer is None:
+                writer = pa.parquet.ParquetWriter(path, batch.schema,
+                                                  compression=compression)
+            writer.write_batch(batch)
+        if writer is None:
+            pa.parquet.write_table(schema.empty_table(), path,
+                                   compression=compression)
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+@docval(
+    {
+        'name': 'source',
+        'type': (str, list),
+        'doc': 'a Parquet file of exported runs, a directory of them, or a '
+               'list of files'
+    },
+    {
+        'name': 'frequency',
+        'type': (tuple, list),
+        'doc': 'the (min, max) frequency, in Hz, of the runs to read. Either '
+               'bound may be None',
+        'default': None
+    },
+    {
+        'name': 'amplitude',
+        'type': (tuple, list),
+        'doc': 'the (min, max) amplitude of the runs to read',
+        'default': None
+    },
+    {
+        'name': 'pulse_width',
+        'type': (tuple, list),
+        'doc': 'the (min, max) pulse width of the runs to read',
+        'default': None
+    },
+    {
+        'name': 'time',
+        'type': (tuple, list),
+        'doc': 'the (t0, t1) window, in seconds, that the runs to read must '
+               'overlap',
+        'default': None
+    },
+    {
+        'name': 'session_ids',
+        'type': (tuple, list),
+        'doc': 'the sessions to read the runs of',
+        'default': None
+    },
+    {
+        'name': 'columns',
+        'type': (tuple, list),
+        'doc': 'the columns to read. Defaults to all of them',
+        'default': None
+    },
+    returns='the matching runs, as a pyarrow.Table',
+    is_method=False
+)
+def read_stim_runs(**kwargs):
+    """
+    Read exported StimTable runs, keeping only those that match all of the
+    given ranges. The filters are pushed down to the Parquet reader, which
+    skips row groups and files whose column statistics cannot match.
+    """
+    source, time, session_ids, columns = getargs('source', 'time',
+                                                 'session_ids', 'columns',
+                                                 kwargs)
+    pa = _import_pyarrow()
+    field = pa.dataset.field
+    conditions = list()
+    for name in ('frequency', 'amplitude', 'pulse_width'):
+        bounds = kwargs[name]
+        if bounds is None:
+            continue
+        low, high = bounds
+        if low is not None:
+            conditions.append(field(name) >= low)
+        if high is not None:
+            conditions.append(field(name) <= high)
+    if time is not None:
+        t0, t1 = time
+        conditions.append(field('start_time') <= t1)
+        conditions.append(field('stop_time') >= t0)
+    if session_ids is not None:
+        conditions.append(field('session_id').isin(list(session_ids)))
+    condition = None
+    for c in conditions:
+        condition = c if condition is None else condition & c
+    dataset = pa.dataset.dataset(source, format='parquet')
+    return dataset.to_table(
+        columns=list(columns) if columns is not None else None,
+        filter=condition)
+
+
+def _is_ragged(table, name):
+    return any(isinstance(col, VectorIndex) and col.target.name == name
+               for col in table.columns)
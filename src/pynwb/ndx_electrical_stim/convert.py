@@ -0,0 +1,329 @@
+# -*- coding: utf-8 -*-
+"""
+Convert many stimulation sessions to NWB files across a pool of processes.
+
+A manifest lists the sessions to convert, one JSON object per line, each with
+at least a unique *session_id*. A user-supplied *build* function turns one
+session into an NWBFile (with its StimTable, StimSeries, ...), which is then
+written to ``<output_dir>/<session_id>.nwb``, or to the session's *output*
+path if it has one.
+
+Conversion is resumable: every file is first written to a ``.partial`` file
+that is renamed into place only once it is complete, so sessions whose output
+already exists are skipped when the conversion is run again, and a failed
+session never leaves a truncated file behind.
+
+From the command line::
+
+    python -m ndx_electrical_stim.convert sessions.jsonl \\
+        --build my_lab.conversion:build_session --output-dir nwb/ --workers 8
+"""
+import argparse
+import importlib
+import json
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+from collections import namedtuple
+from collections.abc import Callable
+
+from hdmf.utils import docval, getargs
+from pynwb import NWBHDF5IO
+
+from . import instrumentation
+from .namespace import load_namespace
+
+ConversionResult = namedtuple('ConversionResult', [
+    'session_id', 'path', 'status', 'seconds', 'nbytes', 'error'])
+ConversionResult.__doc__ = """
+The outcome of converting one session. *status* is 'converted', 'skipped'
+(the output already existed) or 'failed', in which case *error* holds the
+traceback.
+"""
+
+ConversionProgress = namedtuple('ConversionProgress', [
+    'done', 'total', 'failed', 'elapsed', 'nbytes', 'result'])
+ConversionProgress.__doc__ = """
+The progress of a conversion after a session finished: the number of
+sessions done (including skipped and failed ones) out of *total*, the number
+that failed, the seconds elapsed, the number of bytes written so far, and
+the ConversionResult of the session that just finished.
+"""
+
+# the build function of this worker process, resolved once by _init_worker
+_worker_build = None
+
+
+@docval(
+    {
+        'name': 'path',
+        'type': str,
+        'doc': 'path to a manifest with one JSON object per line'
+    },
+    returns='the sessions of the manifest', rtype=list,
+    is_method=False
+)
+def read_manifest(**kwargs):
+    """
+    Read a manifest of sessions, one JSON object per line. Blank lines are
+    ignored.
+    """
+    path = getargs('path', kwargs)
+    sessions = list()
+    with open(path) as f:
+        for lineno, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                sessions.append(json.loads(line))
+            except ValueError as e:
+                raise ValueError('%s, line %d: %s' % (path, lineno, e))
+    return sessions
+
+
+@docval(
+    {
+        'name': 'sessions',
+        'type': (list, tuple, str),
+        'doc': 'the sessions to convert, as dicts with a unique '
+               "'session_id' and optionally an 'output' path, or the path "
+               'of a manifest of them'
+    },
+    {
+        'name': 'build',
+        'type': (Callable, str),
+        'doc': "function that builds the NWBFile of a session, or its "
+               "import path as 'module:function'. It must be importable by "
+               'the worker processes'
+    },
+    {
+        'name': 'output_dir',
+        'type': str,
+        'doc': 'directory to write <session_id>.nwb files to',
+        'default': '.'
+    },
+    {
+        'name': 'n_workers',
+        'type': int,
+        'doc': 'number of worker processes. Defaults to the number of CPUs. '
+               'With 0, sessions are converted in this process',
+        'default': None
+    },
+    {
+        'name': 'max_sessions_per_worker',
+        'type': int,
+        'doc': 'number of sessions a worker process converts before it is '
+               'replaced by a fresh one, which bounds the memory a worker '
+               'can accumulate',
+        'default': 16
+    },
+    {
+        'name': 'overwrite',
+        'type': bool,
+        'doc': 'convert sessions again even if their output already exists',
+        'default': False
+    },
+    {
+        'name': 'progress',
+        'type': Callable,
+        'doc': 'function called with a ConversionProgress after each session',
+        'default': None
+    },
+    returns='the ConversionResult of every session, in manifest order',
+    rtype=list,
+    is_method=False
+)
+def convert_sessions(**kwargs):
+    """
+    Build and write the NWB file of every session of a manifest, in parallel.
+
+    Each worker process imports ndx_electrical_stim, which loads the
+    extension namespaces, and resolves the *build* function once when it
+    starts, not once per session. Sessions are handed out one at a time, so
+    at most *n_workers* sessions are in memory at once.
+    """
+    sessions, build, output_dir, n_workers, max_sessions_per_worker, \
+        overwrite, progress = getargs(
+            'sessions', 'build', 'output_dir', 'n_workers',
+            'max_sessions_per_worker', 'overwrite', 'progress', kwargs)
+    if isinstance(sessions, str):
+        sessions = read_manifest(sessions)
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    if n_workers < 0:
+        raise ValueError('n_workers must be non-negative, got %d' % n_workers)
+    paths = _output_paths(sessions, output_dir)
+    os.makedirs(output_dir, exist_ok=True)
+
+    results = [None] * len(sessions)
+    tracker = _ProgressTracker(len(sessions), progress)
+    todo = list()
+    for i, (session, path) in enumerate(zip(sessions, paths)):
+        if not overwrite and os.path.exists(path):
+            results[i] = ConversionResult(session['session_id'], path,
+                                          'skipped', 0., 0, None)
+            tracker.update(results[i])
+        else:
+            todo.append((i, session, path))
+
+    if not todo:
+        return results
+    if n_workers == 0:
+        _init_worker(build)
+        for task in todo:
+            i, result = _convert_task(task)
+            results[i] = result
+            tracker.update(result)
+        return results
+    with multiprocessing.Pool(min(n_workers, len(todo)),
+                              initializer=_init_worker, initargs=(build,),
+                              maxtasksperchild=max_sessions_per_worker) as pool:
+        for i, result in pool.imap_unordered(_convert_task, todo, chunksize=1):
+            results[i] = result
+            tracker.update(result)
+    return results
+
+
+def _output_paths(sessions, output_dir):
+    """
+    The output path of every session, checking that session ids are unique.
+    """
+    paths = list()
+    seen = set()
+    for session in sessions:
+        if 'session_id' not in session:
+            raise ValueError("session %r has no 'session_id'" % (session,))
+        session_id = str(session['session_id'])
+        if session_id in seen:
+            raise ValueError("duplicate session_id '%s'" % session_id)
+        seen.add(session_id)
+        paths.append(session.get('output')
+                     or os.path.join(output_dir, session_id + '.nwb'))
+    return paths
+
+
+def _resolve_build(build):
+    """
+    Import the build function named 'module:function', if given by name.
+    """
+    if not isinstance(build, str):
+        return build
+    module, sep, name = build.partition(':')
+    if not sep or not module or not name:
+        raise ValueError("build must be given as 'module:function', got '%s'"
+                         % build)
+    return getattr(importlib.import_module(module), name)
+
+
+def _init_worker(build):
+    """
+    Load the extension and resolve the build function, once per worker.
+    """
+    global _worker_build
+    load_namespace()
+    _worker_build = _resolve_build(build)
+
+
+def _convert_task(task):
+    """
+    Build and write one session, catching its errors so that one failed
+    session does not stop the others.
+    """
+    i, session, path = task
+    session_id = str(session['session_id'])
+    partial = path + '.partial'
+    start = time.perf_counter()
+    try:
+        nwbfile = _worker_build(session)
+        # the output of a session may be in a directory of its own
+        os.makedirs(os.path.dirname(path) or os.curdir, exist_ok=True)
+        with NWBHDF5IO(partial, 'w') as io:
+            io.write(nwbfile)
+        os.replace(partial, path)
+    except Exception:
+        if os.path.exists(partial):
+            os.remove(partial)
+        return i, ConversionResult(session_id, path, 'failed',
+                                   time.perf_counter() - start, 0,
+                                   traceback.format_exc())
+    finally:
+        # pool workers are terminated without running atexit handlers, so
+        # write their instrumentation report after every session
+        instrumentation.flush()
+    return i, ConversionResult(session_id, path, 'converted',
+                               time.perf_counter() - start,
+                               os.path.getsize(path), None)
+
+
+class _ProgressTracker(object):
+    """
+    Count finished sessions and report them to the *progress* callback.
+    """
+
+    def __init__(self, total, callback):
+        self.__total = total
+        self.__callback = callback
+        self.__start = time.perf_counter()
+        self.__done = 0
+        self.__failed = 0
+        self.__nbytes = 0
+
+    def update(self, result):
+        self.__done += 1
+        self.__failed += result.status == 'failed'
+        self.__nbytes += result.nbytes
+        if self.__callback is not None:
+            self.__callback(ConversionProgress(
+                self.__done, self.__total, self.__failed,
+                time.perf_counter() - self.__start, self.__nbytes, result))
+
+
+def _print_progress(progress):
+    result = progress.result
+    rate = progress.done / progress.elapsed if progress.elapsed else 0.
+    throughput = progress.nbytes / progress.elapsed / 1e6 if progress.elapsed else 0.
+    print('[%d/%d] %s %s in %.1fs (%.2f sessions/s, %.1f MB/s, %d failed)'
+          % (progress.done, progress.total, result.session_id, result.status,
+             result.seconds, rate, throughput, progress.failed),
+          file=sys.stderr)
+    if result.error is not None:
+        print(result.error, file=sys.stderr)
+
+
+def main(argv=None):
+    """
+    Convert the sessions of a manifest from the command line. Returns 1 if
+    any session failed, 0 otherwise.
+    """
+    parser = argparse.ArgumentParser(
+        description='Convert the stimulation sessions of a manifest to NWB '
+                    'files in parallel.')
+    parser.add_argument('manifest',
+                        help='file with one JSON session per line')
+    parser.add_argument('--build', required=True,
+                        help="function that builds the NWBFile of a session, "
+                             "as 'module:function'")
+    parser.add_argument('--output-dir', default='.',
+                        help='directory to write the NWB files to')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of worker processes (default: one per '
+                             'CPU, 0 to convert in this process)')
+    parser.add_argument('--max-sessions-per-worker', type=int, default=16,
+                        help='sessions a worker converts before it is '
+                             'replaced')
+    parser.add_argument('--overwrite', action='store_true',
+                        help='convert sessions whose output already exists')
+    args = parser.parse_args(argv)
+    results = convert_sessions(
+        sessions=args.manifest, build=args.build, output_dir=args.output_dir,
+        n_workers=args.workers,
+        max_sessions_per_worker=args.max_sessions_per_worker,
+        overwrite=args.overwrite, progress=_print_progress)
+    return int(any(result.status == 'failed' for result in results))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+"""
+Utilities for streaming StimSeries waveforms to and from HDF5.
+"""
+import time
+from collections.abc import Iterable
+
+import h5py
+import numpy as np
+
+from hdmf.backends.hdf5 import H5DataIO
+from hdmf.data_utils import AbstractDataChunkIterator, DataChunk, DataIO
+from hdmf.utils import docval, getargs
+
+from .instrumentation import instrumented, record
+
+
+class StimBlockIterator(AbstractDataChunkIterator):
+    """
+    Iterate over blocks of stimulation waveform samples, yielding each block
+    as a single DataChunk appended along the time axis.
+
+    Each block is an array of shape (n_samples,) or (n_samples, n_pairs) and
+    all blocks must share the same trailing shape. Only the current block is
+    held in memory, so a waveform of any length can be written with
+    memory bounded by the block size.
+    """
+
+    @docval(
+        {
+            'name': 'blocks',
+            'type': Iterable,
+            'doc': 'iterable or generator of waveform sample blocks, with '
+                   'time on the first dimension'
+        },
+        {
+            'name': 'dtype',
+            'type': (type, np.dtype, str),
+            'doc': 'the dtype to write the waveform as. Defaults to the '
+                   'dtype of the first block',
+            'default': None
+        },
+        {
+            'name': 'chunk_shape',
+            'type': tuple,
+            'doc': 'the HDF5 chunk shape to recommend for the dataset',
+            'default': None
+        }
+    )
+    def __init__(self, **kwargs):
+        blocks, dtype, chunk_shape = getargs('blocks', 'dtype',
+                                             'chunk_shape', kwargs)
+        self.__blocks = iter(blocks)
+        try:
+            self.__next_block = np.asarray(next(self.__blocks))
+        except StopIteration:
+            raise ValueError('StimBlockIterator requires at least one '
+                             'block of samples')
+        if self.__next_block.ndim not in (1, 2):
+            raise ValueError('blocks must be 1D or 2D (time x pairs), found '
+                             'shape %s' % str(self.__next_block.shape))
+        self.__dtype = np.dtype(dtype or self.__next_block.dtype)
+        self.__chunk_shape = chunk_shape
+        self.__first_shape = self.__next_block.shape
+        self.__position = 0
+        # when the last block was returned, and its size
+        self.__returned = None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        """
+        Return the next block as a DataChunk placed after the samples that
+        have already been returned.
+        """
+        self.__record_write()
+        if self.__next_block is not None:
+            block, self.__next_block = self.__next_block, None
+        else:
+            block = np.asarray(next(self.__blocks))
+        if block.shape[1:] != self.__first_shape[1:]:
+            raise ValueError('block shape %s does not match the shape of the '
+                             'first block %s'
+                             % (str(block.shape), str(self.__first_shape)))
+        block = block.astype(self.__dtype, copy=False)
+        start = self.__position
+        self.__position += len(block)
+        selection = (slice(start, self.__position),) + tuple(
+            slice(None) for _ in block.shape[1:])
+        self.__returned = (time.perf_counter(), block.nbytes)
+        return DataChunk(data=block, selection=selection)
+
+    next = __next__
+
+    def __record_write(self):
+        # the writer asks for the next block once it has written the last one
+        if self.__returned is not None:
+            returned, nbytes = self.__returned
+            record('StimSeries.hdf5_write', time.perf_counter() - returned,
+                   bytes_written=nbytes, buffer_bytes=nbytes)
+            self.__returned = None
+
+    def recommended_chunk_shape(self):
+        return self.__chunk_shape
+
+    def recommended_data_shape(self):
+        return self.__first_shape
+
+    @property
+    def dtype(self):
+        return self.__dtype
+
+    @property
+    def maxshape(self):
+        return (None,) + self.__first_shape[1:]
+
+
+def wrap_waveform_data(data, chunk_shape=None, compression='gzip',
+                       compression_opts=None, shuffle=True):
+    """
+    Wrap a waveform, an array or a StimBlockIterator, in an H5DataIO that
+    writes it as a chunked, compressed dataset.
+
+    :param data: the waveform
+    :param chunk_shape: the HDF5 chunk shape. Defaults to letting h5py choose
+    :param compression: the compression filter, 'gzip' or 'lzf'
+    :param compression_opts: the compression level for gzip (0-9)
+    :param shuffle: whether to apply the shuffle filter before compression
+    """
+    if compression not in ('gzip', 'lzf'):
+        raise ValueError("compression must be 'gzip' or 'lzf', found "
+                         "'%s'" % compression)
+    if compression == 'lzf' and compression_opts is not None:
+        raise ValueError("compression_opts is not supported for 'lzf' "
+                         "compression")
+    return H5DataIO(data=data, chunks=chunk_shape, compression=compression,
+                    compression_opts=compression_opts, shuffle=shuffle)
+
+
+def get_readable_data(data):
+    """
+    Return *data* in a form that supports slicing along the first dimension,
+    unwrapping DataIO objects and converting lists to arrays.
+    """
+    if isinstance(data, DataIO):
+        data = data.data
+    if isinstance(data, AbstractDataChunkIterator):
+        raise ValueError('data that is written from an iterator cannot be '
+                         'read before it is written to a file')
+    if isinstance(data, (list, tuple)):
+        data = np.asarray(data)
+    return data
+
+
+def find_groups(group, neurodata_types):
+    """
+    Find the HDF5 groups of the given neurodata types under *group*, without
+    descending into the cached specifications or into the groups that are
+    found. Returns a dict of the list of groups of each type.
+
+    :param group: the h5py.File or h5py.Group to search
+    :param neurodata_types: the names of the neurodata types to find
+    """
+    found = {neurodata_type: list() for neurodata_type in neurodata_types}
+    _find_groups(group, found)
+    return found
+
+
+def _find_groups(group, found):
+    for obj in group.values():
+        if not isinstance(obj, h5py.Group) or obj.name == '/specifications':
+            continue
+        neurodata_type = obj.attrs.get('neurodata_type')
+        if isinstance(neurodata_type, bytes):
+            neurodata_type = neurodata_type.decode()
+        if neurodata_type in found:
+            found[neurodata_type].append(obj)
+        else:
+            _find_groups(obj, found)
+
+
+def time_to_index(series, times, side='left'):
+    """
+    Convert *times* to indices of the samples of a TimeSeries. With
+    side='left' the result is the first sample at or after each time, and
+    with side='right' it is the first sample after each time.
+
+    :param series: the TimeSeries, with either a rate or timestamps
+    :param times: the times to convert, in seconds
+    :param side: 'left' or 'right'
+    """
+    times = np.asarray(times, dtype=float)
+    if series.rate is not None:
+        index = (times - series.starting_time) * series.rate
+        # snap values within rounding error of a sample onto it
+        rounded = np.round(index)
+        index = np.where(np.isclose(index, rounded), rounded, index)
+        if side == 'left':
+            return np.ceil(index).astype(np.int64)
+        return np.floor(index).astype(np.int64) + 1
+    timestamps = get_readable_data(series.timestamps)
+    return np.searchsorted(np.asarray(timestamps), times, side=side)
+
+
+@instrumented('StimSeries.read_segments')
+def read_segments(data, starts, stops, n_samples, columns=None,
+                  fill_value=np.nan, max_gap=0):
+    """
+    Read the segments data[starts[i]:stops[i]] into one preallocated array of
+    shape (n_segments, n_samples, n_columns).
+
+    Segments that overlap, or are separated by at most *max_gap* samples, are
+    coalesced into a single contiguous read, so each region of the data is
+    read from HDF5 once. Samples of a segment that fall outside the data or
+    beyond its stop are set to *fill_value*.
+
+    :param data: array or h5py.Dataset with time on the first dimension
+    :param starts: the first sample of each segment, may be negative
+    :param stops: the sample after the last sample of each segment
+    :param n_samples: the number of samples per output segment
+    :param columns: indices of the columns to read. Defaults to all columns
+    :param fill_value: the value of samples missing from the data
+    :param max_gap: the largest gap, in samples, between segments that are
+                    still read together
+    """
+    starts = np.asarray(starts, dtype=np.int64)
+    stops = np.minimum(np.asarray(stops, dtype=np.int64), starts + n_samples)
+    n_total = data.shape[0]
+    if columns is None:
+        columns = slice(None)
+        n_columns = data.shape[1] if data.ndim > 1 else 1
+        inverse = slice(None)
+    else:
+        # h5py requires sorted, unique indices
+        columns, inverse = np.unique(np.asarray(columns, dtype=np.int64),
+                                     return_inverse=True)
+        n_columns = len(inverse)
+    dtype = data.dtype if np.issubdtype(data.dtype, np.floating) else float
+    out = np.full((len(starts), n_samples, n_columns), fill_value,
+                  dtype=dtype)
+
+    order = np.argsort(starts, kind='stable')
+    clipped_starts = np.clip(starts[order], 0, n_total)
+    clipped_stops = np.clip(stops[order], clipped_starts, n_total)
+    if not len(order):
+        return out
+    # a new read begins wherever a segment starts after all earlier ones end
+    reach = np.maximum.accumulate(clipped_stops)
+    new_read = np.r_[True, clipped_starts[1:] > reach[:-1] + max_gap]
+    first = np.flatnonzero(new_read)
+    read_stops = np.maximum.reduceat(clipped_stops, first)
+    for begin, end, read_start, read_stop in zip(
+            first, np.r_[first[1:], len(order)], clipped_starts[first],
+            read_stops):
+        if read_stop <= read_start:
+            continue
+        if data.ndim > 1:
+            block = np.asarray(data[read_start:read_stop, columns])
+            block = block[:, inverse]
+        else:
+            block = np.asarray(data[read_start:read_stop])[:, None]
+        record('StimSeries.read_segments', calls=0, bytes_read=block.nbytes,
+               buffer_bytes=out.nbytes)
+        for i in range(begin, end):
+            segment = order[i]
+            src_start = clipped_starts[i] - read_start
+            src_stop = clipped_stops[i] - read_start
+            dst_start = clipped_starts[i] - starts[segment]
+            out[segment, dst_start:dst_start + src_stop - src_start] = \
+                block[src_start:src_stop]
+    return out
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""
+Detect stimulation runs in a recorded StimSeries waveform and build the
+matching StimTable.
+
+The waveform of each bipolar pair is thresholded into phases, maximal
+stretches of samples above *threshold* in absolute value with the same sign.
+A pulse is a sequence of phases bounded by samples below threshold, and its
+pulse width is the duration of its first phase. Pulses closer together than
+*max_interval* belong to the same run. The frequency, amplitude and pulse
+width of a run are the medians over its pulses of the inverse inter-pulse
+interval, the peak absolute value and the pulse width. A run of a single
+pulse has no inter-pulse interval: its frequency is NaN and it stops when its
+pulse ends. Pulses further apart than *max_interval*, e.g. those of trains
+slower than 1 Hz with the default of 1 s, each form a run of their own.
+"""
+import numpy as np
+from hdmf.utils import docval, getargs
+
+from .data_utils import get_readable_data
+from .ndx_electrical_stim import StimSeries, StimTable
+from .pulses import PhaseTracker, SampleTimes, get_default_threshold
+
+
+@docval(
+    {
+        'name': 'stim_series',
+        'type': StimSeries,
+        'doc': 'the recorded stimulation waveform'
+    },
+    {
+        'name': 'stim_table',
+        'type': StimTable,
+        'doc': 'the StimTable to add the detected runs to. Defaults to a new '
+               'StimTable',
+        'default': None
+    },
+    {
+        'name': 'threshold',
+        'type': float,
+        'doc': 'the absolute value, in amperes, above which a sample is part '
+               'of a pulse. Defaults to half of the largest absolute value '
+               'of the waveform, which costs an extra pass over the data',
+        'default': None
+    },
+    {
+        'name': 'max_interval',
+        'type': float,
+        'doc': 'the longest interval, in seconds, between the onsets of '
+               'consecutive pulses of the same run. Must be longer than the '
+               'inter-pulse interval of the slowest train, whose pulses '
+               'otherwise form one run each',
+        'default': 1.
+    },
+    {
+        'name': 'block_rows',
+        'type': int,
+        'doc': 'the number of samples to read at a time. Defaults to about '
+               '8 MiB of whole HDF5 chunks',
+        'default': None
+    },
+    returns='the StimTable with the detected runs', rtype=StimTable,
+    is_method=False
+)
+def detect_runs(**kwargs):
+    """
+    Detect the stimulation runs of every bipolar pair of a StimSeries and add
+    them to a StimTable in one bulk insert.
+
+    The waveform is read one block at a time and thresholded and
+    edge-detected with array operations, so memory and time scale linearly
+    with the recording regardless of its length. The *bipolar_pair* of each
+    run is taken from the *bipolar_electrodes* of the StimSeries.
+    """
+    stim_series, stim_table, threshold, max_interval, block_rows = getargs(
+        'stim_series', 'stim_table', 'threshold', 'max_interval',
+        'block_rows', kwargs)
+    data = stim_series.get_lazy_data()
+    if data.ndim != 2:
+        raise ValueError('the waveform of StimSeries %s must be 2D (time x '
+                         'pairs)' % stim_series.name)
+    region = stim_series.bipolar_electrodes
+    if stim_table is None:
+        stim_table = StimTable(bipolar_table=region.table)
+    if threshold is None:
+        if len(data) == 0:
+            return stim_table
+        threshold = get_default_threshold(data)
+        if threshold == 0:
+            return stim_table
+
+    trackers = [PhaseTracker(threshold) for _ in range(data.shape[1])]
+    for start, block in data.iter_blocks(block_rows):
+        for column, tracker in enumerate(trackers):
+            tracker.consume(block[:, column], start)
+
+    times = SampleTimes(stim_series, len(data))
+    pairs = np.asarray(get_readable_data(region.data)[:])
+    runs = [_runs_from_phases(tracker.finish(len(data)), times, max_interval)
+            for tracker in trackers]
+    for column, column_runs in enumerate(runs):
+        column_runs['bipolar_pair'] = np.full(len(column_runs['start_time']),
+                                              pairs[column])
+    runs = {name: np.concatenate([column_runs[name] for column_runs in runs])
+            for name in runs[0]} if runs else dict()
+    if not runs or not len(runs['start_time']):
+        return stim_table
+    order = np.argsort(runs['start_time'], kind='stable')
+    runs = {name: values[order] for name, values in runs.items()}
+    for name in stim_table.colnames:
+        if name not in runs:
+            raise ValueError("StimTable %s has column '%s' that cannot be "
+                             "detected" % (stim_table.name, name))
+    stim_table.add_runs(**runs)
+    return stim_table
+
+
+def _runs_from_phases(phases, times, max_interval):
+    """
+    Group the phases of one pair into pulses and the pulses into runs.
+    """
+    starts, ends, peaks, before, after = phases
+    if not len(starts):
+        return {name: np.empty(0) for name in (
+            'start_time', 'stop_time', 'frequency', 'amplitude',
+            'pulse_width')}
+    first = np.flatnonzero(before == 0)
+    last = np.flatnonzero(after == 0)
+    onsets = starts[first].astype(np.int64)
+    pulse_ends = ends[last].astype(np.int64)
+    widths = (ends[first] - starts[first]) / times.rate
+    amplitudes = np.maximum.reduceat(peaks, first)
+
+    onset_times = times(onsets)
+    new_run = np.r_[True, np.diff(onset_times) > max_interval]
+    run_first = np.flatnonzero(new_run)
+    run_last = np.r_[run_first[1:], len(onsets)] - 1
+    run_of_pulse = np.cumsum(new_run) - 1
+
+    intervals = np.diff(onset_times)
+    same_run = ~new_run[1:]
+    interval_median = _group_median(intervals[same_run],
+                                    run_of_pulse[1:][same_run],
+                                    len(run_first))
+    frequency = 1. / interval_median
+    end_times = times(pulse_ends - 1) + 1. / times.rate
+    stop_time = np.fmax(onset_times[run_last] + interval_median,
+                        end_times[run_last])
+    return dict(
+        start_time=onset_times[run_first],
+        stop_time=stop_time,
+        frequency=frequency,
+        amplitude=_group_median(amplitudes, run_of_pulse, len(run_first)),
+        pulse_width=_group_median(widths, run_of_pulse, len(run_first))
+    )
+
+
+def _group_median(values, groups, n_groups):
+    """
+    The median of *values* within each of *n_groups* groups, NaN for empty
+    groups.
+    """
+    order = np.lexsort((values, groups))
+    values = values[order]
+    counts = np.bincount(groups, minlength=n_groups)
+    offsets = np.cumsum(counts) - counts
+    medians = np.full(n_groups, np.nan)
+    found = counts > 0
+    low = offsets[found] + (counts[found] - 1) // 2
+    high = offsets[found] + counts[found] // 2
+    medians[found] = (values[low] + values[high]) / 2
+    return medians
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+Sorted index over [start, stop] intervals for fast overlap queries.
+"""
+import numpy as np
+
+
+class IntervalIndex(object):
+    """
+    Index over a set of [start, stop] intervals that finds the intervals
+    overlapping a query window with two binary searches.
+
+    Intervals are sorted by start time, along with the running maximum of
+    their stop times. Every interval before the first position whose running
+    maximum reaches the window start ends before the window, and every
+    interval after the last start inside the window begins after it, so only
+    the positions in between need to be checked. For stimulation runs, which
+    rarely overlap each other, that range is (almost) exactly the answer.
+    Intervals with a NaN start or stop never match.
+    """
+
+    def __init__(self, starts, stops):
+        starts = np.asarray(starts, dtype=float)
+        stops = np.asarray(stops, dtype=float)
+        if starts.shape != stops.shape or starts.ndim != 1:
+            raise ValueError('starts and stops must be 1D arrays of the same '
+                             'length')
+        self.__order = np.argsort(starts, kind='stable')
+        self.__starts = starts[self.__order]
+        self.__stops = stops[self.__order]
+        self.__max_stops = np.maximum.accumulate(
+            np.where(np.isnan(self.__stops), -np.inf, self.__stops))
+
+    def __len__(self):
+        return len(self.__order)
+
+    def __bounds(self, t0, t1):
+        lo = np.searchsorted(self.__max_stops, t0, side='left')
+        hi = np.searchsorted(self.__starts, t1, side='right')
+        return lo, np.maximum(lo, hi)
+
+    def overlapping(self, t0, t1):
+        """
+        Return the sorted indices of the intervals that overlap [t0, t1].
+        """
+        lo, hi = self.__bounds(t0, t1)
+        candidates = self.__order[lo:hi]
+        return np.sort(candidates[self.__stops[lo:hi] >= t0])
+
+    def overlapping_many(self, t0, t1):
+        """
+        Return, for each window [t0[i], t1[i]], the sorted indices of the
+        intervals that overlap it.
+        """
+        t0 = np.asarray(t0, dtype=float)
+        t1 = np.asarray(t1, dtype=float)
+        if len(t0) == 0:
+            return []
+        lo, hi = self.__bounds(t0, t1)
+        counts = hi - lo
+        # positions lo[i]:hi[i] of every window, concatenated
+        offsets = np.cumsum(counts) - counts
+        positions = (np.arange(counts.sum())
+                     + np.repeat(lo - offsets, counts))
+        matches = self.__stops[positions] >= np.repeat(t0, counts)
+        window = np.repeat(np.arange(len(t0)), counts)[matches]
+        rows = self.__order[positions[matches]]
+        # sort by window, then by row
+        sort = np.lexsort((rows, window))
+        rows, window = rows[sort], window[sort]
+        return np.split(rows, np.searchsorted(window, np.arange(1, len(t0))))
@@ -0,0 +1,365 @@
+# -*- coding: utf-8 -*-
+"""
+Opt-in instrumentation of the hot paths of StimTable and StimSeries I/O.
+
+While instrumentation is enabled, every instrumented operation records its
+number of calls, its cumulative wall time, the bytes it read and wrote and
+the largest buffer it held:
+
+- StimTable.add_run and StimTable.add_runs,
+- bipolar.bind_table, looking up the BipolarSchemeTable of a bipolar_pair
+  column, and bipolar.resolve_pairs, resolving pairs to their electrodes,
+- StimTableMap.bipolar_column, when a StimTable is built for writing,
+- StimSeries.hdf5_write, the HDF5 writes of StimSeries waveforms, once per
+  waveform held in memory and once per block of a StimBlockIterator, timed
+  from one block to the next. The waveforms held in memory are recorded by
+  wrapping HDF5IO.write_dataset, only while instrumentation is enabled,
+- StimSeriesAppender.hdf5_write, the writes of a StimSeriesAppender,
+- StimSeries.read_segments, reading windows of waveform samples,
+- ColumnBuffers.grow, the growth of the in-memory buffers of table columns.
+
+Enable it for a block of code::
+
+    from ndx_electrical_stim.instrumentation import instrument
+
+    with instrument() as instrumentation:
+        convert(session)
+    instrumentation.write('report.json')
+
+or for whole processes, including worker processes, by setting the
+environment variable NDX_ELECTRICAL_STIM_INSTRUMENT to a directory. Every
+process then writes its report to that directory when it exits, and
+*convert_sessions* workers after each session. Aggregate the reports with
+*merge_reports*, or from the command line::
+
+    python -m ndx_electrical_stim.instrumentation reports/
+
+When instrumentation is disabled, an instrumented call costs one check of a
+module global.
+"""
+import argparse
+import atexit
+import functools
+import json
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+import h5py
+import numpy as np
+from hdmf.backends.hdf5 import HDF5IO
+from hdmf.data_utils import AbstractDataChunkIterator, DataIO
+from hdmf.utils import docval, getargs
+
+from .namespace import NAMESPACE_NAME
+
+ENV_VAR = 'NDX_ELECTRICAL_STIM_INSTRUMENT'
+
+_FIELDS = ('calls', 'seconds', 'bytes_read', 'bytes_written',
+           'peak_buffer_bytes')
+# the neurodata types whose data is recorded as StimSeries.hdf5_write
+_STIM_SERIES_TYPES = ('StimSeries', 'SparseStimSeries')
+
+# the Instrumentation that records operations, or None when disabled
+_active = None
+# the directory that reports are written to, and the Instrumentation of the
+# whole process, if enabled by ENV_VAR
+_report_dir = None
+_process = None
+# the original HDF5IO.write_dataset while it is wrapped
+_write_dataset = None
+
+
+class Instrumentation(object):
+    """
+    The statistics of the instrumented operations of one process, recorded
+    while it is active.
+    """
+
+    def __init__(self):
+        self.__operations = dict()
+        self.__lock = threading.Lock()
+        self.__started = time.time()
+
+    def record(self, operation, seconds=0., calls=1, bytes_read=0,
+               bytes_written=0, buffer_bytes=0):
+        """
+        Add a call, or other counts, to the statistics of an operation.
+
+        :param operation: the name of the operation
+        :param seconds: the wall time of the call
+        :param calls: the number of calls
+        :param bytes_read: the number of bytes read
+        :param bytes_written: the number of bytes written
+        :param buffer_bytes: the size of a buffer held by the operation
+        """
+        with self.__lock:
+            stats = self.__operations.get(operation)
+            if stats is None:
+                stats = self.__operations[operation] = [0, 0., 0, 0, 0]
+            stats[0] += calls
+            stats[1] += seconds
+            stats[2] += bytes_read
+            stats[3] += bytes_written
+            stats[4] = max(stats[4], buffer_bytes)
+
+    def merge(self, report):
+        """
+        Add the statistics of a report, e.g. of a nested instrumentation.
+
+        :param report: a report returned by *report*
+        """
+        for operation, stats in report['operations'].items():
+            with self.__lock:
+                current = self.__operations.setdefault(operation,
+                                                       [0, 0., 0, 0, 0])
+                for i, field in enumerate(_FIELDS[:-1]):
+                    current[i] += stats[field]
+                current[4] = max(current[4], stats['peak_buffer_bytes'])
+
+    def report(self):
+        """
+        The statistics recorded so far, as a dictionary that can be
+        serialized to JSON.
+        """
+        with self.__lock:
+            operations = {operation: dict(zip(_FIELDS, stats))
+                          for operation, stats in self.__operations.items()}
+        return dict(hostname=socket.gethostname(), pid=os.getpid(),
+                    processes=1, started=self.__started,
+                    elapsed=time.time() - self.__started,
+                    operations=operations)
+
+    def write(self, path):
+        """
+        Write the report to a JSON file.
+
+        :param path: the path of the file
+        """
+        # write to a temporary file first so that readers never see a
+        # partial report
+        partial = path + '.partial'
+        with open(partial, 'w') as f:
+            json.dump(self.report(), f, indent=1, sort_keys=True)
+        os.replace(partial, path)
+
+
+def get_instrumentation():
+    """
+    The Instrumentation that is recording, or None if instrumentation is
+    disabled.
+    """
+    return _active
+
+
+@contextmanager
+def instrument():
+    """
+    Record the instrumented operations of all threads while a block of code
+    runs, and yield the Instrumentation that records them.
+
+    When instrumentation was already enabled, e.g. by an enclosing block, the
+    statistics of the block are also added to the enclosing Instrumentation
+    when it exits.
+    """
+    outer = _active
+    instrumentation = Instrumentation()
+    _set_active(instrumentation)
+    try:
+        yield instrumentation
+    finally:
+        _set_active(outer)
+        if outer is not None:
+            outer.merge(instrumentation.report())
+
+
+def instrumented(operation):
+    """
+    Decorate a function so that its calls are recorded as *operation* while
+    instrumentation is enabled.
+
+    :param operation: the name of the operation
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            instrumentation = _active
+            if instrumentation is None:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                instrumentation.record(operation,
+                                       time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+def record(operation, seconds=0., calls=1, bytes_read=0, bytes_written=0,
+           buffer_bytes=0):
+    """
+    Record a call of, or other counts of, *operation* if instrumentation is
+    enabled. See Instrumentation.record.
+    """
+    instrumentation = _active
+    if instrumentation is not None:
+        instrumentation.record(operation, seconds, calls, bytes_read,
+                               bytes_written, buffer_bytes)
+
+
+def flush():
+    """
+    Write the report of this process to the directory named by ENV_VAR, if
+    instrumentation was enabled by it.
+    """
+    if _process is not None:
+        os.makedirs(_report_dir, exist_ok=True)
+        _process.write(os.path.join(
+            _report_dir, 'instrumentation-%s-%d.json'
+            % (socket.gethostname(), os.getpid())))
+
+
+@docval(
+    {
+        'name': 'reports',
+        'type': (str, list, tuple),
+        'doc': 'reports, paths of report files, or a directory of report '
+               'files'
+    },
+    returns='the combined report, with the statistics of every operation '
+            'summed over the reports and the largest peak buffer',
+    rtype=dict,
+    is_method=False
+)
+def merge_reports(**kwargs):
+    """
+    Aggregate the reports of many processes, e.g. of the workers of a
+    conversion.
+    """
+    reports = getargs('reports', kwargs)
+    if isinstance(reports, str):
+        reports = sorted(os.path.join(reports, name)
+                         for name in os.listdir(reports)
+                         if name.endswith('.json'))
+    merged = Instrumentation()
+    processes = 0
+    elapsed = 0.
+    for report in reports:
+        if isinstance(report, str):
+            with open(report) as f:
+                report = json.load(f)
+        merged.merge(report)
+        processes += report['processes']
+        elapsed += report['elapsed']
+    return dict(processes=processes, elapsed=elapsed,
+                operations=merged.report()['operations'])
+
+
+def main(argv=None):
+    """
+    Print the aggregated reports of a directory from the command line.
+    """
+    parser = argparse.ArgumentParser(
+        description='Aggregate the instrumentation reports of processes.')
+    parser.add_argument('reports', nargs='+',
+                        help='report files, or a directory of report files')
+    parser.add_argument('--json', action='store_true',
+                        help='print the aggregated report as JSON')
+    args = parser.parse_args(argv)
+    reports = args.reports[0] if len(args.reports) == 1 \
+        and os.path.isdir(args.reports[0]) else args.reports
+    merged = merge_reports(reports)
+    if args.json:
+        print(json.dumps(merged, indent=1, sort_keys=True))
+        return 0
+    print('%d processes, %.1f s' % (merged['processes'], merged['elapsed']))
+    print('%-32s %10s %10s %12s %12s %12s'
+          % ('operation', 'calls', 'seconds', 'read', 'written',
+             'peak buffer'))
+    for operation, stats in sorted(merged['operations'].items(),
+                                   key=lambda item: -item[1]['seconds']):
+        print('%-32s %10d %10.3f %12d %12d %12d'
+              % ((operation,) + tuple(stats[field] for field in _FIELDS)))
+    return 0
+
+
+def _set_active(instrumentation):
+    """
+    Make *instrumentation* the Instrumentation that records, or disable
+    instrumentation with None. HDF5IO.write_dataset is wrapped while
+    instrumentation is enabled, and restored when it is disabled.
+    """
+    global _active, _write_dataset
+    _active = instrumentation
+    if instrumentation is not None and _write_dataset is None:
+        _write_dataset = HDF5IO.write_dataset
+        HDF5IO.write_dataset = _instrument_write_dataset(_write_dataset)
+    elif instrumentation is None and _write_dataset is not None:
+        HDF5IO.write_dataset = _write_dataset
+        _write_dataset = None
+
+
+def _instrument_write_dataset(write_dataset):
+    """
+    Wrap HDF5IO.write_dataset so that the writes of the data of StimSeries
+    are recorded as StimSeries.hdf5_write, one call per dataset. Data written
+    from an iterator is left out: a StimBlockIterator records the write of
+    each of its blocks itself.
+    """
+    @functools.wraps(write_dataset)
+    def wrapper(self, *args, **kwargs):
+        if _active is None:
+            return write_dataset(self, *args, **kwargs)
+        parent = args[0] if args else kwargs['parent']
+        builder = args[1] if len(args) > 1 else kwargs['builder']
+        data = builder.data
+        while isinstance(data, DataIO):
+            data = data.data
+        group = builder.parent
+        if (builder.name != 'data' or group is None
+                or group.attributes.get('namespace') != NAMESPACE_NAME
+                or group.attributes.get('neurodata_type')
+                not in _STIM_SERIES_TYPES
+                or isinstance(data, AbstractDataChunkIterator)
+                or self.get_written(builder)):
+            return write_dataset(self, *args, **kwargs)
+        start = time.perf_counter()
+        ret = write_dataset(self, *args, **kwargs)
+        # links to existing datasets write no samples
+        written = 0
+        if isinstance(parent.get(builder.name, getlink=True), h5py.HardLink):
+            dset = parent[builder.name]
+            written = dset.size * dset.dtype.itemsize
+        record('StimSeries.hdf5_write', time.perf_counter() - start,
+               bytes_written=written,
+               buffer_bytes=data.nbytes if isinstance(data, np.ndarray) else 0)
+        return ret
+    return wrapper
+
+
+def _start_process():
+    """
+    Give a forked child process its own Instrumentation, so that its report
+    does not repeat the statistics of its parent.
+    """
+    global _process
+    _process = Instrumentation()
+    _set_active(_process)
+
+
+if os.environ.get(ENV_VAR):
+    _report_dir = os.environ[ENV_VAR]
+    _process = Instrumentation()
+    _set_active(_process)
+    atexit.register(flush)
+    # spawned processes, and all processes where fork is not available,
+    # import this module again and are instrumented through ENV_VAR
+    if hasattr(os, 'register_at_fork'):
+        os.register_at_fork(after_in_child=_start_process)
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
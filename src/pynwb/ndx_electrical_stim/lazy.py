@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+"""
+Lazy, NumPy-compatible access to StimSeries waveforms stored in HDF5.
+"""
+from collections import OrderedDict
+
+import h5py
+import numpy as np
+
+from .data_utils import get_readable_data
+
+# target number of bytes read at a time by the reductions
+_REDUCTION_BYTES = 8 * 1024 ** 2
+# number of bytes per cached block of an unchunked dataset
+_CACHE_BLOCK_BYTES = 1024 ** 2
+
+
+class LazyStimData(object):
+    """
+    A lazily sliced view of a StimSeries waveform that reads only the samples
+    that are indexed.
+
+    If the waveform is a contiguous, uncompressed HDF5 dataset, it is
+    memory-mapped directly from the file and slices are zero-copy views. Other
+    HDF5 datasets are read one block of chunk rows at a time through a
+    least-recently-used cache, so repeated nearby slices do not decompress
+    the same chunks again. In-memory arrays are used as they are.
+
+    The per-pair reductions (*mean*, *rms*, *min*, *max*, *abs_max*) walk the waveform
+    block by block and never hold the whole waveform in memory.
+    """
+
+    def __init__(self, data, cache_blocks=64):
+        data = get_readable_data(data)
+        self.__data = data
+        self.__memmap = None
+        self.__block_rows = None
+        self.__cache = OrderedDict()
+        self.__cache_blocks = cache_blocks
+        if isinstance(data, h5py.Dataset):
+            if _is_memmappable(data):
+                self.__memmap = np.memmap(data.file.filename, mode='r',
+                                          dtype=data.dtype, shape=data.shape,
+                                          offset=data.id.get_offset())
+            elif data.chunks is not None:
+                self.__block_rows = data.chunks[0]
+            else:
+                self.__block_rows = max(1, _CACHE_BLOCK_BYTES // max(1, _row_bytes(data)))
+
+    @property
+    def is_memmap(self):
+        """Whether the waveform is memory-mapped from the file"""
+        return self.__memmap is not None
+
+    @property
+    def shape(self):
+        return self.__data.shape
+
+    @property
+    def dtype(self):
+        return self.__data.dtype
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None):
+        return np.asarray(self[:], dtype=dtype)
+
+    def __getitem__(self, key):
+        if self.__memmap is not None:
+            return self.__memmap[key]
+        if self.__block_rows is None:
+            return self.__data[key]
+        if not isinstance(key, tuple):
+            key = (key,)
+        time_key, rest = key[0], key[1:]
+        if isinstance(time_key, slice):
+            rows = np.arange(*time_key.indices(len(self)))
+        else:
+            rows = np.asarray(time_key)
+            if rows.dtype == bool:
+                rows = np.flatnonzero(rows)
+            rows = np.where(rows < 0, rows + len(self), rows)
+            if rows.size and (rows.min() < 0 or rows.max() >= len(self)):
+                raise IndexError('index out of range for a waveform with %d '
+                                 'samples' % len(self))
+        flat_rows = rows.ravel()
+        out = np.empty((len(flat_rows),) + self.shape[1:], dtype=self.dtype)
+        blocks = flat_rows // self.__block_rows
+        order = np.argsort(blocks, kind='stable')
+        unique_blocks, group_starts = np.unique(blocks[order],
+                                                return_index=True)
+        for block, group in zip(unique_blocks,
+                                np.split(order, group_starts[1:])):
+            out[group] = self.__get_block(block)[flat_rows[group] - block * self.__block_rows]
+        out = out.reshape(rows.shape + self.shape[1:])
+        return out[(slice(None),) * rows.ndim + rest] if rest else out
+
+    def __get_block(self, block):
+        cached = self.__cache.get(block)
+        if cached is not None:
+            self.__cache.move_to_end(block)
+            return cached
+        start = block * self.__block_rows
+        cached = self.__data[start:start + self.__block_rows]
+        self.__cache[block] = cached
+        if len(self.__cache) > self.__cache_blocks:
+            self.__cache.popitem(last=False)
+        return cached
+
+    def iter_blocks(self, block_rows=None):
+        """
+        Iterate over the waveform in blocks of rows, yielding the index of
+        the first row of each block and the block itself. By default, blocks
+        are a whole number of HDF5 chunks of about 8 MiB.
+        """
+        if block_rows is None:
+            block_rows = max(1, _REDUCTION_BYTES // max(1, _row_bytes(self.__data)))
+            if self.__block_rows is not None:
+                block_rows = max(self.__block_rows,
+                                 block_rows - block_rows % self.__block_rows)
+        source = self.__memmap if self.__memmap is not None else self.__data
+        for start in range(0, len(self), block_rows):
+            yield start, np.asarray(source[start:start + block_rows])
+
+    def __reduce_blocks(self, func, combine):
+        result = None
+        for _, block in self.iter_blocks():
+            value = func(block)
+            result = value if result is None else combine(result, value)
+        if result is None:
+            raise ValueError('cannot reduce an empty waveform')
+        return result
+
+    def sum(self):
+        """The sum of the waveform of each pair"""
+        return self.__reduce_blocks(
+            lambda block: block.sum(axis=0, dtype=np.float64), np.add)
+
+    def mean(self):
+        """The mean of the waveform of each pair"""
+        return self.sum() / len(self)
+
+    def rms(self):
+        """The root mean square of the waveform of each pair"""
+        sum_squares = self.__reduce_blocks(
+            lambda block: np.square(block, dtype=np.float64).sum(axis=0),
+            np.add)
+        return np.sqrt(sum_squares / len(self))
+
+    def min(self):
+        """The minimum of the waveform of each pair"""
+        return self.__reduce_blocks(lambda block: block.min(axis=0),
+                                    np.minimum)
+
+    def max(self):
+        """The maximum of the waveform of each pair"""
+        return self.__reduce_blocks(lambda block: block.max(axis=0),
+                                    np.maximum)
+
+    def abs_max(self):
+        """The largest absolute value of the waveform of each pair"""
+        return self.__reduce_blocks(lambda block: np.abs(block).max(axis=0),
+                                    np.maximum)
+
+
+def _is_memmappable(dset):
+    """
+    Whether *dset* is stored as one contiguous, unfiltered block in a plain
+    file on disk.
+    """
+    if dset.chunks is not None or dset.compression is not None:
+        return False
+    if dset.file.driver not in ('sec2', 'stdio'):
+        return False
+    return dset.id.get_offset() is not None and dset.dtype.kind in 'biuf'
+
+
+def _row_bytes(data):
+    return int(np.prod(data.shape[1:], dtype=np.int64)) * data.dtype.itemsize
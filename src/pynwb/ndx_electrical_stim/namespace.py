@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+"""
+Find and load the ndx-electrical-stim namespace.
+"""
+import os
+
+import pynwb
+
+NAMESPACE_NAME = 'ndx-electrical-stim'
+_NAMESPACE_FILE = 'ndx-electrical-stim.namespace.yaml'
+
+
+def get_namespace_path():
+    """
+    The path of the namespace YAML file: the installed copy in the package,
+    or the one in the git repo when running from a source checkout.
+    """
+    path = os.path.join(os.path.dirname(__file__), 'spec', _NAMESPACE_FILE)
+    if not os.path.exists(path):
+        path = os.path.abspath(os.path.join(
+            os.path.dirname(__file__), '..', '..', '..', 'spec',
+            _NAMESPACE_FILE))
+    return path
+
+
+def load_namespace():
+    """
+    Load the ndx-electrical-stim namespace into the PyNWB type map. Loading
+    it again is cheap and has no effect.
+    """
+    pynwb.load_namespaces(get_namespace_path())
@@ -3,14 +3,33 @@
 Define StimSeries & StimTable classes for the PyNWB API.
 """
 import warnings
+from collections.abc import Iterable
 
-from hdmf.common import DynamicTableRegion
+import numpy as np
+import pandas as pd
+from hdmf.common import DynamicTable, DynamicTableRegion, VectorIndex
 from hdmf.common.io.table import DynamicTableMap
+from hdmf.container import Data
+from hdmf.data_utils import AbstractDataChunkIterator, DataIO
 from hdmf.utils import popargs, get_docval, docval
 from ndx_bipolar_scheme import BipolarSchemeTable
 from pynwb import TimeSeries, register_class
+from pynwb.core import NWBData
 from pynwb import register_map
 from pynwb.epoch import TimeIntervals
+from pynwb.io.base import TimeSeriesMap
+
+from .bipolar import resolve_bipolar_pairs
+from .buffer import ColumnBuffers
+from .data_utils import (StimBlockIterator, get_readable_data, read_segments,
+                         time_to_index, wrap_waveform_data)
+from .index import IntervalIndex
+from .instrumentation import instrumented
+from .lazy import LazyStimData
+from .overview import (PyramidBuilder, PyramidIterator, WaveformOverview,
+                       level_lengths, reduce_points)
+from .parallel import iter_read_segments, read_parallel
+from .sparse import SparseStimData, find_segments
 
 
 @register_class('StimTable', 'ndx-electrical-stim')
@@ -39,7 +58,7 @@ class StimTable(TimeIntervals):
         },
         {
             'name': 'amplitude',
-            'description': 'Amplitude of stimulation waveform, in meters',
+            'description': 'Amplitude of stimulation waveform, in amperes',
             'required': True
         },
         {
@@ -77,13 +96,48 @@ class StimTable(TimeIntervals):
                    '*bipolar_pair* column indexes',
             'default': None
         },
+        {
+            'name': 'lab_meta_data_name',
+            'type': str,
+            'doc': 'The name of the lab metadata (an EcephysExt) of the '
+                   'NWBFile whose BipolarSchemeTable the *bipolar_pair* '
+                   'column indexes, if *bipolar_table* is not given',
+            'default': 'ecephys_ext'
+        },
+        {
+            'name': 'parameter_dtype',
+            'type': str,
+            'doc': "the dtype to hold the frequency, amplitude and pulse "
+                   "width of the runs in, 'float64' or 'float32'",
+            'default': 'float64'
+        },
         *get_docval(TimeIntervals.__init__, 'id', 'columns', 'colnames')
     )
     def __init__(self, **kwargs):
-        bipolar_table = popargs('bipolar_table', kwargs)
+        bipolar_table, lab_meta_data_name, parameter_dtype = popargs(
+            'bipolar_table', 'lab_meta_data_name', 'parameter_dtype', kwargs)
+        if parameter_dtype not in ('float64', 'float32'):
+            raise ValueError("parameter_dtype must be 'float64' or "
+                             "'float32', got '%s'" % parameter_dtype)
         super(StimTable, self).__init__(**kwargs)
         self.bipolar_table = bipolar_table
+        self.lab_meta_data_name = lab_meta_data_name
+        if bipolar_table is not None:
+            self.bind_bipolar_table(bipolar_table)
+        self.__run_index = None
+        self.__bipolar_electrodes = None
+        # in-memory columns are accumulated in growable arrays of these dtypes
+        self.__buffers = ColumnBuffers({
+            'id': 'int64',
+            'start_time': 'float64',
+            'stop_time': 'float64',
+            'frequency': parameter_dtype,
+            'amplitude': parameter_dtype,
+            'pulse_width': parameter_dtype,
+            'bipolar_pair': 'int32'
+        })
 
+    @instrumented('StimTable.add_run')
     @docval(
         {
             'name': 'start_time',
@@ -115,19 +169,341 @@ class StimTable(TimeIntervals):
     def add_run(self, **kwargs):
         """
         Add a stimulation parameters for a specific run.
+
+        The standard columns of a table that is in memory are accumulated in
+        growable NumPy arrays (see *parameter_dtype*) rather than lists of
+        Python floats.
+        """
+        if not self.__append_run(kwargs):
+            super(StimTable, self).add_interval(**kwargs)
+        _bind_in_file(self, self['bipolar_pair'])
+        self.__run_index = None
+        self.__bipolar_electrodes = None
+
+    @instrumented('StimTable.add_runs')
+    @docval(
+        {
+            'name': 'start_time',
+            'type': 'array_data',
+            'doc': 'the start times of the stimulation runs',
+        },
+        {
+            'name': 'stop_time',
+            'type': 'array_data',
+            'doc': 'the stop times of the stimulation runs',
+        },
+        {
+            'name': 'frequency',
+            'type': 'array_data',
+            'doc': 'the frequencies of the stimulation waveforms',
+        },
+        {
+            'name': 'amplitude',
+            'type': 'array_data',
+            'doc': 'the amplitudes of the stimulation waveforms',
+        },
+        {
+            'name': 'pulse_width',
+            'type': 'array_data',
+            'doc': 'the pulse widths of the stimulation waveforms',
+        },
+        {
+            'name': 'bipolar_pair',
+            'type': 'array_data',
+            'doc': 'the rows of the BipolarSchemeTable used for each run',
+        },
+        {
+            'name': 'id',
+            'type': 'array_data',
+            'doc': 'the IDs for the new rows. Defaults to continuing the '
+                   'existing IDs',
+            'default': None
+        },
+        allow_extra=True
+    )
+    def add_runs(self, **kwargs):
+        """
+        Add stimulation parameters for many runs at once.
+
+        Every argument is a 1D array with one element per run. The columns
+        are validated as whole arrays and each column is extended once,
+        which is much faster than calling *add_run* in a loop. Any other
+        existing (non-ragged) column of the table must also be supplied.
+        """
+        ids = popargs('id', kwargs)
+
+        extra_columns = set(kwargs) - set(self.colnames)
+        missing_columns = set(self.colnames) - set(kwargs)
+        if extra_columns or missing_columns:
+            raise ValueError(
+                '\n'.join([
+                    'run data keys don\'t match available columns',
+                    'you supplied {} extra keys: {}'.format(
+                        len(extra_columns), extra_columns),
+                    'and were missing {} keys: {}'.format(
+                        len(missing_columns), missing_columns)
+                ])
+            )
+
+        columns, ids = _check_runs(kwargs, ids, len(self))
+        for name in columns:
+            if isinstance(self[name], VectorIndex):
+                raise ValueError("ragged column '%s' is not supported by "
+                                 "add_runs, use add_run instead" % name)
+        if len(ids) == 0:
+            return
+
+        self.__extend_column(self.id, ids)
+        for name, value in columns.items():
+            self.__extend_column(self[name], value)
+        _bind_in_file(self, self['bipolar_pair'])
+        self.__run_index = None
+        self.__bipolar_electrodes = None
+
+    def __append_run(self, row):
+        """
+        Append a run to the columns of the table through their buffers.
+        Returns False, without changing the table, if the run cannot be
+        appended this way and must go through *add_interval*, e.g. because
+        the table has ragged columns or the values do not match the columns.
+        """
+        row = dict(row)
+        row_id = row.pop('id', None)
+        if row_id is None:
+            row_id = len(self)
+        if set(row) != set(self.colnames) or not isinstance(row_id, (int, np.integer)):
+            return False
+        pair = row['bipolar_pair']
+        if not isinstance(pair, (int, np.integer)) or isinstance(pair, bool):
+            return False
+        columns = [(self.id, row_id)] + [(self[name], row[name])
+                                         for name in self.colnames]
+        if any(isinstance(column, VectorIndex) for column, _ in columns):
+            return False
+        for column, value in columns:
+            if not self.__buffers.append(column, value):
+                column.add_row(value)
+        return True
+
+    def __extend_column(self, column, values):
+        """
+        Append the array *values* to *column*, through its growable buffer if
+        it has one.
+        """
+        if not self.__buffers.extend(column, values):
+            _extend_column(column, values)
+
+    @classmethod
+    @docval(
+        {
+            'name': 'df',
+            'type': pd.DataFrame,
+            'doc': 'DataFrame with one row per stimulation run'
+        },
+        {
+            'name': 'name',
+            'type': str,
+            'doc': 'Name of this StimTable',
+            'default': 'StimTable'
+        },
+        {
+            'name': 'description',
+            'type': str,
+            'doc': 'Description of what is in this StimTable',
+            'default': 'stimulation parameters'
+        },
+        *get_docval(__init__, 'bipolar_table', 'lab_meta_data_name'),
+        {
+            'name': 'column_descriptions',
+            'type': dict,
+            'doc': 'descriptions of any additional columns in *df*, keyed '
+                   'by column name',
+            'default': None
+        }
+    )
+    def from_dataframe(cls, **kwargs):
+        """
+        Construct a StimTable from a pandas DataFrame in a single bulk insert.
+
+        Columns of *df* that are not predefined by StimTable are added as
+        new columns. If the index of *df* is named 'id', it is used for the
+        row IDs.
+        """
+        df, column_descriptions = popargs('df', 'column_descriptions', kwargs)
+        column_descriptions = column_descriptions or dict()
+        table = cls(**kwargs)
+        for colname in df.columns:
+            if colname not in table.colnames:
+                table.add_column(
+                    name=colname,
+                    description=column_descriptions.get(colname,
+                                                        'no description'))
+        ids = df.index.values if df.index.name == 'id' else None
+        table.add_runs(id=ids,
+                       **{colname: df[colname].values
+                          for colname in df.columns})
+        return table
+
+    @property
+    def run_index(self):
+        """
+        The IntervalIndex over the start and stop times of the runs.
+
+        The index is built on first use, which reads only the *start_time* and
+        *stop_time* columns, and is cached until runs are added.
+        """
+        if self.__run_index is None or len(self.__run_index) != len(self):
+            self.__run_index = IntervalIndex(self['start_time'].data[:],
+                                             self['stop_time'].data[:])
+        return self.__run_index
+
+    @docval(
+        {
+            'name': 't0',
+            'type': (int, float),
+            'doc': 'the start of the time window, in seconds'
+        },
+        {
+            'name': 't1',
+            'type': (int, float),
+            'doc': 'the end of the time window, in seconds'
+        },
+        {
+            'name': 'df',
+            'type': bool,
+            'doc': 'return the matching rows as a DataFrame instead of their '
+                   'indices',
+            'default': False
+        }
+    )
+    def runs_in_window(self, **kwargs):
+        """
+        Find the stimulation runs that overlap the time window [t0, t1].
+
+        Returns the sorted row indices of the runs, or, if *df* is True, a
+        DataFrame of only those rows.
+        """
+        t0, t1, df = popargs('t0', 't1', 'df', kwargs)
+        rows = self.run_index.overlapping(t0, t1)
+        if df:
+            return self.get(rows, df=True, index=True)
+        return rows
+
+    @docval(
+        {
+            'name': 'windows',
+            'type': 'array_data',
+            'doc': 'array of shape (n_windows, 2) with the start and end of '
+                   'each time window, in seconds'
+        }
+    )
+    def runs_in_windows(self, **kwargs):
+        """
+        Find the stimulation runs that overlap each of many time windows.
+
+        Returns a list with the sorted row indices of the runs overlapping
+        each window.
+        """
+        windows = np.asarray(popargs('windows', kwargs), dtype=float)
+        if windows.ndim != 2 or windows.shape[1] != 2:
+            raise ValueError('windows must have shape (n_windows, 2), found '
+                             '%s' % str(windows.shape))
+        return self.run_index.overlapping_many(windows[:, 0], windows[:, 1])
+
+    def get_bipolar_electrodes(self):
+        """
+        Resolve the *bipolar_pair* of every run to the electrodes of its anodes
+        and cathodes.
+
+        Returns a BipolarElectrodes with CSR-style offsets and electrode
+        indices for all runs. The result is cached until runs are added.
+        """
+        cached = self.__bipolar_electrodes
+        if cached is None or len(cached.anode_offsets) != len(self) + 1:
+            cached = resolve_bipolar_pairs(
+                self.bind_bipolar_table(),
+                get_readable_data(self['bipolar_pair'].data)[:])
+            self.__bipolar_electrodes = cached
+        return cached
+
+    @docval(
+        {
+            'name': 'bipolar_table',
+            'type': BipolarSchemeTable,
+            'doc': 'The table of bipolar electrode pairs that the '
+                   '*bipolar_pair* column indexes. Defaults to the table '
+                   'given to the constructor or, if there was none, to the '
+                   'BipolarSchemeTable of the lab metadata '
+                   '*lab_meta_data_name* of the NWBFile',
+            'default': None
+        },
+        returns='the table that the bipolar_pair column references',
+        rtype=BipolarSchemeTable
+    )
+    def bind_bipolar_table(self, **kwargs):
+        """
+        Point the *bipolar_pair* column at its BipolarSchemeTable.
+
+        The table is looked up once: a column that references a table, e.g.
+        because it was read from a file, keeps it, and the NWBFile is only
+        searched if the column references no table yet. This is done when
+        the table is written, so the StimTable may be added to the NWBFile
+        before or after its runs.
         """
-        super(StimTable, self).add_interval(**kwargs)
-        bipolar_col = self['bipolar_pair']
-        if bipolar_col.table is None:
-            if self.bipolar_table is None:
-                nwbfile = self.get_ancestor(data_type='NWBFile')
-                try:
-                    bipolar_col.table = nwbfile.lab_meta_data['ecephys_ext'].bipolar_scheme_table
-                except KeyError:
-                    warnings.warn('Reference to BipolarSchemeTable that '
-                                  'does not yet exist.')
-            else:
-                bipolar_col.table = self.bipolar_table
+        bipolar_table = popargs('bipolar_table', kwargs)
+        if bipolar_table is None:
+            bipolar_table = self.bipolar_table
+        return _bind_bipolar_table(self['bipolar_pair'], bipolar_table, self,
+                                   self.lab_meta_data_name)
+
+
+@register_class('StimOverview', 'ndx-electrical-stim')
+class StimOverview(NWBData):
+    """
+    The min/max decimation pyramid of a StimSeries waveform, with all levels
+    stored one after the other (see ndx_electrical_stim.overview).
+    """
+
+    __nwbfields__ = ('bin_size', 'factor')
+
+    @docval(
+        {
+            'name': 'name',
+            'type': str,
+            'doc': 'Name of this StimOverview',
+            'default': 'overview'
+        },
+        {
+            'name': 'data',
+            'type': ('array_data', 'data'),
+            'doc': 'the minima and maxima of all levels, of shape '
+                   '(n_bins, 2, n_pairs)'
+        },
+        {
+            'name': 'bin_size',
+            'type': int,
+            'doc': 'the number of samples per bin of the finest level'
+        },
+        {
+            'name': 'factor',
+            'type': int,
+            'doc': 'the number of bins of a level combined into each bin of '
+                   'the next level'
+        }
+    )
+    def __init__(self, **kwargs):
+        bin_size, factor = popargs('bin_size', 'factor', kwargs)
+        super(StimOverview, self).__init__(**kwargs)
+        self.bin_size = bin_size
+        self.factor = factor
+
+    def get_level(self, level, n_samples):
+        """
+        The offset of *level* in the data and its number of bins, for a
+        waveform of *n_samples* samples.
+        """
+        lengths = level_lengths(n_samples, self.bin_size, self.factor)
+        return sum(lengths[:level]), lengths[level]
 
 
 @register_class('StimSeries', 'ndx-electrical-stim')
@@ -147,6 +523,12 @@ class StimSeries(TimeSeries):
                    'stimulation waveforms.',
             'child': True
         },
+        {
+            'name': 'overview',
+            'required_name': 'overview',
+            'doc': 'min/max decimation pyramid of the waveform',
+            'child': True
+        },
     )
 
     @docval(
@@ -165,29 +547,1117 @@ class StimSeries(TimeSeries):
         },
         *get_docval(TimeSeries.__init__, 'resolution', 'conversion',
                     'timestamps', 'starting_time', 'rate', 'comments',
-                    'description', 'control', 'control_description')
+                    'description', 'control', 'control_description'),
+        {
+            'name': 'overview',
+            'type': StimOverview,
+            'doc': 'min/max decimation pyramid of the waveform. See '
+                   '*add_overview*',
+            'default': None
+        }
     )
     def __init__(self, **kwargs):
-        name, data, bipolar_electrodes = popargs('name',
-                                                 'data',
-                                                 'bipolar_electrodes',
-                                                 kwargs)
+        name, data, bipolar_electrodes, overview = popargs(
+            'name', 'data', 'bipolar_electrodes', 'overview', kwargs)
 
         super(StimSeries, self).__init__(name, data, 'amperes', **kwargs)
         self.bipolar_electrodes = bipolar_electrodes
+        self.overview = overview
+        self.__resolved_bipolar_electrodes = None
+
+    @classmethod
+    @docval(
+        {
+            'name': 'blocks',
+            'type': Iterable,
+            'doc': 'iterable or generator of waveform sample blocks, each '
+                   'of shape (n_samples, n_pairs)'
+        },
+        *get_docval(__init__, 'name', 'bipolar_electrodes'),
+        {
+            'name': 'chunk_shape',
+            'type': tuple,
+            'doc': 'HDF5 chunk shape of the waveform dataset. Defaults to '
+                   'letting h5py choose',
+            'default': None
+        },
+        {
+            'name': 'compression',
+            'type': str,
+            'doc': "compression filter to apply, 'gzip' or 'lzf'",
+            'default': 'gzip'
+        },
+        {
+            'name': 'compression_opts',
+            'type': int,
+            'doc': 'compression level for gzip (0-9)',
+            'default': None
+        },
+        {
+            'name': 'shuffle',
+            'type': bool,
+            'doc': 'whether to apply the HDF5 shuffle filter before '
+                   'compression',
+            'default': True
+        },
+        {
+            'name': 'dtype',
+            'type': (type, np.dtype, str),
+            'doc': 'dtype to write the waveform as. Defaults to the dtype '
+                   'of the first block',
+            'default': None
+        },
+        {
+            'name': 'overview_bin_size',
+            'type': int,
+            'doc': 'also write a min/max decimation pyramid of the waveform '
+                   'with this many samples per bin at its finest level, '
+                   'computed from the blocks as they are written. Defaults '
+                   'to no pyramid',
+            'default': None
+        },
+        {
+            'name': 'overview_factor',
+            'type': int,
+            'doc': 'the number of bins of a level of the pyramid combined '
+                   'into each bin of the next level',
+            'default': 8
+        },
+        *get_docval(__init__, 'resolution', 'conversion', 'timestamps',
+                    'starting_time', 'rate', 'comments', 'description',
+                    'control', 'control_description')
+    )
+    def from_blocks(cls, **kwargs):
+        """
+        Create a StimSeries whose waveform is streamed to disk block by block
+        when the file is written with NWBHDF5IO.
+
+        The waveform is written as a chunked, compressed, resizable dataset
+        and only one block is held in memory at a time. With
+        *overview_bin_size*, the bins of the pyramid are accumulated as the
+        blocks pass through and the pyramid is written after the waveform,
+        so the waveform is read only once.
+        """
+        blocks, chunk_shape, compression, compression_opts, shuffle, dtype, \
+            overview_bin_size, overview_factor = popargs(
+                'blocks', 'chunk_shape', 'compression', 'compression_opts',
+                'shuffle', 'dtype', 'overview_bin_size', 'overview_factor',
+                kwargs)
+        pyramid = None
+        if overview_bin_size is not None:
+            pyramid = PyramidBuilder(overview_bin_size, overview_factor)
+            blocks = pyramid.tap(blocks)
+        iterator = StimBlockIterator(blocks=blocks, dtype=dtype,
+                                     chunk_shape=chunk_shape)
+        if pyramid is not None:
+            shape = iterator.recommended_data_shape()
+            kwargs['overview'] = StimOverview(
+                data=PyramidIterator(pyramid, iterator.dtype,
+                                     shape[1] if len(shape) > 1 else 1),
+                bin_size=overview_bin_size, factor=overview_factor)
+        kwargs['data'] = wrap_waveform_data(iterator, chunk_shape, compression,
+                                            compression_opts, shuffle)
+        return cls(**kwargs)
+
+    def get_bipolar_electrodes(self):
+        """
+        Resolve the *bipolar_electrodes* pair of every column of the waveform
+        to the electrodes of its anodes and cathodes.
+
+        Returns a BipolarElectrodes with CSR-style offsets and electrode
+        indices for all columns. The result is cached.
+        """
+        region = self.bipolar_electrodes
+        cached = self.__resolved_bipolar_electrodes
+        if cached is None or len(cached.anode_offsets) != len(region) + 1:
+            cached = resolve_bipolar_pairs(region.table,
+                                           get_readable_data(region.data)[:])
+            self.__resolved_bipolar_electrodes = cached
+        return cached
+
+    @docval(
+        {
+            'name': 'cache_blocks',
+            'type': int,
+            'doc': 'the number of blocks of chunk rows to keep in the cache '
+                   'when the waveform cannot be memory-mapped',
+            'default': 64
+        },
+        returns='a lazily sliced view of the waveform', rtype=LazyStimData
+    )
+    def get_lazy_data(self, **kwargs):
+        """
+        Get a NumPy-compatible view of the waveform that reads only the
+        samples that are indexed, instead of loading the whole waveform.
+
+        Contiguous, uncompressed datasets are memory-mapped from the file;
+        chunked datasets are read through an LRU cache of chunk rows.
+        """
+        cache_blocks = popargs('cache_blocks', kwargs)
+        return LazyStimData(self.data, cache_blocks=cache_blocks)
+
+    @docval(
+        {
+            'name': 'bin_size',
+            'type': int,
+            'doc': 'the number of samples per bin of the finest level',
+            'default': 256
+        },
+        {
+            'name': 'factor',
+            'type': int,
+            'doc': 'the number of bins of a level combined into each bin of '
+                   'the next level',
+            'default': 8
+        },
+        returns='the pyramid', rtype=StimOverview
+    )
+    def add_overview(self, **kwargs):
+        """
+        Compute the min/max decimation pyramid of the waveform, which is
+        written with the StimSeries and used by *get_overview*.
+
+        The waveform, in memory or already written, is read block by block.
+        To compute the pyramid of a waveform that is written from blocks,
+        pass *overview_bin_size* to *from_blocks* instead.
+        """
+        bin_size, factor = popargs('bin_size', 'factor', kwargs)
+        if self.overview is not None:
+            raise ValueError('StimSeries %s already has an overview'
+                             % self.name)
+        data = self.data.data if isinstance(self.data, DataIO) else self.data
+        if isinstance(data, AbstractDataChunkIterator):
+            raise ValueError('the waveform of StimSeries %s is not written '
+                             'yet; pass overview_bin_size to from_blocks to '
+                             'compute its overview while it is written'
+                             % self.name)
+        pyramid = PyramidBuilder(bin_size, factor)
+        for _, block in self.get_lazy_data().iter_blocks():
+            pyramid.update(block)
+        self.overview = StimOverview(data=pyramid.finish().astype(
+            self._get_waveform().dtype, copy=False),
+            bin_size=bin_size, factor=factor)
+        return self.overview
+
+    @docval(
+        {
+            'name': 't0',
+            'type': (int, float),
+            'doc': 'the start of the time window, in seconds'
+        },
+        {
+            'name': 't1',
+            'type': (int, float),
+            'doc': 'the end of the time window, in seconds'
+        },
+        {
+            'name': 'n_points',
+            'type': int,
+            'doc': 'the largest number of points to return',
+            'default': 2000
+        },
+        returns='the overview of the window', rtype=WaveformOverview
+    )
+    def get_overview(self, **kwargs):
+        """
+        Get the minimum and maximum of the waveform of each pair over at most
+        *n_points* consecutive intervals of the time window [t0, t1], e.g. to
+        draw the waveform at any zoom level.
+
+        The level of the pyramid with the fewest bins that still has at least
+        *n_points* bins in the window is read, so a view reads at most about
+        *factor* x *n_points* bins, and at most *bin_size* x *n_points*
+        samples of the waveform when it is zoomed in closer than the finest
+        level. Without a pyramid (see *add_overview*) all the samples in the
+        window are read.
+        """
+        t0, t1, n_points = popargs('t0', 't1', 'n_points', kwargs)
+        if n_points < 1:
+            raise ValueError('n_points must be positive, got %d' % n_points)
+        data = self._get_waveform()
+        n_samples = data.shape[0]
+        start = min(max(int(self._time_to_index(t0, 'left')), 0), n_samples)
+        stop = min(max(int(self._time_to_index(t1, 'right')), start),
+                   n_samples)
+        overview = self.overview
+        level = None
+        if overview is not None and stop - start > n_points:
+            n_levels = len(level_lengths(n_samples, overview.bin_size,
+                                         overview.factor))
+            for k in range(n_levels):
+                k_bin_size = overview.bin_size * overview.factor ** k
+                if -(-stop // k_bin_size) - start // k_bin_size < n_points:
+                    break
+                level, bin_size = k, k_bin_size
+        if level is None:
+            # the samples themselves
+            samples = np.asarray(data[start:stop])
+            first_rows, mins, maxs = reduce_points(samples, samples, n_points)
+            indices = start + first_rows
+        else:
+            offset, _ = overview.get_level(level, n_samples)
+            first_bin = start // bin_size
+            bins = np.asarray(overview.data[offset + first_bin:
+                                            offset - (-stop // bin_size)])
+            if data.ndim == 1:
+                bins = bins[:, :, 0]
+            first_rows, mins, maxs = reduce_points(bins[:, 0], bins[:, 1],
+                                                   n_points)
+            indices = np.maximum((first_bin + first_rows) * bin_size, start)
+        return WaveformOverview(self._index_to_time(indices), mins, maxs)
+
+    def _get_waveform(self):
+        """
+        The waveform, in a form that supports slicing along the first
+        dimension.
+        """
+        return get_readable_data(self.data)
+
+    def _index_to_time(self, indices):
+        """
+        Convert sample indices to times.
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        if self.rate is not None:
+            return self.starting_time + indices / self.rate
+        timestamps = get_readable_data(self.timestamps)
+        return np.asarray(timestamps[indices]) if len(indices) else np.zeros(0)
+
+    def _time_to_index(self, times, side='left'):
+        """
+        Convert *times* to sample indices. With side='left' the result is the
+        first sample at or after each time, and with side='right' it is the
+        first sample after each time.
+        """
+        return time_to_index(self, times, side)
+
+    @docval(
+        {
+            'name': 't0',
+            'type': (int, float),
+            'doc': 'the start of the time window, in seconds'
+        },
+        {
+            'name': 't1',
+            'type': (int, float),
+            'doc': 'the end of the time window, in seconds'
+        },
+        {
+            'name': 'pairs',
+            'type': 'array_data',
+            'doc': 'the columns (bipolar pairs) to read. Defaults to all',
+            'default': None
+        },
+        {
+            'name': 'n_workers',
+            'type': int,
+            'doc': 'the number of threads to read the window with. By '
+                   'default, it is read in the calling thread',
+            'default': None
+        }
+    )
+    def get_data_in_window(self, **kwargs):
+        """
+        Read the waveform samples that fall within the time window [t0, t1].
+
+        Only the samples in the window are read from the file. With
+        *n_workers*, the window is read in parts by a pool of threads (see
+        ndx_electrical_stim.parallel).
+        """
+        t0, t1, pairs, n_workers = popargs('t0', 't1', 'pairs', 'n_workers',
+                                           kwargs)
+        data = self._get_waveform()
+        start = max(int(self._time_to_index(t0, 'left')), 0)
+        stop = max(int(self._time_to_index(t1, 'right')), start)
+        if n_workers is not None:
+            return read_parallel(data, start, stop, columns=pairs,
+                                 n_workers=n_workers)
+        if pairs is None:
+            return np.asarray(data[start:stop])
+        n_samples = max(min(stop, data.shape[0]) - start, 0)
+        segment = read_segments(data, [start], [stop], n_samples,
+                                columns=pairs)
+        return segment[0]
+
+    @docval(
+        {
+            'name': 'onsets',
+            'type': ('array_data', StimTable),
+            'doc': 'the times to align the epochs to, in seconds, or a '
+                   'StimTable to use the start times of its runs'
+        },
+        {
+            'name': 'pre',
+            'type': (int, float),
+            'doc': 'the duration of each epoch before its onset, in seconds'
+        },
+        {
+            'name': 'post',
+            'type': (int, float),
+            'doc': 'the duration of each epoch after its onset, in seconds'
+        },
+        {
+            'name': 'pairs',
+            'type': 'array_data',
+            'doc': 'the columns (bipolar pairs) to read. Defaults to all',
+            'default': None
+        },
+        {
+            'name': 'max_gap',
+            'type': int,
+            'doc': 'epochs separated by at most this many samples are read '
+                   'together in a single contiguous read',
+            'default': 0
+        },
+        {
+            'name': 'n_workers',
+            'type': int,
+            'doc': 'the number of threads to read the epochs with. By '
+                   'default, they are read in the calling thread',
+            'default': None
+        }
+    )
+    def extract_epochs(self, **kwargs):
+        """
+        Extract the waveform around many onsets at once.
+
+        Returns an array of shape (n_epochs, n_samples, n_pairs), where epoch
+        *i* covers [onsets[i] - pre, onsets[i] + post). Samples are located by
+        converting all onsets to indices at once, and overlapping or nearby
+        epochs are coalesced into a few contiguous reads. Samples outside of
+        the recording are NaN, as are the trailing samples of epochs that
+        contain fewer samples than the longest epoch, which can only happen
+        when the StimSeries has irregular timestamps.
+
+        With *n_workers*, the reads are spread over a pool of threads (see
+        *iter_epochs*).
+        """
+        onsets, pre, post, pairs, max_gap, n_workers = popargs(
+            'onsets', 'pre', 'post', 'pairs', 'max_gap', 'n_workers', kwargs)
+        data = self._get_waveform()
+        starts, stops, n_samples = self.__get_epoch_bounds(onsets, pre, post)
+        if n_workers is None:
+            return read_segments(data, starts, stops, n_samples,
+                                 columns=pairs, max_gap=max_gap)
+        # an empty read gives the shape and dtype of the epochs
+        empty = read_segments(data, starts[:0], stops[:0], n_samples,
+                              columns=pairs)
+        out = np.empty((len(starts),) + empty.shape[1:], dtype=empty.dtype)
+        for indices, epochs in iter_read_segments(
+                data, starts, stops, n_samples, columns=pairs,
+                max_gap=max_gap, n_workers=n_workers):
+            out[indices] = epochs
+        return out
+
+    @docval(
+        *get_docval(extract_epochs, 'onsets', 'pre', 'post', 'pairs',
+                    'max_gap'),
+        {
+            'name': 'n_workers',
+            'type': int,
+            'doc': 'the number of threads to read the epochs with. Defaults '
+                   'to the number of CPUs. With 0, the epochs are read in '
+                   'the calling thread',
+            'default': None
+        }
+    )
+    def iter_epochs(self, **kwargs):
+        """
+        Extract the waveform around many onsets with a pool of threads,
+        yielding the index of each epoch and its samples, of shape
+        (n_samples, n_pairs), as soon as they are read.
+
+        The epochs are the same as those of *extract_epochs*. Nearby epochs
+        are read together, in tasks of about 4 MiB of waveform, and chunks
+        of HDF5 datasets that are only deflate-compressed and/or shuffled
+        are decompressed by the threads in parallel (see
+        ndx_electrical_stim.parallel). Waveforms that cannot be read from
+        several threads, like that of a SparseStimSeries, are read in the
+        calling thread.
+        """
+        onsets, pre, post, pairs, max_gap, n_workers = popargs(
+            'onsets', 'pre', 'post', 'pairs', 'max_gap', 'n_workers', kwargs)
+        starts, stops, n_samples = self.__get_epoch_bounds(onsets, pre, post)
+        for indices, epochs in iter_read_segments(
+                self._get_waveform(), starts, stops, n_samples,
+                columns=pairs, max_gap=max_gap, n_workers=n_workers):
+            for index, epoch in zip(indices, epochs):
+                yield int(index), epoch
+
+    def __get_epoch_bounds(self, onsets, pre, post):
+        """
+        The first sample of each epoch, the sample after its last sample and
+        the number of samples of the longest epoch.
+        """
+        if isinstance(onsets, StimTable):
+            onsets = onsets['start_time'].data[:]
+        onsets = np.asarray(onsets, dtype=float)
+        starts = self._time_to_index(onsets - pre, 'left')
+        if self.rate is not None:
+            n_samples = int(round((pre + post) * self.rate))
+            stops = starts + n_samples
+        else:
+            stops = self._time_to_index(onsets + post, 'left')
+            n_samples = int(np.max(stops - starts, initial=0))
+        return starts, stops, n_samples
+
+
+@register_class('SparseStimSeries', 'ndx-electrical-stim')
+class SparseStimSeries(StimSeries):
+    """
+    A StimSeries that stores only the non-zero segments of its waveform.
+
+    *data* holds the samples of all segments one after the other,
+    *segment_starts* the first sample of each segment in the dense waveform
+    and *segment_index* the end of each segment in *data*. Every other
+    sample of the dense waveform, which has *num_dense_samples* samples at
+    a constant *rate*, is zero. The dense waveform is reconstructed lazily,
+    slice by slice, by *get_lazy_data*, and all the methods of StimSeries
+    that read the waveform see the dense waveform.
+    """
+
+    __nwbfields__ = ('segment_starts', 'segment_index', 'num_dense_samples')
+
+    @docval(
+        *get_docval(StimSeries.__init__, 'name', 'data', 'bipolar_electrodes'),
+        {
+            'name': 'segment_starts',
+            'type': 'array_data',
+            'doc': 'the first sample of each non-zero segment in the dense '
+                   'waveform, in increasing order'
+        },
+        {
+            'name': 'segment_index',
+            'type': 'array_data',
+            'doc': 'the end of each segment in *data*, i.e. the cumulative '
+                   'number of samples of the segments'
+        },
+        {
+            'name': 'num_dense_samples',
+            'type': int,
+            'doc': 'the number of samples of the dense waveform'
+        },
+        {
+            'name': 'rate',
+            'type': float,
+            'doc': 'Sampling rate in Hz'
+        },
+        *get_docval(StimSeries.__init__, 'resolution', 'conversion',
+                    'starting_time', 'comments', 'description', 'control',
+                    'control_description', 'overview')
+    )
+    def __init__(self, **kwargs):
+        segment_starts, segment_index, num_dense_samples = popargs(
+            'segment_starts', 'segment_index', 'num_dense_samples', kwargs)
+        super(SparseStimSeries, self).__init__(**kwargs)
+        self.segment_starts = segment_starts
+        self.segment_index = segment_index
+        self.num_dense_samples = num_dense_samples
+        self.__check_segments()
+
+    def __check_segments(self):
+        starts = np.asarray(get_readable_data(self.segment_starts)[:])
+        ends = np.asarray(get_readable_data(self.segment_index)[:])
+        if starts.shape != ends.shape or starts.ndim != 1:
+            raise ValueError('segment_starts and segment_index must be 1D '
+                             'with the same length, found shapes %s and %s'
+                             % (starts.shape, ends.shape))
+        lengths = np.diff(np.r_[0, ends])
+        stops = starts + lengths
+        if np.any(lengths < 0) or np.any(starts[1:] < stops[:-1]):
+            raise ValueError('the segments of SparseStimSeries %s must be in '
+                             'increasing order and must not overlap'
+                             % self.name)
+        if len(starts) and (starts[0] < 0 or stops[-1] > self.num_dense_samples):
+            raise ValueError('the segments of SparseStimSeries %s must lie '
+                             'within its %d samples'
+                             % (self.name, self.num_dense_samples))
+        data = self.data.data if isinstance(self.data, DataIO) else self.data
+        if hasattr(data, '__len__') and len(data) != (ends[-1] if len(ends) else 0):
+            raise ValueError('data of SparseStimSeries %s has %d samples, '
+                             'but its segments have %d'
+                             % (self.name, len(data),
+                                ends[-1] if len(ends) else 0))
+
+    @classmethod
+    @docval(
+        {
+            'name': 'data',
+            'type': 'array_data',
+            'doc': 'the dense waveform, of shape (n_samples, n_pairs)'
+        },
+        *get_docval(__init__, 'name', 'bipolar_electrodes', 'rate'),
+        {
+            'name': 'min_gap',
+            'type': int,
+            'doc': 'non-zero segments separated by at most this many zero '
+                   'samples are stored as one segment',
+            'default': 0
+        },
+        *get_docval(__init__, 'resolution', 'conversion', 'starting_time',
+                    'comments', 'description', 'control',
+                    'control_description')
+    )
+    def from_dense(cls, **kwargs):
+        """
+        Create a SparseStimSeries from a dense waveform, keeping only its
+        non-zero segments.
+
+        The waveform may be an HDF5 dataset: it is scanned block by block and
+        only the samples of the segments are held in memory.
+        """
+        data, min_gap = popargs('data', 'min_gap', kwargs)
+        samples, starts, index, num_samples = find_segments(data,
+                                                            min_gap=min_gap)
+        return cls(data=samples, segment_starts=starts, segment_index=index,
+                   num_dense_samples=num_samples, **kwargs)
+
+    @property
+    def num_samples(self):
+        """The number of samples of the dense waveform"""
+        return self.num_dense_samples
+
+    @docval(
+        *get_docval(StimSeries.get_lazy_data),
+        returns='a lazily reconstructed view of the dense waveform',
+        rtype=SparseStimData
+    )
+    def get_lazy_data(self, **kwargs):
+        """
+        Get a NumPy-compatible view of the dense waveform that reads only the
+        stored samples of the segments that are indexed.
+        """
+        cache_blocks = popargs('cache_blocks', kwargs)
+        return SparseStimData(self.data, self.segment_starts,
+                              self.segment_index, self.num_dense_samples,
+                              cache_blocks=cache_blocks)
+
+    def _get_waveform(self):
+        return self.get_lazy_data()
+
+
+@register_class('StimParameterTable', 'ndx-electrical-stim')
+class StimParameterTable(DynamicTable):
+    """
+    The distinct sets of stimulation parameters used by the runs of a
+    CompactStimTable, one set per row.
+    """
+
+    __columns__ = (
+        {
+            'name': 'frequency',
+            'description': 'Frequency of stimulation waveform, in Hz',
+            'required': True
+        },
+        {
+            'name': 'amplitude',
+            'description': 'Amplitude of stimulation waveform, in amperes',
+            'required': True
+        },
+        {
+            'name': 'pulse_width',
+            'description': 'Pulse width of stimulation waveform, '
+                           'in seconds/phase',
+            'required': True
+        },
+        {
+            'name': 'bipolar_pair',
+            'description': 'The bipolar pair of electrodes used with this '
+                           'parameter set.',
+            'required': True,
+            'table': True
+        }
+    )
+
+    @docval(
+        {
+            'name': 'name',
+            'type': str,
+            'doc': 'Name of this StimParameterTable',
+            'default': 'parameter_sets'
+        },
+        {
+            'name': 'description',
+            'type': str,
+            'doc': 'Description of what is in this StimParameterTable',
+            'default': 'distinct stimulation parameter sets'
+        },
+        *get_docval(DynamicTable.__init__, 'id', 'columns', 'colnames')
+    )
+    def __init__(self, **kwargs):
+        super(StimParameterTable, self).__init__(**kwargs)
+
+
+@register_class('CompactStimTable', 'ndx-electrical-stim')
+class CompactStimTable(TimeIntervals):
+    """
+    Stimulation runs whose parameters are stored once per distinct parameter
+    set.
+
+    Each distinct combination of frequency, amplitude, pulse width and
+    bipolar pair is a row of the *parameter_sets* StimParameterTable, and
+    each run holds only its start and stop time and the index of its
+    parameter set. Sessions that repeat a few parameter sets over many runs
+    are much smaller on disk this way. The parameters of the runs are
+    expanded on access by *get_parameters*, *to_dataframe* and
+    *to_stim_table*.
+    """
+
+    __fields__ = (
+        {
+            'name': 'parameter_sets',
+            'child': True
+        },
+    )
+
+    __columns__ = (
+        {
+            'name': 'start_time',
+            'description': 'Start time of stimulation, in seconds',
+            'required': True
+        },
+        {
+            'name': 'stop_time',
+            'description': 'Stop time of stimulation, in seconds',
+            'required': True
+        },
+        {
+            'name': 'parameter_set',
+            'description': 'The parameter set used for this stimulation run.',
+            'required': True,
+            'table': True
+        }
+    )
+
+    # the columns of the parameter sets, in the order of their keys
+    parameters = ('frequency', 'amplitude', 'pulse_width', 'bipolar_pair')
+
+    @docval(
+        {
+            'name': 'name',
+            'type': str,
+            'doc': 'Name of this CompactStimTable',
+            'default': 'StimTable'
+        },
+        {
+            'name': 'description',
+            'type': str,
+            'doc': 'Description of what is in this CompactStimTable',
+            'default': 'stimulation parameters'
+        },
+        {
+            'name': 'parameter_sets',
+            'type': StimParameterTable,
+            'doc': 'The distinct parameter sets that the *parameter_set* '
+                   'column indexes. Defaults to a new, empty table',
+            'default': None
+        },
+        {
+            'name': 'bipolar_table',
+            'type': BipolarSchemeTable,
+            'doc': 'The table of bipolar electrode pairs that the '
+                   '*bipolar_pair* column of the parameter sets indexes',
+            'default': None
+        },
+        *get_docval(StimTable.__init__, 'lab_meta_data_name'),
+        *get_docval(TimeIntervals.__init__, 'id', 'columns', 'colnames')
+    )
+    def __init__(self, **kwargs):
+        parameter_sets, bipolar_table, lab_meta_data_name = popargs(
+            'parameter_sets', 'bipolar_table', 'lab_meta_data_name', kwargs)
+        super(CompactStimTable, self).__init__(**kwargs)
+        if parameter_sets is None:
+            parameter_sets = StimParameterTable()
+        self.parameter_sets = parameter_sets
+        self.bipolar_table = bipolar_table
+        self.lab_meta_data_name = lab_meta_data_name
+        if bipolar_table is not None:
+            self.bind_bipolar_table(bipolar_table)
+        if self['parameter_set'].table is None:
+            self['parameter_set'].table = parameter_sets
+        # the row of each parameter set, keyed by its parameters, built on
+        # first use from the sets already in the table
+        self.__set_rows = None
+        self.__buffers = ColumnBuffers({
+            'id': 'int64',
+            'start_time': 'float64',
+            'stop_time': 'float64',
+            'parameter_set': 'int32'
+        })
+
+    @instrumented('CompactStimTable.add_run')
+    @docval(
+        *get_docval(StimTable.add_run, 'start_time', 'stop_time',
+                    'frequency', 'amplitude', 'pulse_width'),
+        {
+            'name': 'bipolar_pair',
+            'type': int,
+            'doc': 'the row of the BipolarSchemeTable used for the run',
+        },
+        {
+            'name': 'id',
+            'type': int,
+            'doc': 'the ID for the new row. Defaults to continuing the '
+                   'existing IDs',
+            'default': None
+        }
+    )
+    def add_run(self, **kwargs):
+        """
+        Add a stimulation run, adding its parameters to the parameter sets
+        if they are new.
+        """
+        row_id = popargs('id', kwargs)
+        self.__check_columns()
+        parameter_set = self.__get_parameter_set(
+            tuple(kwargs[name] for name in self.parameters))
+        if row_id is None:
+            row_id = len(self)
+        for column, value in ((self.id, row_id),
+                              (self['start_time'], kwargs['start_time']),
+                              (self['stop_time'], kwargs['stop_time']),
+                              (self['parameter_set'], parameter_set)):
+            if not self.__buffers.append(column, value):
+                column.add_row(value)
+        _bind_in_file(self, self.parameter_sets['bipolar_pair'])
+
+    @instrumented('CompactStimTable.add_runs')
+    @docval(
+        *get_docval(StimTable.add_runs, 'start_time', 'stop_time',
+                    'frequency', 'amplitude', 'pulse_width', 'bipolar_pair',
+                    'id')
+    )
+    def add_runs(self, **kwargs):
+        """
+        Add many stimulation runs at once.
+
+        Every argument is a 1D array with one element per run. The distinct
+        parameter sets of the runs are found in a single pass, new ones are
+        added to the parameter sets, and each column of the runs is extended
+        once.
+        """
+        ids = popargs('id', kwargs)
+        self.__check_columns()
+        columns, ids = _check_runs(kwargs, ids, len(self))
+        n_runs = len(ids)
+        if n_runs == 0:
+            return
+
+        # number the distinct parameter sets in the order they first appear
+        # by factorizing one parameter at a time, combined with the numbers
+        # of the previous ones, which hashes instead of sorting
+        inverse = np.zeros(n_runs, dtype=np.int64)
+        for name in self.parameters:
+            codes, values = pd.factorize(columns[name])
+            # NaN, coded -1, is a value of its own
+            codes[codes < 0] = len(values)
+            inverse, _ = pd.factorize(inverse * (len(values) + 1) + codes)
+        first = pd.Series(inverse).drop_duplicates().index
+        set_rows = np.array([
+            self.__get_parameter_set(tuple(columns[name][i].item()
+                                           for name in self.parameters))
+            for i in first], dtype=np.int32)
+
+        for column, values in ((self.id, ids),
+                               (self['start_time'], columns['start_time']),
+                               (self['stop_time'], columns['stop_time']),
+                               (self['parameter_set'],
+                                set_rows[inverse])):
+            if not self.__buffers.extend(column, values):
+                _extend_column(column, values)
+        _bind_in_file(self, self.parameter_sets['bipolar_pair'])
+
+    def __check_columns(self):
+        extra_columns = set(self.colnames) - {'start_time', 'stop_time',
+                                              'parameter_set'}
+        if extra_columns:
+            raise ValueError('runs cannot be added to CompactStimTable %s, '
+                             'which has the additional columns %s'
+                             % (self.name, sorted(extra_columns)))
+
+    def __get_parameter_set(self, key):
+        """
+        The row of the parameter set *key*, a tuple of the *parameters*,
+        adding the set to the parameter sets if it is new.
+        """
+        if self.__set_rows is None:
+            self.__set_rows = dict()
+            columns = [get_readable_data(self.parameter_sets[name].data)[:]
+                       for name in self.parameters]
+            for row, existing in enumerate(zip(*columns)):
+                self.__set_rows.setdefault(
+                    tuple(np.asarray(existing).tolist()), row)
+        row = self.__set_rows.get(key)
+        if row is None:
+            row = len(self.parameter_sets)
+            self.parameter_sets.add_row(**dict(zip(self.parameters, key)))
+            self.__set_rows[key] = row
+        return row
+
+    @classmethod
+    @docval(
+        {
+            'name': 'stim_table',
+            'type': StimTable,
+            'doc': 'the StimTable to compact'
+        },
+        {
+            'name': 'name',
+            'type': str,
+            'doc': 'Name of the CompactStimTable. Defaults to the name of '
+                   '*stim_table*',
+            'default': None
+        },
+        {
+            'name': 'description',
+            'type': str,
+            'doc': 'Description of the CompactStimTable. Defaults to the '
+                   'description of *stim_table*',
+            'default': None
+        }
+    )
+    def from_stim_table(cls, **kwargs):
+        """
+        Store the runs of a StimTable with a lookup table of their distinct
+        parameter sets. *stim_table* must have only the standard columns.
+        """
+        stim_table, name, description = popargs('stim_table', 'name',
+                                                'description', kwargs)
+        extra_columns = set(stim_table.colnames) - {'start_time', 'stop_time'} \
+            - set(cls.parameters)
+        if extra_columns:
+            raise ValueError('StimTable %s has the additional columns %s, '
+                             'which CompactStimTable does not support'
+                             % (stim_table.name, sorted(extra_columns)))
+        table = cls(name=name or stim_table.name,
+                    description=description or stim_table.description,
+                    bipolar_table=stim_table['bipolar_pair'].table,
+                    lab_meta_data_name=stim_table.lab_meta_data_name)
+        table.add_runs(
+            id=get_readable_data(stim_table.id.data)[:],
+            **{name: get_readable_data(stim_table[name].data)[:]
+               for name in ('start_time', 'stop_time') + cls.parameters})
+        return table
+
+    @docval(
+        {
+            'name': 'name',
+            'type': str,
+            'doc': 'Name of the StimTable. Defaults to the name of this '
+                   'table',
+            'default': None
+        },
+        *get_docval(StimTable.__init__, 'parameter_dtype'),
+        returns='the runs with their parameters expanded', rtype=StimTable
+    )
+    def to_stim_table(self, **kwargs):
+        """
+        Expand the runs into a StimTable with one row of parameters per run.
+        """
+        name, parameter_dtype = popargs('name', 'parameter_dtype', kwargs)
+        stim_table = StimTable(
+            name=name or self.name, description=self.description,
+            bipolar_table=self.parameter_sets['bipolar_pair'].table,
+            lab_meta_data_name=self.lab_meta_data_name,
+            parameter_dtype=parameter_dtype)
+        stim_table.add_runs(
+            id=get_readable_data(self.id.data)[:],
+            start_time=get_readable_data(self['start_time'].data)[:],
+            stop_time=get_readable_data(self['stop_time'].data)[:],
+            **{name: self.get_parameters(name) for name in self.parameters})
+        return stim_table
+
+    @docval(
+        {
+            'name': 'name',
+            'type': str,
+            'doc': "the parameter to expand: 'frequency', 'amplitude', "
+                   "'pulse_width' or 'bipolar_pair'"
+        },
+        returns='the value of the parameter for every run',
+        rtype=np.ndarray
+    )
+    def get_parameters(self, **kwargs):
+        """
+        Look up a parameter of every run in the parameter sets.
+        """
+        name = popargs('name', kwargs)
+        if name not in self.parameters:
+            raise ValueError("'%s' is not a parameter of the parameter sets, "
+                             "must be one of %s" % (name, self.parameters))
+        values = np.asarray(
+            get_readable_data(self.parameter_sets[name].data)[:])
+        rows = get_readable_data(self['parameter_set'].data)[:]
+        return values[np.asarray(rows, dtype=np.intp)]
+
+    @docval(*get_docval(DynamicTable.to_dataframe))
+    def to_dataframe(self, **kwargs):
+        """
+        Produce a pandas DataFrame with one row per run and the parameters of
+        each run expanded into the *frequency*, *amplitude*, *pulse_width*
+        and *bipolar_pair* columns, in place of *parameter_set*.
+        *bipolar_pair* holds the row of the BipolarSchemeTable.
+        """
+        exclude = set(popargs('exclude', kwargs) or ())
+        df = super(CompactStimTable, self).to_dataframe(
+            exclude=exclude | {'parameter_set'}, **kwargs)
+        for name in self.parameters:
+            if name not in exclude:
+                df[name] = self.get_parameters(name)
+        return df
+
+    @docval(*get_docval(StimTable.bind_bipolar_table),
+            returns='the table that the bipolar_pair column references',
+            rtype=BipolarSchemeTable)
+    def bind_bipolar_table(self, **kwargs):
+        """
+        Point the *bipolar_pair* column of the parameter sets at its
+        BipolarSchemeTable, once (see StimTable.bind_bipolar_table).
+        """
+        bipolar_table = popargs('bipolar_table', kwargs)
+        if bipolar_table is None:
+            bipolar_table = self.bipolar_table
+        return _bind_bipolar_table(self.parameter_sets['bipolar_pair'],
+                                   bipolar_table, self,
+                                   self.lab_meta_data_name)
+
+
+class BipolarTableNotFoundError(ValueError):
+    """
+    Raised when a *bipolar_pair* column is bound while there is no
+    BipolarSchemeTable to bind it to yet.
+    """
+
+
+@instrumented('bipolar.bind_table')
+def _bind_bipolar_table(bipolar_col, bipolar_table, container,
+                        lab_meta_data_name):
+    """
+    Point the *bipolar_pair* column *bipolar_col* of *container* at
+    *bipolar_table* or, if that is None, at the BipolarSchemeTable of the
+    lab metadata *lab_meta_data_name* of the NWBFile that *container* is in.
+    A column that already references a table keeps it. Returns the table.
+    """
+    if bipolar_col.table is not None:
+        if bipolar_table is not None and bipolar_table is not bipolar_col.table:
+            raise ValueError("the 'bipolar_pair' column of %s %s already "
+                             "references BipolarSchemeTable %s"
+                             % (container.__class__.__name__, container.name,
+                                bipolar_col.table.name))
+        return bipolar_col.table
+    if bipolar_table is None:
+        nwbfile = container.get_ancestor(data_type='NWBFile')
+        lab_meta_data = None if nwbfile is None \
+            else nwbfile.lab_meta_data.get(lab_meta_data_name)
+        bipolar_table = getattr(lab_meta_data, 'bipolar_scheme_table', None)
+        if bipolar_table is None:
+            raise BipolarTableNotFoundError(
+                "the 'bipolar_pair' column of %s %s does not reference a "
+                "BipolarSchemeTable, and there is none in the lab metadata "
+                "'%s' of its NWBFile. Pass bipolar_table to the constructor "
+                "or to bind_bipolar_table"
+                % (container.__class__.__name__, container.name,
+                   lab_meta_data_name))
+    bipolar_col.table = bipolar_table
+    return bipolar_table
+
+
+def _bind_in_file(container, bipolar_col):
+    """
+    Bind the *bipolar_pair* column *bipolar_col* of *container* if it does
+    not reference a table yet and *container* is already in an NWBFile, so
+    that the column can be used right away. If the NWBFile has no
+    BipolarSchemeTable yet, a warning is issued and the column is bound when
+    it is written.
+    """
+    if bipolar_col.table is None and container.parent is not None:
+        try:
+            container.bind_bipolar_table()
+        except BipolarTableNotFoundError:
+            warnings.warn('Reference to BipolarSchemeTable that '
+                          'does not yet exist.')
+
+
+def _check_runs(runs, ids, first_id):
+    """
+    Check the arrays of run parameters passed to *add_runs*, and return
+    them as NumPy arrays, with the times and stimulation parameters as
+    floats, along with the array of the IDs of the runs.
+
+    :param runs: the 1D array of each column, keyed by column name
+    :param ids: the IDs of the runs, or None to number them from *first_id*
+    :param first_id: the ID of the first run if *ids* is None
+    """
+    columns = {name: np.asarray(value) for name, value in runs.items()}
+    n_runs = len(columns['start_time'])
+    for name, value in columns.items():
+        if value.ndim != 1 or len(value) != n_runs:
+            raise ValueError("column '%s' must be 1D with %d elements, "
+                             "found shape %s" % (name, n_runs, value.shape))
+    for name in ('start_time', 'stop_time', 'frequency', 'amplitude',
+                 'pulse_width'):
+        if not np.issubdtype(columns[name].dtype, np.number):
+            raise ValueError("column '%s' must be numeric, found dtype %s"
+                             % (name, columns[name].dtype))
+        columns[name] = columns[name].astype(float)
+    if not np.issubdtype(columns['bipolar_pair'].dtype, np.integer):
+        raise ValueError("column 'bipolar_pair' must contain integers, "
+                         "found dtype %s" % columns['bipolar_pair'].dtype)
+    if ids is None:
+        ids = np.arange(first_id, first_id + n_runs)
+    elif len(ids) != n_runs:
+        raise ValueError("must provide same number of ids as runs")
+    return columns, np.asarray(ids)
+
+
+def _extend_column(column, values):
+    """
+    Append *values* to the data of *column* with a single extend, bypassing
+    the per-element *add_row* that VectorData subclasses fall back to.
+    """
+    if isinstance(column.data, list):
+        Data.extend(column, values.tolist())
+    elif isinstance(column.data, np.ndarray):
+        # extend_data stacks numpy arrays along a new axis, so concatenate
+        column.transform(lambda data: np.concatenate([data, values]))
+    else:
+        Data.extend(column, values)
 
 
 ## IO
 
 
+@register_map(StimParameterTable)
 @register_map(StimTable)
 class StimTableMap(DynamicTableMap):
     @DynamicTableMap.object_attr("bipolar_pair")
+    @instrumented('StimTableMap.bipolar_column')
     def bipolar_column(self, container, manager):
         ret = container.get('bipolar_pair')
-        if ret is None:
+        if ret is None or ret.table is not None:
             return ret
-        # set the electrode table if it hasn't been set yet
-        if getattr(ret, 'table', None) is None:
-            ret.table = container.get_ancestor('NWBFile').lab_meta_data['ecephys_ext'].bipolar_scheme_table
-        return ret
\ No newline at end of file
+        # bind the BipolarSchemeTable once, through the table that owns the
+        # column: the StimTable, or the CompactStimTable of the parameter sets
+        owner = container.parent if isinstance(container, StimParameterTable) \
+            else container
+        if isinstance(owner, (StimTable, CompactStimTable)):
+            owner.bind_bipolar_table()
+        else:
+            _bind_bipolar_table(ret, None, container, 'ecephys_ext')
+        return ret
+
+
+@register_map(StimSeries)
+class StimSeriesMap(TimeSeriesMap):
+    @docval(*get_docval(TimeSeriesMap.build))
+    def build(self, **kwargs):
+        """
+        Build the StimSeries with its overview after its data, so that the
+        pyramid of a waveform written from blocks is written once the
+        blocks have been consumed (see PyramidIterator).
+        """
+        builder = super().build(**kwargs)
+        overview = builder.datasets.pop('overview', None)
+        if overview is not None:
+            builder.set_dataset(overview)
+        return builder
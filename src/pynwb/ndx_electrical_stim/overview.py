@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+Min/max decimation pyramids of StimSeries waveforms, for drawing long
+waveforms at any zoom level without reading all of their samples.
+
+Level 0 of a pyramid holds the minimum and maximum of each pair over every
+*bin_size* samples of the waveform, and each following level combines
+*factor* bins of the level below, up to a level with a single bin. All
+levels are stored one after the other in one array of shape
+(n_bins, 2, n_pairs), where [:, 0] are the minima and [:, 1] the maxima. The
+number of bins of each level follows from the number of samples of the
+waveform, so no other index is stored.
+"""
+from collections import namedtuple
+
+import numpy as np
+from hdmf.data_utils import AbstractDataChunkIterator, DataChunk
+
+WaveformOverview = namedtuple('WaveformOverview', ['timestamps', 'min', 'max'])
+WaveformOverview.__doc__ = """
+A view of a waveform drawn from at most a bounded number of points: the time
+of the first sample of each point, and the minimum and maximum of the
+waveform of each pair over the samples of the point.
+"""
+
+
+def level_lengths(n_samples, bin_size, factor):
+    """
+    The number of bins of each level of the pyramid of a waveform of
+    *n_samples* samples.
+    """
+    lengths = [-(-n_samples // bin_size)]
+    while lengths[-1] > 1:
+        lengths.append(-(-lengths[-1] // factor))
+    return lengths
+
+
+class PyramidBuilder(object):
+    """
+    Compute the min/max pyramid of a waveform from its blocks of samples, one
+    block at a time.
+
+    Only the bins of level 0 are accumulated while the blocks are consumed;
+    the other levels are computed from them by *finish*.
+    """
+
+    def __init__(self, bin_size, factor):
+        if bin_size < 1 or factor < 2:
+            raise ValueError('the pyramid bin_size must be at least 1 and its '
+                             'factor at least 2, got %d and %d'
+                             % (bin_size, factor))
+        self.bin_size = bin_size
+        self.factor = factor
+        self.__bins = list()
+        self.__carry = None
+        self.__n_blocks = 0
+        self.__finished = False
+        self.__pyramid = None
+
+    @property
+    def finished(self):
+        """Whether all the blocks of the waveform have been consumed"""
+        return self.__finished
+
+    @property
+    def n_blocks(self):
+        """The number of blocks added so far"""
+        return self.__n_blocks
+
+    def update(self, block):
+        """
+        Add the next block of samples, of shape (n_samples,) or
+        (n_samples, n_pairs).
+        """
+        block = np.asarray(block)
+        block = block.reshape(len(block), -1)
+        self.__n_blocks += 1
+        if self.__carry is not None:
+            block = np.concatenate([self.__carry, block])
+        n_full = len(block) - len(block) % self.bin_size
+        if n_full:
+            # reduceat is much faster than reducing the middle axis of a
+            # (n_bins, bin_size, n_pairs) view
+            starts = np.arange(0, n_full, self.bin_size)
+            self.__bins.append(np.stack([
+                np.minimum.reduceat(block[:n_full], starts, axis=0),
+                np.maximum.reduceat(block[:n_full], starts, axis=0)], axis=1))
+        self.__carry = block[n_full:]
+
+    def tap(self, blocks):
+        """
+        Iterate over *blocks*, adding each block to the pyramid as it passes
+        through, and finish the pyramid once they are exhausted.
+        """
+        for block in blocks:
+            block = np.asarray(block)
+            self.update(block)
+            yield block
+        self.__finished = True
+
+    def finish(self):
+        """
+        The pyramid of all the blocks added so far, as one array of shape
+        (n_bins, 2, n_pairs).
+        """
+        self.__finished = True
+        if self.__pyramid is not None:
+            return self.__pyramid
+        if self.__carry is not None and len(self.__carry):
+            self.__bins.append(np.stack([self.__carry.min(axis=0),
+                                         self.__carry.max(axis=0)])[None])
+        n_pairs = self.__carry.shape[1] if self.__carry is not None else 1
+        levels = [np.concatenate(self.__bins) if self.__bins
+                  else np.zeros((0, 2, n_pairs))]
+        while len(levels[-1]) > 1:
+            below = levels[-1]
+            starts = np.arange(0, len(below), self.factor)
+            levels.append(np.stack([
+                np.minimum.reduceat(below[:, 0], starts, axis=0),
+                np.maximum.reduceat(below[:, 1], starts, axis=0)], axis=1))
+        self.__pyramid = np.concatenate(levels)
+        return self.__pyramid
+
+
+class PyramidIterator(AbstractDataChunkIterator):
+    """
+    Write the pyramid of a waveform that is itself written from an iterator,
+    once that iterator is exhausted.
+
+    The StimSeries mapper places the pyramid after the waveform in the
+    builder, so HDF5IO writes it once the waveform is written or, with
+    exhaust_dci=False, in turns with the waveform. Until the waveform has
+    been written, this iterator returns empty chunks, which keeps it in the
+    queue without writing anything, as long as the waveform advances
+    between its turns.
+    """
+
+    def __init__(self, builder, dtype, n_pairs):
+        self.__builder = builder
+        self.__dtype = np.dtype(dtype)
+        self.__n_pairs = n_pairs
+        self.__done = False
+        self.__last_n_blocks = None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.__done:
+            raise StopIteration
+        if not self.__builder.finished:
+            if self.__builder.n_blocks == self.__last_n_blocks:
+                raise ValueError('the pyramid cannot be written because its '
+                                 'waveform is not being written')
+            self.__last_n_blocks = self.__builder.n_blocks
+            return DataChunk(
+                data=np.zeros((0, 2, self.__n_pairs), dtype=self.__dtype),
+                selection=(slice(0, 0), slice(0, 2), slice(0, self.__n_pairs)))
+        self.__done = True
+        pyramid = self.__builder.finish().astype(self.__dtype, copy=False)
+        return DataChunk(data=pyramid,
+                         selection=(slice(0, len(pyramid)), slice(0, 2),
+                                    slice(0, self.__n_pairs)))
+
+    next = __next__
+
+    def recommended_chunk_shape(self):
+        return None
+
+    def recommended_data_shape(self):
+        return (0, 2, self.__n_pairs)
+
+    @property
+    def dtype(self):
+        return self.__dtype
+
+    @property
+    def maxshape(self):
+        return (None, 2, self.__n_pairs)
+
+
+def reduce_points(mins, maxs, n_points):
+    """
+    Combine consecutive rows of *mins* and *maxs* into at most *n_points*
+    rows. Returns the index of the first row of each group and the minima
+    and maxima of the groups.
+    """
+    n_rows = len(mins)
+    if n_rows <= n_points:
+        return np.arange(n_rows), mins, maxs
+    starts = np.unique(np.arange(n_points) * n_rows // n_points)
+    return (starts, np.minimum.reduceat(mins, starts, axis=0),
+            np.maximum.reduceat(maxs, starts, axis=0))
@@ -0,0 +1,320 @@
+# -*- coding: utf-8 -*-
+"""
+Reading many parts of a StimSeries waveform with a pool of threads.
+
+h5py serializes every call into the HDF5 library, so threads that read a
+compressed dataset through h5py decompress its chunks one at a time.
+*ChunkedStimData* reads the raw, still compressed chunks of datasets whose
+only filters are shuffle and/or deflate, which is quick, and undoes the
+filters itself with zlib and NumPy, which release the GIL, so that the
+chunks read by different threads are decompressed in parallel.
+"""
+import os
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import h5py
+import numpy as np
+
+from .data_utils import read_segments
+
+# the filter pipelines, in the order they are applied on write, that
+# ChunkedStimData can undo itself
+_DIRECT_PIPELINES = {
+    (),
+    (h5py.h5z.FILTER_SHUFFLE,),
+    (h5py.h5z.FILTER_DEFLATE,),
+    (h5py.h5z.FILTER_SHUFFLE, h5py.h5z.FILTER_DEFLATE),
+}
+# target number of bytes of waveform read by each task
+_TASK_BYTES = 4 * 1024 ** 2
+
+
+class ChunkedStimData(object):
+    """
+    A NumPy-compatible view of a chunked HDF5 waveform that decodes its
+    chunks outside of the HDF5 library, so that it can be read from several
+    threads at once.
+
+    Only slices of rows with a step of 1, optionally followed by a column
+    index, are decoded directly. Other keys, datasets with any other filter
+    pipeline than shuffle, deflate or shuffle then deflate, and chunks that
+    do not decode to the chunk size, are read through h5py.
+    """
+
+    def __init__(self, dset):
+        self.__dset = dset
+        plist = dset.id.get_create_plist()
+        # the filters in the order they are applied on write
+        self.__filters = tuple(plist.get_filter(i)[0]
+                               for i in range(plist.get_nfilters()))
+        self.__direct = (dset.chunks is not None
+                         and self.__filters in _DIRECT_PIPELINES
+                         and dset.dtype.kind in 'biuf')
+        if self.__direct:
+            self.__chunk_bytes = (int(np.prod(dset.chunks, dtype=np.int64))
+                                  * dset.dtype.itemsize)
+        # the chunks of the last read of each thread, which the next read of
+        # the thread often starts in
+        self.__local = threading.local()
+
+    @property
+    def is_direct(self):
+        """Whether chunks are decoded outside of the HDF5 library"""
+        return self.__direct
+
+    @property
+    def shape(self):
+        return self.__dset.shape
+
+    @property
+    def dtype(self):
+        return self.__dset.dtype
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None):
+        return np.asarray(self[:], dtype=dtype)
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        time_key, rest = key[0], key[1:]
+        if not self.__direct or not isinstance(time_key, slice) or len(rest) > 1:
+            return self.__dset[key]
+        start, stop, step = time_key.indices(len(self))
+        if step != 1:
+            return self.__dset[key]
+        stop = max(start, stop)
+        if self.ndim == 1:
+            return self.__read(start, stop, [0])
+        column_chunk = self.__dset.chunks[1]
+        columns = np.arange(self.shape[1])[rest[0] if rest else slice(None)]
+        out = self.__read(start, stop,
+                          np.unique(np.atleast_1d(columns) // column_chunk)
+                          * column_chunk)
+        return out[:, columns] if rest else out
+
+    def __read(self, start, stop, column_offsets):
+        """
+        Rows *start* to *stop* of the chunks that begin at the column
+        *column_offsets*. Other columns are left uninitialized.
+        """
+        out = np.empty((stop - start,) + self.shape[1:], dtype=self.dtype)
+        row_chunk = self.__dset.chunks[0]
+        last_chunks = getattr(self.__local, 'chunks', dict())
+        chunks = dict()
+        for row_offset in range(start - start % row_chunk, stop, row_chunk):
+            first = max(start, row_offset)
+            last = min(stop, row_offset + row_chunk)
+            for column_offset in column_offsets:
+                offset = (row_offset,) if self.ndim == 1 \
+                    else (row_offset, column_offset)
+                chunk = last_chunks.get(offset)
+                if chunk is None:
+                    chunk = self.__decode(offset)
+                chunks[offset] = chunk
+                chunk = chunk[first - row_offset:last - row_offset]
+                if self.ndim == 1:
+                    out[first - start:last - start] = chunk
+                else:
+                    out[first - start:last - start,
+                        column_offset:column_offset + chunk.shape[1]] = \
+                        chunk[:, :self.shape[1] - column_offset]
+        self.__local.chunks = chunks
+        return out
+
+    def __decode(self, offset):
+        """
+        The chunk that begins at *offset*, as an array of the chunk shape.
+        """
+        try:
+            filter_mask, raw = self.__dset.id.read_direct_chunk(offset)
+        except RuntimeError:
+            # the chunk was never written
+            return np.full(self.__dset.chunks, self.__dset.fillvalue,
+                           dtype=self.dtype)
+        try:
+            raw = self.__unfilter(raw, filter_mask)
+        except zlib.error:
+            raw = None
+        if raw is None or len(raw) != self.__chunk_bytes:
+            return self.__read_chunk(offset)
+        return np.frombuffer(raw, dtype=self.dtype).reshape(self.__dset.chunks)
+
+    def __unfilter(self, raw, filter_mask):
+        """
+        The bytes of a chunk read with *read_direct_chunk*, or None if they
+        cannot be decoded here.
+        """
+        # undo the filters in reverse order, skipping those that the mask
+        # says were not applied to this chunk
+        for i in reversed(range(len(self.__filters))):
+            if filter_mask & (1 << i):
+                continue
+            if self.__filters[i] == h5py.h5z.FILTER_DEFLATE:
+                raw = zlib.decompress(raw)
+            elif len(raw) != self.__chunk_bytes:
+                return None
+            else:
+                # the shuffled chunk holds the first byte of every value,
+                # then the second byte of every value, etc. Copying one byte
+                # at a time is much faster than copying the transpose
+                planes = np.frombuffer(raw, dtype=np.uint8).reshape(
+                    self.dtype.itemsize, -1)
+                values = np.empty(planes.shape[::-1], dtype=np.uint8)
+                for byte, plane in enumerate(planes):
+                    values[:, byte] = plane
+                raw = values.ravel()
+        return raw
+
+    def __read_chunk(self, offset):
+        """
+        The chunk that begins at *offset* read through h5py, padded with the
+        fill value where it extends past the dataset.
+        """
+        chunk = np.full(self.__dset.chunks, self.__dset.fillvalue,
+                        dtype=self.dtype)
+        key = tuple(slice(o, min(o + c, n)) for o, c, n
+                    in zip(offset, self.__dset.chunks, self.shape))
+        chunk[tuple(slice(0, k.stop - k.start) for k in key)] = self.__dset[key]
+        return chunk
+
+
+def get_parallel_data(data):
+    """
+    Return *data* in a form that can be read from several threads at once,
+    or None if it cannot be.
+    """
+    if isinstance(data, h5py.Dataset):
+        return ChunkedStimData(data) if data.chunks is not None else data
+    if isinstance(data, np.ndarray):
+        return data
+    return None
+
+
+def iter_read_segments(data, starts, stops, n_samples, columns=None,
+                       fill_value=np.nan, max_gap=0, n_workers=None,
+                       task_rows=None):
+    """
+    Read the segments data[starts[i]:stops[i]] with a pool of threads, like
+    *read_segments*, yielding them in the order in which they are read.
+
+    The segments are sorted by start and split into tasks that each read at
+    most about *task_rows* rows, and each task is read with *read_segments*
+    by one of the threads. Data that cannot be read from several threads at
+    once (see *get_parallel_data*) is read in the calling thread.
+
+    Yields the indices of the segments read by a task and the array of
+    shape (n_task_segments, n_samples, n_columns) of their samples.
+
+    :param data: array or h5py.Dataset with time on the first dimension
+    :param starts: the first sample of each segment, may be negative
+    :param stops: the sample after the last sample of each segment
+    :param n_samples: the number of samples per output segment
+    :param columns: indices of the columns to read. Defaults to all columns
+    :param fill_value: the value of samples missing from the data
+    :param max_gap: the largest gap, in samples, between segments that are
+                    still read together
+    :param n_workers: the number of threads. Defaults to the number of CPUs.
+                      With 0, the segments are read in the calling thread
+    :param task_rows: the number of rows read by each task. Defaults to about
+                      4 MiB of waveform
+    """
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    if n_workers < 0:
+        raise ValueError('n_workers must be non-negative, got %d' % n_workers)
+    starts = np.asarray(starts, dtype=np.int64)
+    stops = np.minimum(np.asarray(stops, dtype=np.int64), starts + n_samples)
+    parallel_data = get_parallel_data(data)
+    if parallel_data is None:
+        n_workers = 0
+    else:
+        data = parallel_data
+    if task_rows is None:
+        row_bytes = int(np.prod(data.shape[1:], dtype=np.int64)) * data.dtype.itemsize
+        task_rows = max(1, _TASK_BYTES // max(1, row_bytes))
+
+    def read_task(task):
+        return task, read_segments(data, starts[task], stops[task], n_samples,
+                                   columns=columns, fill_value=fill_value,
+                                   max_gap=max_gap)
+
+    tasks = _split_tasks(starts, stops, task_rows)
+    if n_workers == 0 or len(tasks) < 2:
+        for task in tasks:
+            yield read_task(task)
+        return
+    executor = ThreadPoolExecutor(max_workers=min(n_workers, len(tasks)))
+    futures = [executor.submit(read_task, task) for task in tasks]
+    try:
+        for future in as_completed(futures):
+            yield future.result()
+    finally:
+        # stop reading if the caller stops iterating early
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+
+def read_parallel(data, start, stop, columns=None, n_workers=None):
+    """
+    Read the rows *start* to *stop* of *data* with a pool of threads, in
+    parts of about 4 MiB.
+
+    :param data: array or h5py.Dataset with time on the first dimension
+    :param start: the first row to read
+    :param stop: the row after the last row to read
+    :param columns: indices of the columns to read. Defaults to all columns
+    :param n_workers: the number of threads. Defaults to the number of CPUs
+    """
+    stop = max(min(stop, data.shape[0]), start)
+    row_bytes = int(np.prod(data.shape[1:], dtype=np.int64)) * data.dtype.itemsize
+    part_rows = max(1, _TASK_BYTES // max(1, row_bytes))
+    part_starts = np.arange(start, stop, part_rows)
+    parts = iter_read_segments(data, part_starts, part_starts + part_rows,
+                               part_rows, columns=columns,
+                               n_workers=n_workers, task_rows=part_rows)
+    out = None
+    for indices, segments in parts:
+        if out is None:
+            out = np.empty((stop - start,) + segments.shape[2:],
+                           dtype=segments.dtype)
+        for index, segment in zip(indices, segments):
+            part_start = part_starts[index] - start
+            out[part_start:part_start + part_rows] = \
+                segment[:stop - start - part_start]
+    if out is None:
+        return read_segments(data, [start], [stop], 0, columns=columns)[0]
+    if data.ndim == 1 and columns is None:
+        return out[:, 0]
+    return out
+
+
+def _split_tasks(starts, stops, task_rows):
+    """
+    Split the segments, sorted by start, into groups whose reads span at
+    most *task_rows* rows, or a single segment if it is longer.
+    """
+    order = np.argsort(starts, kind='stable')
+    tasks = list()
+    begin = 0
+    task_start = starts[order[0]] if len(order) else 0
+    task_stop = task_start
+    for i, segment in enumerate(order):
+        if i > begin and max(task_stop, stops[segment]) - task_start > task_rows:
+            tasks.append(order[begin:i])
+            begin = i
+            task_start = starts[segment]
+            task_stop = task_start
+        task_stop = max(task_stop, stops[segment])
+    if len(order):
+        tasks.append(order[begin:])
+    return tasks
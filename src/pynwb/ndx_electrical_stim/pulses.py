@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+Thresholding of StimSeries waveforms into pulses and conversion of sample
+indices to times, shared by run detection, run summaries and artifact
+removal.
+"""
+import numpy as np
+
+from .data_utils import get_readable_data
+
+
+def get_default_threshold(data):
+    """
+    The default threshold of a waveform, above which a sample is part of a
+    pulse: half of its largest absolute value, or 0 if it is empty. The
+    waveform is read once.
+
+    :param data: the LazyStimData of a StimSeries
+    """
+    return 0.5 * float(data.abs_max().max()) if len(data) else 0.
+
+
+def get_rate(stim_series):
+    """
+    The sampling rate of a TimeSeries, such as a StimSeries or an
+    ElectricalSeries, or the inverse of the median interval between its
+    timestamps.
+    """
+    if stim_series.rate is not None:
+        return stim_series.rate
+    timestamps = np.asarray(get_readable_data(stim_series.timestamps)[:],
+                            dtype=float)
+    intervals = np.diff(timestamps)
+    return 1. / np.median(intervals) if len(intervals) else 1.
+
+
+class PhaseTracker(object):
+    """
+    Find the phases of the waveform of one pair, one block at a time, carrying
+    the phase that is open at the end of each block over to the next.
+    """
+
+    def __init__(self, threshold):
+        self.__threshold = threshold
+        self.__sign = 0         # the sign of the last sample seen
+        self.__open_start = 0   # the first sample of the open segment
+        self.__open_peak = 0.
+        self.__open_before = 0  # the sign before the open segment
+        self.__phases = list()
+
+    def consume(self, x, offset):
+        """
+        Process the samples *x*, the first of which is sample *offset*.
+        """
+        if not len(x):
+            return
+        absolute = np.abs(x)
+        sign = (np.sign(x) * (absolute > self.__threshold)).astype(np.int8)
+        # the first sample of every segment of constant sign in this block
+        changes = np.flatnonzero(sign[1:] != sign[:-1]) + 1
+        starts = np.r_[0, changes]
+        peaks = np.maximum.reduceat(absolute, starts)
+        signs = sign[starts]
+        before = np.r_[self.__sign, signs[:-1]]
+        global_starts = starts + offset
+        if signs[0] != self.__sign and self.__sign != 0:
+            # the open phase ended with the previous block
+            self.__phases.append(np.array([
+                [self.__open_start], [offset], [self.__open_peak],
+                [self.__open_before], [signs[0]]]))
+        if signs[0] == self.__sign:
+            # the first segment continues the open one
+            global_starts[0] = self.__open_start
+            peaks[0] = max(peaks[0], self.__open_peak)
+            before[0] = self.__open_before
+        ends = np.r_[global_starts[1:], offset + len(x)]
+        after = np.r_[signs[1:], 0]
+        closed = signs[:-1] != 0
+        self.__phases.append(np.stack([
+            global_starts[:-1][closed], ends[:-1][closed], peaks[:-1][closed],
+            before[:-1][closed], after[:-1][closed]]))
+        self.__sign = signs[-1]
+        self.__open_start = global_starts[-1]
+        self.__open_peak = peaks[-1]
+        self.__open_before = before[-1]
+
+    def finish(self, n_samples):
+        """
+        Close the open phase at the end of the data and return the starts,
+        ends, peaks and the signs before and after of all phases.
+        """
+        if self.__sign != 0:
+            self.__phases.append(np.array([
+                [self.__open_start], [n_samples], [self.__open_peak],
+                [self.__open_before], [0]]))
+            self.__sign = 0
+        if not self.__phases:
+            return np.empty((5, 0))
+        return np.concatenate(self.__phases, axis=1)
+
+
+class SampleTimes(object):
+    """
+    Convert sample indices of a StimSeries to times.
+    """
+
+    def __init__(self, stim_series, n_samples):
+        if stim_series.rate is not None:
+            self.__timestamps = None
+            self.__starting_time = stim_series.starting_time
+            self.rate = stim_series.rate
+        else:
+            self.__timestamps = np.asarray(
+                get_readable_data(stim_series.timestamps)[:n_samples],
+                dtype=float)
+            intervals = np.diff(self.__timestamps)
+            self.rate = 1. / np.median(intervals) if len(intervals) else 1.
+
+    def __call__(self, index):
+        if self.__timestamps is None:
+            return self.__starting_time + np.asarray(index) / self.rate
+        return self.__timestamps[np.asarray(index, dtype=np.int64)]
@@ -0,0 +1,546 @@
+# -*- coding: utf-8 -*-
+"""
+Hand StimSeries waveform blocks from one process to others through a ring
+buffer in shared memory, e.g. from the acquisition process of a real-time rig
+to its analysis and decoder processes.
+
+A single producer writes samples into a StimRingBuffer, by itself or through
+a StimSeriesAppender, and any number of consumers attach to it by name with a
+StimRingReader and read the samples in place, without copying or pickling
+them. The segment also holds the metadata of the StimSeries: the bipolar pair
+and electrodes of every column and its time base, so consumers need nothing
+but the name of the buffer.
+
+The producer never waits for the consumers: once the buffer is full, the
+oldest samples are overwritten. A consumer that falls more than *capacity*
+samples behind skips the overwritten samples and counts them as lost, and
+the samples of a block it read stay valid until the producer comes round
+again, which *is_intact* checks.
+
+The header counters are published like a sequence lock: the producer raises
+the reserved count before it overwrites samples and the written count only
+after the samples are in place, with a memory barrier between the stores, and
+consumers load them with barriers in the opposite order. A buffer supports a
+single producer, writing from one thread, only; concurrent writers would race
+on the counters.
+"""
+import json
+import sys
+import threading
+import time
+from collections import namedtuple
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+from hdmf.utils import docval, getargs
+
+from .bipolar import BipolarElectrodes
+from .data_utils import get_readable_data
+from .ndx_electrical_stim import StimSeries
+
+# the int64 fields of the header, at the start of the segment
+_MAGIC, _METADATA_BYTES, _WRITTEN, _RESERVED, _CLOSED = range(5)
+_HEADER_BYTES = 64
+_MAGIC_VALUE = 0x474e4952_4d495453   # 'STIMRING'
+# the arrays of the segment are aligned to cache lines
+_ALIGNMENT = 64
+# acquiring and releasing a lock is a full memory barrier
+_BARRIER = threading.Lock()
+
+RingBlock = namedtuple('RingBlock', ['start', 'data', 'timestamps'])
+RingBlock.__doc__ = """
+Consecutive samples read from a StimRingBuffer: the index in the StimSeries
+of the first sample, the samples, of shape (n_samples, n_pairs), and their
+timestamps, or None if the StimSeries has a rate. *data* and *timestamps*
+are views of the shared memory.
+"""
+
+
+class StimRingBuffer(object):
+    """
+    The producer side of a ring buffer of StimSeries samples in shared
+    memory. A buffer has a single producer, which must write from one thread
+    at a time.
+    """
+
+    @docval(
+        {
+            'name': 'stim_series',
+            'type': StimSeries,
+            'doc': 'the StimSeries whose samples are handed over. Its dtype, '
+                   'bipolar_electrodes and time base are stored with the '
+                   'samples'
+        },
+        {
+            'name': 'capacity',
+            'type': int,
+            'doc': 'the number of samples the buffer holds'
+        },
+        {
+            'name': 'name',
+            'type': str,
+            'doc': 'the name of the shared memory segment. Defaults to a '
+                   'unique name',
+            'default': None
+        },
+        {
+            'name': 'first_sample',
+            'type': int,
+            'doc': 'the index in the StimSeries of the first sample written to '
+                   'the buffer. Defaults to the number of samples of the '
+                   'StimSeries',
+            'default': None
+        }
+    )
+    def __init__(self, **kwargs):
+        stim_series, capacity, name, first_sample = getargs(
+            'stim_series', 'capacity', 'name', 'first_sample', kwargs)
+        if capacity < 1:
+            raise ValueError('capacity must be positive, got %d' % capacity)
+        data = get_readable_data(stim_series.data)
+        if first_sample is None:
+            first_sample = len(data)
+        region = stim_series.bipolar_electrodes
+        electrodes = stim_series.get_bipolar_electrodes()
+        metadata = dict(
+            stim_series=stim_series.name,
+            dtype=np.dtype(data.dtype).str,
+            n_pairs=len(region),
+            capacity=capacity,
+            rate=stim_series.rate,
+            starting_time=stim_series.starting_time,
+            has_timestamps=stim_series.timestamps is not None,
+            first_sample=first_sample,
+            bipolar_table=region.table.name,
+            pairs=np.asarray(get_readable_data(region.data)[:]).tolist(),
+            **{field: np.asarray(values).tolist()
+               for field, values in zip(electrodes._fields, electrodes)})
+        encoded = json.dumps(metadata).encode()
+        layout = _Layout(metadata, len(encoded))
+        self.__shm = _open_untracked(name, create=True, size=layout.size)
+        self.__header, self.__timestamps, self.__data = layout.views(self.__shm)
+        self.__shm.buf[_HEADER_BYTES:_HEADER_BYTES + len(encoded)] = encoded
+        self.__header[_METADATA_BYTES] = len(encoded)
+        self.__header[_MAGIC] = _MAGIC_VALUE
+        self.__capacity = capacity
+        self.__first_sample = first_sample
+        self.__written = 0
+
+    @property
+    def name(self):
+        """The name of the shared memory segment, to attach readers to"""
+        return self.__shm.name
+
+    @property
+    def capacity(self):
+        """The number of samples the buffer holds"""
+        return self.__capacity
+
+    @property
+    def n_pairs(self):
+        """The number of columns of the samples"""
+        return self.__data.shape[1]
+
+    @property
+    def dtype(self):
+        """The dtype of the samples"""
+        return self.__data.dtype
+
+    @property
+    def has_timestamps(self):
+        """Whether a timestamp is written with every sample"""
+        return self.__timestamps is not None
+
+    @property
+    def first_sample(self):
+        """The index in the StimSeries of the first sample written"""
+        return self.__first_sample
+
+    @property
+    def n_written(self):
+        """The number of samples written so far"""
+        return self.__written
+
+    @docval(
+        {
+            'name': 'samples',
+            'type': 'array_data',
+            'doc': 'waveform samples of shape (n_samples, n_pairs)'
+        },
+        {
+            'name': 'timestamps',
+            'type': 'array_data',
+            'doc': 'timestamps of the samples, required if the StimSeries '
+                   'uses timestamps instead of a rate',
+            'default': None
+        }
+    )
+    def write(self, **kwargs):
+        """
+        Write a block of samples, overwriting the oldest samples once the
+        buffer is full.
+        """
+        samples, timestamps = getargs('samples', 'timestamps', kwargs)
+        samples = np.asarray(samples)
+        if samples.ndim != 2 or samples.shape[1] != self.n_pairs:
+            raise ValueError('samples must have shape (n_samples, %d), found '
+                             '%s' % (self.n_pairs, str(samples.shape)))
+        if (timestamps is None) != (self.__timestamps is None):
+            raise ValueError('timestamps must be given if and only if the '
+                             'StimSeries uses timestamps')
+        if timestamps is not None:
+            timestamps = np.asarray(timestamps)
+            if timestamps.shape != samples.shape[:1]:
+                raise ValueError('found %d timestamps for %d samples'
+                                 % (len(timestamps), len(samples)))
+        n = len(samples)
+        start = self.__written
+        # readers check the reserved count to tell whether the samples they
+        # read were overwritten while they used them
+        self.__header[_RESERVED] = start + n
+        _memory_barrier()
+        if n > self.__capacity:
+            samples = samples[-self.__capacity:]
+            timestamps = timestamps[-self.__capacity:] \
+                if timestamps is not None else None
+            start += n - self.__capacity
+        for ring_slice, block_slice in _ring_slices(start, len(samples),
+                                                    self.__capacity):
+            self.__data[ring_slice] = samples[block_slice]
+            if timestamps is not None:
+                self.__timestamps[ring_slice] = timestamps[block_slice]
+        self.__written += n
+        # publish the samples only once they are all in place
+        _memory_barrier()
+        self.__header[_WRITTEN] = self.__written
+
+    def close(self):
+        """
+        Tell the readers that no more samples will be written, and release
+        the shared memory. Readers that are attached can still read the
+        samples that were written.
+        """
+        if self.__shm is None:
+            return
+        self.__header[_CLOSED] = 1
+        self.__header = self.__timestamps = self.__data = None
+        self.__shm.close()
+        _unlink_untracked(self.__shm)
+        self.__shm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class StimRingReader(object):
+    """
+    A consumer of the samples of a StimRingBuffer, possibly in another
+    process.
+    """
+
+    @docval(
+        {
+            'name': 'name',
+            'type': str,
+            'doc': 'the name of the StimRingBuffer to read'
+        },
+        {
+            'name': 'poll_interval',
+            'type': float,
+            'doc': 'the number of seconds to sleep between checks for new '
+                   'samples while waiting for them',
+            'default': 1e-4
+        }
+    )
+    def __init__(self, **kwargs):
+        name, poll_interval = getargs('name', 'poll_interval', kwargs)
+        self.__shm = _open_untracked(name)
+        header = np.ndarray(_HEADER_BYTES // 8, dtype=np.int64,
+                            buffer=self.__shm.buf)
+        if header[_MAGIC] != _MAGIC_VALUE:
+            header = None
+            self.__shm.close()
+            raise ValueError("shared memory '%s' is not a StimRingBuffer"
+                             % name)
+        encoded = bytes(self.__shm.buf[_HEADER_BYTES:
+                                       _HEADER_BYTES + header[_METADATA_BYTES]])
+        self.__metadata = json.loads(encoded)
+        self.__header, self.__timestamps, self.__data = _Layout(
+            self.__metadata, len(encoded)).views(self.__shm)
+        self.__capacity = self.__metadata['capacity']
+        self.__poll_interval = poll_interval
+        self.__position = 0
+        self.__lost = 0
+
+    @property
+    def stim_series(self):
+        """The name of the StimSeries whose samples are handed over"""
+        return self.__metadata['stim_series']
+
+    @property
+    def pairs(self):
+        """The bipolar pair of every column, as rows of the BipolarSchemeTable"""
+        return np.asarray(self.__metadata['pairs'], dtype=np.int64)
+
+    @property
+    def bipolar_table(self):
+        """The name of the BipolarSchemeTable of the pairs"""
+        return self.__metadata['bipolar_table']
+
+    @property
+    def bipolar_electrodes(self):
+        """The anode and cathode electrodes of every column"""
+        return BipolarElectrodes(*(
+            np.asarray(self.__metadata[field], dtype=np.int64)
+            for field in BipolarElectrodes._fields))
+
+    @property
+    def rate(self):
+        """The sampling rate, or None if samples have timestamps"""
+        return self.__metadata['rate']
+
+    @property
+    def starting_time(self):
+        """The time of the first sample of the StimSeries, if it has a rate"""
+        return self.__metadata['starting_time']
+
+    @property
+    def capacity(self):
+        """The number of samples the buffer holds"""
+        return self.__capacity
+
+    @property
+    def n_lost(self):
+        """The number of samples overwritten before they could be read"""
+        return self.__lost
+
+    @property
+    def position(self):
+        """The index in the StimSeries of the next sample to read"""
+        return self.__metadata['first_sample'] + self.__position
+
+    @property
+    def closed(self):
+        """Whether the producer closed the buffer and every sample was read"""
+        return (self.__header[_CLOSED] == 1
+                and self.__position == self.__header[_WRITTEN])
+
+    @docval(
+        {
+            'name': 'max_samples',
+            'type': int,
+            'doc': 'the largest number of samples to read. Defaults to all '
+                   'the samples that are available',
+            'default': None
+        },
+        {
+            'name': 'timeout',
+            'type': float,
+            'doc': 'the number of seconds to wait for samples if none are '
+                   'available',
+            'default': 0.
+        },
+        returns='the samples read, which may be none', rtype=RingBlock
+    )
+    def read(self, **kwargs):
+        """
+        Read the next samples, as views of the shared memory.
+
+        A single read returns the samples up to the end of the ring at most,
+        so that they are contiguous; the next read returns the rest. The
+        samples can be overwritten by the producer once it has written
+        *capacity* more samples; check *is_intact* after using them.
+        """
+        max_samples, timeout = getargs('max_samples', 'timeout', kwargs)
+        deadline = time.monotonic() + timeout
+        while True:
+            written = int(self.__header[_WRITTEN])
+            if written > self.__position or self.__header[_CLOSED] \
+                    or time.monotonic() >= deadline:
+                break
+            time.sleep(self.__poll_interval)
+        # the samples up to *written* are in place before they are read
+        _memory_barrier()
+        # skip the samples that are or are being overwritten
+        oldest = int(self.__header[_RESERVED]) - self.__capacity
+        if oldest > self.__position:
+            self.__lost += oldest - self.__position
+            self.__position = oldest
+        n = max(written - self.__position, 0)
+        index = self.__position % self.__capacity
+        n = min(n, self.__capacity - index)
+        if max_samples is not None:
+            n = min(n, max_samples)
+        block = RingBlock(
+            self.position, self.__data[index:index + n],
+            self.__timestamps[index:index + n]
+            if self.__timestamps is not None else None)
+        self.__position += n
+        return block
+
+    @docval(
+        {
+            'name': 'max_samples',
+            'type': int,
+            'doc': 'the largest number of samples per block',
+            'default': None
+        }
+    )
+    def iter_blocks(self, **kwargs):
+        """
+        Iterate over the samples as they are written, until the producer
+        closes the buffer.
+        """
+        max_samples = getargs('max_samples', kwargs)
+        while not self.closed:
+            block = self.read(max_samples=max_samples, timeout=1.)
+            if len(block.data):
+                yield block
+
+    @docval(
+        {
+            'name': 'block',
+            'type': RingBlock,
+            'doc': 'a block returned by read'
+        },
+        returns='whether none of the samples of the block were overwritten',
+        rtype=bool
+    )
+    def is_intact(self, **kwargs):
+        """
+        Check whether the samples of a block are still those that were read,
+        e.g. after they were processed or copied.
+        """
+        block = getargs('block', kwargs)
+        start = block.start - self.__metadata['first_sample']
+        # the samples of the block were used before the count is checked
+        _memory_barrier()
+        return bool(self.__header[_RESERVED] <= start + self.__capacity)
+
+    @docval(
+        {
+            'name': 'block',
+            'type': RingBlock,
+            'doc': 'a block returned by read'
+        },
+        returns='the time of every sample of the block', rtype=np.ndarray
+    )
+    def get_times(self, **kwargs):
+        """
+        The times of the samples of a block, from their timestamps or from the
+        rate and starting time of the StimSeries.
+        """
+        block = getargs('block', kwargs)
+        if block.timestamps is not None:
+            return np.array(block.timestamps)
+        return self.starting_time \
+            + np.arange(block.start, block.start + len(block.data)) / self.rate
+
+    def close(self):
+        """Detach from the shared memory."""
+        if self.__shm is None:
+            return
+        self.__header = self.__timestamps = self.__data = None
+        self.__shm.close()
+        self.__shm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class _Layout(object):
+    """
+    The offsets of the arrays of a StimRingBuffer segment: the header, the
+    metadata, the timestamps if any, and the samples.
+    """
+
+    def __init__(self, metadata, metadata_bytes):
+        self.capacity = metadata['capacity']
+        self.dtype = np.dtype(metadata['dtype'])
+        self.n_pairs = metadata['n_pairs']
+        self.timestamps_offset = None
+        offset = _align(_HEADER_BYTES + metadata_bytes)
+        if metadata['has_timestamps']:
+            self.timestamps_offset = offset
+            offset = _align(offset + 8 * self.capacity)
+        self.data_offset = offset
+        self.size = offset + self.dtype.itemsize * self.capacity * self.n_pairs
+
+    def views(self, shm):
+        """The header, timestamps and samples arrays of the segment *shm*."""
+        header = np.ndarray(_HEADER_BYTES // 8, dtype=np.int64,
+                            buffer=shm.buf)
+        timestamps = None
+        if self.timestamps_offset is not None:
+            timestamps = np.ndarray(self.capacity, dtype=np.float64,
+                                    buffer=shm.buf,
+                                    offset=self.timestamps_offset)
+        data = np.ndarray((self.capacity, self.n_pairs), dtype=self.dtype,
+                          buffer=shm.buf, offset=self.data_offset)
+        return header, timestamps, data
+
+
+def _align(offset):
+    return -(-offset // _ALIGNMENT) * _ALIGNMENT
+
+
+def _ring_slices(start, n, capacity):
+    """
+    The slices of the ring and of a block of *n* samples that the block,
+    starting at sample *start*, is written to, in at most two parts.
+    """
+    index = start % capacity
+    first = min(n, capacity - index)
+    yield slice(index, index + first), slice(0, first)
+    if first < n:
+        yield slice(0, n - first), slice(first, n)
+
+
+def _memory_barrier():
+    """
+    Order the loads and stores of shared memory before the call before those
+    after it, which NumPy does not do by itself.
+    """
+    with _BARRIER:
+        pass
+
+
+def _open_untracked(name, create=False, size=0):
+    """
+    Create or attach to a shared memory segment that the resource tracker
+    does not unlink when this process exits. Before Python 3.13, attaching to
+    a segment registers it too, so a consumer that exits would remove the
+    segment of the producer; instead, the producer unlinks the segment when
+    it is closed.
+    """
+    if sys.version_info >= (3, 13):
+        return SharedMemory(name=name, create=create, size=size, track=False)
+    shm = SharedMemory(name=name, create=create, size=size)
+    if sys.platform != 'win32':
+        resource_tracker.unregister(_tracked_name(shm), 'shared_memory')
+    return shm
+
+
+def _unlink_untracked(shm):
+    """
+    Unlink a segment opened with *_open_untracked*.
+    """
+    if sys.version_info < (3, 13) and sys.platform != 'win32':
+        # unlink unregisters the segment from the resource tracker again
+        resource_tracker.register(_tracked_name(shm), 'shared_memory')
+    shm.unlink()
+
+
+def _tracked_name(shm):
+    """
+    The name under which the resource tracker knows a POSIX segment, which
+    is its name with a leading slash.
+    """
+    return '/' + shm.name
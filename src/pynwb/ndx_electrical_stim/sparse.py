@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+"""
+Sparse storage of StimSeries waveforms that are zero most of the time.
+
+A sparse waveform keeps only its non-zero segments: the samples of all
+segments concatenated in time order, the index of the first sample of each
+segment in the dense waveform (*segment_starts*) and the end of each segment
+in the stored samples (*segment_index*, like a VectorIndex). Every sample
+outside of the segments is zero.
+"""
+import numpy as np
+from hdmf.utils import docval, getargs
+
+from .data_utils import get_readable_data
+from .lazy import LazyStimData
+
+# target number of bytes of dense waveform produced at a time
+_BLOCK_BYTES = 8 * 1024 ** 2
+
+
+class SparseStimData(object):
+    """
+    A lazily reconstructed, NumPy-compatible view of the dense waveform of a
+    sparse StimSeries.
+
+    Slicing reads only the stored samples of the segments that overlap the
+    slice, in a single contiguous read, and fills the rest with zeros. The
+    per-pair reductions (*sum*, *mean*, *rms*, *min*, *max*, *abs_max*) are
+    computed from the stored samples alone.
+    """
+
+    def __init__(self, data, segment_starts, segment_index, num_samples,
+                 cache_blocks=64):
+        """
+        :param data: the stored samples of the segments, with time on the
+                     first dimension
+        :param segment_starts: the first sample of each segment in the dense
+                               waveform
+        :param segment_index: the end of each segment in *data*
+        :param num_samples: the number of samples of the dense waveform
+        :param cache_blocks: the number of blocks of chunk rows of *data* to
+                             cache, if it is a chunked HDF5 dataset
+        """
+        self.__data = LazyStimData(data, cache_blocks=cache_blocks)
+        self.__starts = np.asarray(get_readable_data(segment_starts)[:],
+                                   dtype=np.int64)
+        self.__ends = np.asarray(get_readable_data(segment_index)[:],
+                                 dtype=np.int64)
+        self.__offsets = np.r_[0, self.__ends[:-1]].astype(np.int64)
+        self.__stops = self.__starts + self.__ends - self.__offsets
+        self.__num_samples = int(num_samples)
+
+    @property
+    def shape(self):
+        return (self.__num_samples,) + self.__data.shape[1:]
+
+    @property
+    def dtype(self):
+        return self.__data.dtype
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def n_stored(self):
+        """The number of samples that are stored"""
+        return len(self.__data)
+
+    def __len__(self):
+        return self.__num_samples
+
+    def __array__(self, dtype=None):
+        return np.asarray(self[:], dtype=dtype)
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        time_key, rest = key[0], key[1:]
+        if isinstance(time_key, slice):
+            start, stop, step = time_key.indices(len(self))
+            if step < 0:
+                rows = np.arange(start, stop, step)
+                out = self.__read_range(rows.min(), rows.max() + 1) \
+                    if len(rows) else self.__read_range(0, 0)
+                out = out[rows - rows.min()] if len(rows) else out
+            else:
+                out = self.__read_range(start, max(start, stop))[::step]
+        elif isinstance(time_key, (int, np.integer)):
+            index = int(time_key) + (len(self) if time_key < 0 else 0)
+            if not 0 <= index < len(self):
+                raise IndexError('index %d is out of range for a waveform '
+                                 'with %d samples' % (time_key, len(self)))
+            out = self.__read_range(index, index + 1)[0]
+        else:
+            out = self.__read_rows(np.asarray(time_key))
+        if not rest:
+            return out
+        if out.ndim < len(self.shape):
+            return out[rest]
+        return out[(slice(None),) + rest]
+
+    def __read_range(self, start, stop):
+        """
+        The dense waveform from sample *start* to *stop*, reading the stored
+        samples of all segments that overlap it at once.
+        """
+        start = max(start, 0)
+        stop = max(min(stop, len(self)), start)
+        out = np.zeros((stop - start,) + self.shape[1:], dtype=self.dtype)
+        first = np.searchsorted(self.__stops, start, side='right')
+        last = np.searchsorted(self.__starts, stop, side='left')
+        if first >= last:
+            return out
+        starts = np.maximum(self.__starts[first:last], start)
+        stops = np.minimum(self.__stops[first:last], stop)
+        lengths = stops - starts
+        stored = self.__data[self.__offsets[first] + starts[0] - self.__starts[first]:
+                             self.__offsets[last - 1] + stops[-1] - self.__starts[last - 1]]
+        # the dense row of every stored row, which are the clipped segments
+        # one after the other
+        rows = np.arange(lengths.sum()) + np.repeat(
+            starts - start - np.r_[0, np.cumsum(lengths)[:-1]], lengths)
+        out[rows] = stored
+        return out
+
+    def __read_rows(self, rows):
+        """
+        The dense waveform at an array of sample indices.
+        """
+        if rows.dtype == bool:
+            rows = np.flatnonzero(rows)
+        rows = np.where(rows < 0, rows + len(self), rows).astype(np.int64)
+        if rows.size and (rows.min() < 0 or rows.max() >= len(self)):
+            raise IndexError('index out of range for a waveform with %d '
+                             'samples' % len(self))
+        flat_rows = rows.ravel()
+        out = np.zeros((len(flat_rows),) + self.shape[1:], dtype=self.dtype)
+        segments = np.searchsorted(self.__starts, flat_rows, side='right') - 1
+        inside = segments >= 0
+        inside[inside] = flat_rows[inside] < self.__stops[segments[inside]]
+        stored_rows = (self.__offsets[segments[inside]] + flat_rows[inside]
+                       - self.__starts[segments[inside]])
+        if len(stored_rows):
+            out[inside] = self.__data[stored_rows]
+        return out.reshape(rows.shape + self.shape[1:])
+
+    def iter_segments(self):
+        """
+        Iterate over the non-zero segments, yielding the index of the first
+        sample of each segment in the dense waveform and its samples.
+        """
+        for start, offset, end in zip(self.__starts, self.__offsets,
+                                      self.__ends):
+            yield int(start), np.asarray(self.__data[offset:end])
+
+    def iter_blocks(self, block_rows=None):
+        """
+        Iterate over the dense waveform in blocks of rows, yielding the index
+        of the first row of each block and the block itself. By default,
+        blocks are about 8 MiB.
+        """
+        if block_rows is None:
+            row_bytes = int(np.prod(self.shape[1:], dtype=np.int64)) * self.dtype.itemsize
+            block_rows = max(1, _BLOCK_BYTES // max(1, row_bytes))
+        for start in range(0, len(self), block_rows):
+            yield start, self.__read_range(start, start + block_rows)
+
+    def __has_zeros(self):
+        return self.n_stored < len(self)
+
+    def sum(self):
+        """The sum of the waveform of each pair"""
+        if not self.n_stored:
+            return np.zeros(self.shape[1:])
+        return self.__data.sum()
+
+    def mean(self):
+        """The mean of the waveform of each pair"""
+        if not len(self):
+            raise ValueError('cannot reduce an empty waveform')
+        return self.sum() / len(self)
+
+    def rms(self):
+        """The root mean square of the waveform of each pair"""
+        if not len(self):
+            raise ValueError('cannot reduce an empty waveform')
+        if not self.n_stored:
+            return np.zeros(self.shape[1:])
+        return self.__data.rms() * np.sqrt(self.n_stored / len(self))
+
+    def min(self):
+        """The minimum of the waveform of each pair"""
+        return self.__reduce(self.__data.min, np.minimum)
+
+    def max(self):
+        """The maximum of the waveform of each pair"""
+        return self.__reduce(self.__data.max, np.maximum)
+
+    def abs_max(self):
+        """The largest absolute value of the waveform of each pair"""
+        return self.__reduce(self.__data.abs_max, np.maximum)
+
+    def __reduce(self, reduce_stored, combine):
+        if not len(self):
+            raise ValueError('cannot reduce an empty waveform')
+        if not self.n_stored:
+            return np.zeros(self.shape[1:], dtype=self.dtype)
+        result = reduce_stored()
+        if self.__has_zeros():
+            result = combine(result, np.zeros_like(result))
+        return result
+
+
+@docval(
+    {
+        'name': 'data',
+        'type': 'array_data',
+        'doc': 'the dense waveform, with time on the first dimension'
+    },
+    {
+        'name': 'min_gap',
+        'type': int,
+        'doc': 'segments separated by at most this many zero samples are '
+               'stored as one segment',
+        'default': 0
+    },
+    {
+        'name': 'block_rows',
+        'type': int,
+        'doc': 'the number of samples to scan at a time. Defaults to about '
+               '8 MiB of waveform',
+        'default': None
+    },
+    returns='the stored samples, the segment starts, the segment index and '
+            'the number of samples of the dense waveform',
+    rtype=tuple,
+    is_method=False
+)
+def find_segments(**kwargs):
+    """
+    Find the non-zero segments of a dense waveform.
+
+    A sample is non-zero if any of its pairs is non-zero. The waveform is
+    scanned block by block, so it may also be an HDF5 dataset that does not
+    fit in memory; only the samples of the segments are kept.
+    """
+    data, min_gap, block_rows = getargs('data', 'min_gap', 'block_rows',
+                                        kwargs)
+    if min_gap < 0:
+        raise ValueError('min_gap must be non-negative, got %d' % min_gap)
+    data = LazyStimData(data)
+    starts, stops = list(), list()
+    active = False
+    for offset, block in data.iter_blocks(block_rows):
+        block = block.reshape(len(block), -1)
+        # or-ing the columns one at a time is much faster than any(axis=1)
+        # over a few columns
+        nonzero = block[:, 0] != 0
+        for column in range(1, block.shape[1]):
+            nonzero |= block[:, column] != 0
+        # segments begin and end where the non-zero mask changes, carrying
+        # the state of the last sample of the previous block
+        edges = np.flatnonzero(np.diff(
+            np.r_[active, nonzero, False].astype(np.int8))) + offset
+        continues = bool(nonzero[-1])
+        if continues:
+            # the last segment continues into the next block
+            edges = edges[:-1]
+        if active and len(edges):
+            # the first edge ends the segment left open by the last block
+            stops.append(edges[:1])
+            edges = edges[1:]
+        starts.append(edges[0::2])
+        stops.append(edges[1::2])
+        active = continues
+    starts = np.concatenate(starts or [np.zeros(0, dtype=np.int64)]).astype(np.int64)
+    stops = np.concatenate(stops or [np.zeros(0, dtype=np.int64)]).astype(np.int64)
+    if active:
+        stops = np.r_[stops, len(data)]
+    if len(starts) and min_gap:
+        merged = np.r_[False, starts[1:] - stops[:-1] <= min_gap]
+        starts = starts[~merged]
+        stops = stops[np.r_[~merged[1:], True]]
+    segment_index = np.cumsum(stops - starts).astype(np.int64)
+    samples = np.empty((int(segment_index[-1]) if len(segment_index) else 0,)
+                       + data.shape[1:], dtype=data.dtype)
+    for start, stop, end in zip(starts, stops, segment_index):
+        samples[end - (stop - start):end] = data[start:stop]
+    return samples, starts, segment_index, len(data)
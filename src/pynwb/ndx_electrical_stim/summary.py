@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""
+Summarize the waveform delivered during every run of a StimTable.
+
+The samples of a run are those of the StimSeries column that records its
+*bipolar_pair*, from its start time to its stop time. The waveform is read
+once, one block at a time. The runs that overlap a block are found with an
+IntervalIndex over their sorted sample bounds, and their statistics are
+accumulated with one reduceat per statistic and column of the block, so the
+cost barely depends on the number of runs.
+"""
+from collections import namedtuple
+
+import numpy as np
+from hdmf.utils import docval, getargs
+
+from .data_utils import get_readable_data
+from .index import IntervalIndex
+from .ndx_electrical_stim import StimSeries, StimTable
+from .pulses import get_rate
+
+RunSummary = namedtuple('RunSummary', ['charge', 'peak', 'rms',
+                                       'pulse_count'])
+RunSummary.__doc__ = """
+The statistics of the waveform of every run of a StimTable: the charge
+delivered (the integral of the absolute waveform), the peak absolute value,
+the root mean square and the number of pulses. Runs without samples, e.g.
+because their bipolar pair is not recorded, have a charge of 0, no pulses,
+and a NaN peak and RMS.
+"""
+
+# the StimTable columns that hold the statistics, with their descriptions
+SUMMARY_COLUMNS = (
+    ('charge', 'charge delivered during the run, the integral of the '
+               'absolute waveform, in waveform units x seconds'),
+    ('peak', 'peak absolute value of the waveform during the run'),
+    ('rms', 'root mean square of the waveform during the run'),
+    ('pulse_count', 'number of pulses during the run'),
+)
+
+
+@docval(
+    {
+        'name': 'stim_series',
+        'type': StimSeries,
+        'doc': 'the waveform delivered during the runs'
+    },
+    {
+        'name': 'stim_table',
+        'type': StimTable,
+        'doc': 'the runs to summarize'
+    },
+    {
+        'name': 'threshold',
+        'type': float,
+        'doc': 'the absolute value above which a sample is part of a pulse, '
+               'e.g. half of the pulse amplitude in waveform units'
+    },
+    {
+        'name': 'add_columns',
+        'type': bool,
+        'doc': 'add the statistics to *stim_table* as the columns charge, '
+               'peak, rms and pulse_count',
+        'default': True
+    },
+    {
+        'name': 'block_rows',
+        'type': int,
+        'doc': 'the number of samples to read at a time. Defaults to about '
+               '8 MiB of whole HDF5 chunks',
+        'default': None
+    },
+    returns='the statistics of every run', rtype=RunSummary,
+    is_method=False
+)
+def summarize_runs(**kwargs):
+    """
+    Compute the charge, peak, RMS and pulse count of the waveform of every
+    run of a StimTable in a single pass over a StimSeries.
+
+    A run is matched to the column of the StimSeries whose entry of
+    *bipolar_electrodes* is the *bipolar_pair* of the run. A pulse is a
+    stretch of samples above *threshold* in absolute value, like in
+    detect_runs; a pulse that is under way when a run starts is counted
+    for that run. The statistics are in the units of the waveform, without
+    its *conversion*.
+    """
+    stim_series, stim_table, threshold, add_columns, block_rows = getargs(
+        'stim_series', 'stim_table', 'threshold', 'add_columns', 'block_rows',
+        kwargs)
+    if add_columns:
+        existing = [name for name, _ in SUMMARY_COLUMNS
+                    if name in stim_table.colnames]
+        if existing:
+            raise ValueError('StimTable %s already has the columns %s'
+                             % (stim_table.name, existing))
+    region = stim_series.bipolar_electrodes
+    bipolar_table = stim_table['bipolar_pair'].table
+    if bipolar_table is not None and region.table is not bipolar_table:
+        raise ValueError('StimSeries %s and StimTable %s do not refer to the '
+                         'same BipolarSchemeTable'
+                         % (stim_series.name, stim_table.name))
+    data = stim_series.get_lazy_data()
+    n_samples = len(data)
+
+    # the samples [first, end) and the column of every run
+    starts = np.asarray(get_readable_data(stim_table['start_time'].data)[:],
+                        dtype=float)
+    stops = np.asarray(get_readable_data(stim_table['stop_time'].data)[:],
+                       dtype=float)
+    valid = np.isfinite(starts) & np.isfinite(stops)
+    first = np.zeros(len(starts), dtype=np.int64)
+    end = np.zeros(len(starts), dtype=np.int64)
+    first[valid] = np.clip(stim_series._time_to_index(starts[valid], 'left'),
+                           0, n_samples)
+    end[valid] = np.clip(stim_series._time_to_index(stops[valid], 'right'),
+                         first[valid], n_samples)
+    pairs = np.asarray(get_readable_data(region.data)[:], dtype=np.int64)
+    run_pairs = np.asarray(
+        get_readable_data(stim_table['bipolar_pair'].data)[:], dtype=np.int64)
+    # the first column that records each pair, -1 if none does
+    columns = np.full(max(pairs.max(initial=-1), run_pairs.max(initial=-1)) + 1,
+                      -1, dtype=np.int64)
+    columns[pairs[::-1]] = np.arange(len(pairs))[::-1]
+    run_columns = columns[run_pairs] if len(run_pairs) else run_pairs
+    end[run_columns < 0] = first[run_columns < 0]
+
+    sums = np.zeros(len(starts))
+    sum_squares = np.zeros(len(starts))
+    peaks = np.full(len(starts), np.nan)
+    counts = np.zeros(len(starts), dtype=np.int64)
+    nonempty = np.flatnonzero(end > first)
+    index = IntervalIndex(first[nonempty], end[nonempty] - 1)
+    above_before = None
+    for offset, block in data.iter_blocks(block_rows):
+        block = block.reshape(len(block), -1)
+        if above_before is None:
+            above_before = np.zeros(block.shape[1], dtype=bool)
+        runs = nonempty[index.overlapping(offset, offset + len(block) - 1)]
+        # the part of each run in this block and the column of its pair
+        a = np.maximum(first[runs], offset) - offset
+        b = np.minimum(end[runs], offset + len(block)) - offset
+        c = run_columns[runs]
+        for column in np.unique(c):
+            in_column = c == column
+            column_runs = runs[in_column]
+            # the reductions of the [a, b) intervals, which are never empty,
+            # are at the even positions of the interleaved bounds
+            bounds = np.column_stack([a[in_column], b[in_column]]).ravel()
+            absolute = np.abs(block[:, column], dtype=float)
+            above = absolute > threshold
+            rising = above.copy()
+            rising[1:] &= ~above[:-1]
+            rising[0] &= ~above_before[column]
+            sums[column_runs] += _reduce_intervals(np.add, absolute, bounds)
+            sum_squares[column_runs] += _reduce_intervals(
+                np.add, np.square(absolute), bounds)
+            counts[column_runs] += _reduce_intervals(
+                np.add, rising.astype(np.int64), bounds)
+            peaks[column_runs] = np.fmax(
+                peaks[column_runs],
+                _reduce_intervals(np.maximum, absolute, bounds))
+            # a pulse under way at the start of a run counts for the run
+            starting = first[column_runs] >= offset
+            first_rows = a[in_column][starting]
+            counts[column_runs[starting]] += (above[first_rows]
+                                              & ~rising[first_rows])
+        if len(block):
+            above_before = np.abs(block[-1]) > threshold
+
+    lengths = end - first
+    rate = get_rate(stim_series)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        rms = np.where(lengths > 0, np.sqrt(sum_squares / lengths), np.nan)
+    summary = RunSummary(charge=sums / rate, peak=peaks, rms=rms,
+                         pulse_count=counts)
+    if add_columns:
+        for name, description in SUMMARY_COLUMNS:
+            stim_table.add_column(name=name, description=description,
+                                  data=getattr(summary, name))
+    return summary
+
+
+def _reduce_intervals(ufunc, values, bounds):
+    """
+    Reduce *values* with *ufunc* over the intervals [bounds[0], bounds[1]),
+    [bounds[2], bounds[3]), ..., which must not be empty.
+    """
+    # reduceat reduces up to the next index, so every other result is one of
+    # the intervals; the padding lets intervals end at len(values)
+    return ufunc.reduceat(np.r_[values, values[:1]], bounds)[::2]
@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+"""
+Render the commanded stimulation waveform of StimTable runs into a StimSeries.
+
+Every run is a train of biphasic, charge-balanced pulses: starting at
+*start_time* and repeating at *frequency* for as long as the pulse onset is
+before *stop_time*, each pulse is +*amplitude* for *pulse_width* seconds
+followed by -*amplitude* for another *pulse_width* seconds.
+"""
+import numpy as np
+from hdmf.common import DynamicTableRegion
+from hdmf.utils import docval, getargs, popargs, get_docval
+
+from .data_utils import get_readable_data, wrap_waveform_data
+from .index import IntervalIndex
+from .ndx_electrical_stim import StimSeries, StimTable
+
+
+@docval(
+    {
+        'name': 'stim_table',
+        'type': StimTable,
+        'doc': 'the StimTable with the runs to render'
+    },
+    {
+        'name': 'rate',
+        'type': float,
+        'doc': 'the sampling rate of the rendered waveform, in Hz'
+    },
+    {
+        'name': 'pairs',
+        'type': 'array_data',
+        'doc': 'the bipolar pair of each column of the waveform. Runs on '
+               'other pairs are ignored'
+    },
+    {
+        'name': 'starting_time',
+        'type': float,
+        'doc': 'the time of the first sample, in seconds',
+        'default': 0.
+    },
+    {
+        'name': 'n_samples',
+        'type': int,
+        'doc': 'the number of samples to render. Defaults to the end of the '
+               'last pulse',
+        'default': None
+    },
+    {
+        'name': 'block_size',
+        'type': int,
+        'doc': 'the number of samples per block',
+        'default': 1000000
+    },
+    is_method=False
+)
+def iter_pulse_train_blocks(**kwargs):
+    """
+    Render the pulse trains of the runs of a StimTable, yielding blocks of
+    shape (block_size, n_pairs).
+
+    Each block is rendered with array operations over all the pulses that
+    touch it: pulse edges are scattered into a difference array that is then
+    integrated along time, so there is no loop over pulses or runs.
+    """
+    stim_table, rate, pairs, starting_time, n_samples, block_size = getargs(
+        'stim_table', 'rate', 'pairs', 'starting_time', 'n_samples',
+        'block_size', kwargs)
+    pairs = np.asarray(pairs, dtype=np.int64)
+    runs = _RunParameters(stim_table, pairs)
+    if n_samples is None:
+        n_samples = max(int(np.ceil((runs.end_time - starting_time) * rate)), 0)
+    for first in range(0, n_samples, block_size):
+        yield runs.render(rate, starting_time, first,
+                          min(block_size, n_samples - first))
+
+
+@docval(
+    *get_docval(iter_pulse_train_blocks, 'stim_table', 'rate'),
+    {
+        'name': 'bipolar_electrodes',
+        'type': DynamicTableRegion,
+        'doc': 'the bipolar pairs to render, one column each. Defaults to '
+               'every pair used in *stim_table*',
+        'default': None
+    },
+    {
+        'name': 'name',
+        'type': str,
+        'doc': 'Name of the StimSeries',
+        'default': 'StimSeries'
+    },
+    *get_docval(iter_pulse_train_blocks, 'starting_time', 'n_samples',
+                'block_size'),
+    {
+        'name': 'stream',
+        'type': bool,
+        'doc': 'render the waveform block by block while the file is '
+               'written, instead of up front',
+        'default': False
+    },
+    *get_docval(StimSeries.from_blocks, 'chunk_shape', 'compression',
+                'compression_opts', 'shuffle'),
+    {
+        'name': 'description',
+        'type': str,
+        'doc': 'Description of the StimSeries',
+        'default': 'commanded stimulation waveform rendered from a StimTable'
+    },
+    returns='the rendered waveform', rtype=StimSeries,
+    is_method=False
+)
+def synthesize_stim_series(**kwargs):
+    """
+    Render the runs of a StimTable into a StimSeries of biphasic pulse trains.
+
+    With *stream* the waveform is rendered one block at a time as it is
+    written with StimSeries.from_blocks, so memory is bounded by the block
+    size no matter how long the session is. Either way, it is written with
+    the chunking and compression options.
+    """
+    stim_table, rate, bipolar_electrodes, name, starting_time, n_samples, \
+        block_size, stream, description = popargs(
+            'stim_table', 'rate', 'bipolar_electrodes', 'name',
+            'starting_time', 'n_samples', 'block_size', 'stream',
+            'description', kwargs)
+    if bipolar_electrodes is None:
+        bipolar_col = stim_table['bipolar_pair']
+        bipolar_electrodes = DynamicTableRegion(
+            name='bipolar_electrodes',
+            data=np.unique(get_readable_data(bipolar_col.data)[:]),
+            description='the bipolar pairs of the rendered waveform',
+            table=bipolar_col.table)
+    pairs = get_readable_data(bipolar_electrodes.data)[:]
+    blocks = iter_pulse_train_blocks(stim_table=stim_table, rate=rate,
+                                     pairs=pairs, starting_time=starting_time,
+                                     n_samples=n_samples,
+                                     block_size=block_size)
+    if stream:
+        return StimSeries.from_blocks(blocks=blocks, name=name,
+                                      bipolar_electrodes=bipolar_electrodes,
+                                      rate=rate, starting_time=starting_time,
+                                      description=description, **kwargs)
+    blocks = list(blocks)
+    if blocks:
+        data = np.concatenate(blocks)
+    else:
+        data = np.zeros((0, len(pairs)))
+    data = wrap_waveform_data(data, *getargs(
+        'chunk_shape', 'compression', 'compression_opts', 'shuffle', kwargs))
+    return StimSeries(name=name, data=data,
+                      bipolar_electrodes=bipolar_electrodes, rate=rate,
+                      starting_time=starting_time, description=description)
+
+
+class _RunParameters(object):
+    """
+    The parameters of the runs of a StimTable that are on one of *pairs*, read
+    once, with the column of the waveform each run is rendered into.
+    """
+
+    def __init__(self, stim_table, pairs):
+        columns = {name: np.asarray(get_readable_data(stim_table[name].data)[:])
+                   for name in ('start_time', 'stop_time', 'frequency',
+                                'amplitude', 'pulse_width', 'bipolar_pair')}
+        # map each run's bipolar pair to its column, -1 if it is not rendered
+        bipolar_pair = columns['bipolar_pair']
+        column = np.full(len(bipolar_pair), -1, dtype=np.int64)
+        if len(pairs):
+            order = np.argsort(pairs, kind='stable')
+            position = np.minimum(np.searchsorted(pairs[order], bipolar_pair),
+                                  len(pairs) - 1)
+            found = pairs[order][position] == bipolar_pair
+            column[found] = order[position[found]]
+        valid = ((column >= 0) & (columns['frequency'] > 0)
+                 & (columns['pulse_width'] > 0)
+                 & np.isfinite(columns['start_time'])
+                 & np.isfinite(columns['stop_time']))
+        self.n_columns = len(pairs)
+        self.column = column[valid]
+        self.start = columns['start_time'][valid].astype(float)
+        self.stop = columns['stop_time'][valid].astype(float)
+        self.frequency = columns['frequency'][valid].astype(float)
+        self.amplitude = columns['amplitude'][valid].astype(float)
+        self.pulse_width = columns['pulse_width'][valid].astype(float)
+        # a pulse can end up to two phases after the stop time of its run
+        ends = self.stop + 2 * self.pulse_width
+        self.end_time = ends.max(initial=0.)
+        self.index = IntervalIndex(self.start, ends)
+
+    def render(self, rate, starting_time, first, n):
+        """
+        Render samples first:first + n of the waveform.
+        """
+        t0 = starting_time + first / rate
+        t1 = starting_time + (first + n) / rate
+        runs = self.index.overlapping(t0, t1)
+        start, stop = self.start[runs], self.stop[runs]
+        frequency, pulse_width = self.frequency[runs], self.pulse_width[runs]
+
+        # the range of pulses of each run that may touch the block
+        k_lo = np.maximum(np.floor((t0 - 2 * pulse_width - start) * frequency), 0)
+        k_hi = np.minimum(np.ceil((stop - start) * frequency) - 1,
+                          np.floor((t1 - start) * frequency))
+        counts = np.maximum(k_hi - k_lo + 1, 0).astype(np.int64)
+        offsets = np.cumsum(counts) - counts
+        run_of_pulse = np.repeat(np.arange(len(runs)), counts)
+        k = np.arange(counts.sum()) - offsets[run_of_pulse] + k_lo[run_of_pulse]
+        onset = start[run_of_pulse] + k / frequency[run_of_pulse]
+        keep = onset < stop[run_of_pulse]
+        run_of_pulse, onset = run_of_pulse[keep], onset[keep]
+
+        width = pulse_width[run_of_pulse]
+        amplitude = self.amplitude[runs][run_of_pulse]
+        column = self.column[runs][run_of_pulse]
+        # scatter the pulse edges into a difference array and integrate it
+        edges = np.concatenate([onset, onset + width, onset + 2 * width])
+        steps = np.concatenate([amplitude, -2 * amplitude, amplitude])
+        index = _edge_index(edges, rate, starting_time, first, n)
+        flat = index * self.n_columns + np.tile(column, 3)
+        delta = np.bincount(flat, weights=steps,
+                            minlength=(n + 1) * self.n_columns)
+        delta = delta.reshape(n + 1, self.n_columns)
+        return np.cumsum(delta[:-1], axis=0, dtype=float)
+
+
+def _edge_index(times, rate, starting_time, first, n):
+    """
+    The index, relative to sample *first* and clipped to [0, n], of the first
+    sample at or after each of *times*.
+    """
+    index = (times - starting_time) * rate - first
+    rounded = np.round(index)
+    index = np.where(np.isclose(index, rounded), rounded, index)
+    return np.clip(np.ceil(index), 0, n).astype(np.int64)
@@ -0,0 +1,404 @@
+# -*- coding: utf-8 -*-
+"""
+Check the consistency of the StimTables and StimSeries of whole archives of
+NWB files, in parallel.
+
+For every file, the validator checks that:
+
+- the *bipolar_pair* of every run of a StimTable, or of every parameter set
+  of a CompactStimTable, and the *parameter_set* of every run of a
+  CompactStimTable, are rows of the table they reference,
+- the *bipolar_electrodes* of every StimSeries are rows of the
+  BipolarSchemeTable, and there is one of them per column of its data,
+- every run starts before it stops, and lies within the time range of a
+  StimSeries that records its bipolar pair. Runs whose times are NaN, and
+  runs whose bipolar pair no StimSeries on the same BipolarSchemeTable
+  records, are not checked against the time range.
+
+Files are read directly with h5py, the columns of the tables a chunk of rows
+at a time, and the waveforms of the StimSeries are never read, so checking a
+file costs a few reads of its metadata plus one pass over its run columns.
+
+From the command line::
+
+    python -m ndx_electrical_stim.validation archive/ --workers 8
+"""
+import argparse
+import fnmatch
+import json
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+from collections import namedtuple
+
+import h5py
+import numpy as np
+from hdmf.utils import docval, getargs
+
+from .data_utils import find_groups
+
+# the names of the checks; the issues of a file are listed in this order
+CHECKS = ('bipolar_electrodes_range', 'data_columns', 'bipolar_pair_range',
+          'parameter_set_range', 'start_stop_order', 'run_time_range')
+
+ValidationIssue = namedtuple('ValidationIssue', [
+    'object', 'check', 'count', 'rows', 'message'])
+ValidationIssue.__doc__ = """
+A check that failed for an object of a file: the HDF5 path of the object,
+the name of the check (one of CHECKS), the number of rows that fail it, the
+first of these rows, and a description of the failure.
+"""
+
+ValidationResult = namedtuple('ValidationResult', [
+    'path', 'status', 'issues', 'seconds', 'error'])
+ValidationResult.__doc__ = """
+The outcome of validating one file. *status* is 'valid', 'invalid' (in which
+case *issues* lists the ValidationIssue of every failed check) or 'failed',
+if the file could not be read, in which case *error* holds the traceback.
+"""
+
+# default number of rows of a table column read at a time
+_CHUNK_ROWS = 1024 ** 2
+
+
+@docval(
+    {
+        'name': 'path',
+        'type': str,
+        'doc': 'the NWB file to validate'
+    },
+    {
+        'name': 'max_rows',
+        'type': int,
+        'doc': 'the number of failing rows to report for each issue',
+        'default': 10
+    },
+    {
+        'name': 'chunk_rows',
+        'type': int,
+        'doc': 'the number of rows of a table column to read at a time',
+        'default': _CHUNK_ROWS
+    },
+    returns='the issues of the file', rtype=ValidationResult,
+    is_method=False
+)
+def validate_file(**kwargs):
+    """
+    Check the StimTables, CompactStimTables and StimSeries of an NWB file.
+
+    Errors reading the file are raised; use validate_files to record them
+    in the result instead.
+    """
+    path, max_rows, chunk_rows = getargs('path', 'max_rows', 'chunk_rows',
+                                         kwargs)
+    if chunk_rows < 1:
+        raise ValueError('chunk_rows must be positive, got %d' % chunk_rows)
+    start = time.perf_counter()
+    issues = list()
+    with h5py.File(path, 'r') as f:
+        validator = _FileValidator(f, issues, max_rows, chunk_rows)
+        validator.validate()
+    # the issues of a check are in the order of the objects in the file
+    issues.sort(key=lambda issue: CHECKS.index(issue.check))
+    return ValidationResult(path, 'invalid' if issues else 'valid', issues,
+                            time.perf_counter() - start, None)
+
+
+@docval(
+    {
+        'name': 'paths',
+        'type': (list, tuple, str),
+        'doc': 'the NWB files to validate, or a directory to validate the NWB '
+               'files of, recursively'
+    },
+    {
+        'name': 'pattern',
+        'type': str,
+        'doc': 'the file name pattern of NWB files in a directory',
+        'default': '*.nwb'
+    },
+    {
+        'name': 'n_workers',
+        'type': int,
+        'doc': 'number of worker processes. Defaults to the number of CPUs. '
+               'With 0, files are validated in this process',
+        'default': None
+    },
+    {
+        'name': 'max_rows',
+        'type': int,
+        'doc': 'the number of failing rows to report for each issue',
+        'default': 10
+    },
+    {
+        'name': 'chunk_rows',
+        'type': int,
+        'doc': 'the number of rows of a table column to read at a time',
+        'default': _CHUNK_ROWS
+    },
+    returns='the ValidationResult of every file, in the order of *paths*, or '
+            'sorted by path for a directory',
+    rtype=list,
+    is_method=False
+)
+def validate_files(**kwargs):
+    """
+    Validate many NWB files across a pool of processes.
+
+    A file that cannot be read does not stop the others; its result has the
+    status 'failed' and the traceback of the error.
+    """
+    paths, pattern, n_workers, max_rows, chunk_rows = getargs(
+        'paths', 'pattern', 'n_workers', 'max_rows', 'chunk_rows', kwargs)
+    if isinstance(paths, str):
+        paths = _find_files(paths, pattern)
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    if n_workers < 0:
+        raise ValueError('n_workers must be non-negative, got %d' % n_workers)
+    tasks = [(i, path, max_rows, chunk_rows) for i, path in enumerate(paths)]
+    results = [None] * len(tasks)
+    if n_workers == 0 or len(tasks) < 2:
+        for task in tasks:
+            i, result = _validate_task(task)
+            results[i] = result
+        return results
+    with multiprocessing.Pool(min(n_workers, len(tasks))) as pool:
+        for i, result in pool.imap_unordered(_validate_task, tasks,
+                                             chunksize=1):
+            results[i] = result
+    return results
+
+
+def _find_files(directory, pattern):
+    """
+    The files under *directory* whose name matches *pattern*, sorted.
+    """
+    paths = list()
+    for root, _, names in os.walk(directory):
+        for name in fnmatch.filter(names, pattern):
+            paths.append(os.path.join(root, name))
+    return sorted(paths)
+
+
+def _validate_task(task):
+    """
+    Validate one file, catching its errors so that one unreadable file does
+    not stop the others.
+    """
+    i, path, max_rows, chunk_rows = task
+    start = time.perf_counter()
+    try:
+        return i, validate_file(path, max_rows=max_rows, chunk_rows=chunk_rows)
+    except Exception:
+        return i, ValidationResult(path, 'failed', [],
+                                   time.perf_counter() - start,
+                                   traceback.format_exc())
+
+
+class _FileValidator(object):
+    """
+    Make the checks of one open file, adding their issues to *issues*.
+    """
+
+    def __init__(self, f, issues, max_rows, chunk_rows):
+        self.__file = f
+        self.__issues = issues
+        self.__max_rows = max_rows
+        self.__chunk_rows = chunk_rows
+        # the number of rows of each referenced table, by HDF5 path
+        self.__n_rows = dict()
+
+    def validate(self):
+        groups = find_groups(self.__file, ('StimSeries', 'SparseStimSeries',
+                                           'StimTable', 'CompactStimTable'))
+        series = [self.__validate_series(group)
+                  for group in groups['StimSeries'] + groups['SparseStimSeries']]
+        for group in groups['StimTable']:
+            self.__validate_stim_table(group, series)
+        for group in groups['CompactStimTable']:
+            self.__validate_compact_stim_table(group, series)
+
+    def __add_issue(self, obj, check, failing, offset, message):
+        """
+        Record the rows of *obj* that fail *check* in a chunk that starts at
+        row *offset*, merging them with those of the previous chunks.
+        """
+        rows = np.flatnonzero(failing)
+        if not len(rows):
+            return
+        rows = (rows[:self.__max_rows] + offset).tolist()
+        for i, issue in enumerate(self.__issues):
+            if issue.object == obj.name and issue.check == check:
+                self.__issues[i] = issue._replace(
+                    count=issue.count + int(np.count_nonzero(failing)),
+                    rows=(issue.rows + rows)[:self.__max_rows])
+                return
+        self.__issues.append(ValidationIssue(
+            obj.name, check, int(np.count_nonzero(failing)), rows, message))
+
+    def __get_table(self, region):
+        """
+        The table referenced by a DynamicTableRegion dataset, and its number
+        of rows.
+        """
+        table = self.__file[region.attrs['table']]
+        if table.name not in self.__n_rows:
+            self.__n_rows[table.name] = len(table['id'])
+        return table, self.__n_rows[table.name]
+
+    def __iter_chunks(self, *datasets):
+        """
+        Iterate over the first row and the values of aligned chunks of rows
+        of *datasets*, which have the same length.
+        """
+        n_rows = len(datasets[0])
+        for offset in range(0, n_rows, self.__chunk_rows):
+            stop = min(n_rows, offset + self.__chunk_rows)
+            yield offset, [dset[offset:stop] for dset in datasets]
+
+    def __validate_series(self, group):
+        """
+        Check the bipolar_electrodes of a StimSeries. Returns the path of its
+        BipolarSchemeTable, whether it records each pair, and its time range.
+        """
+        region = group['bipolar_electrodes']
+        table, n_pairs = self.__get_table(region)
+        records = np.zeros(n_pairs, dtype=bool)
+        for offset, (pairs,) in self.__iter_chunks(region):
+            in_range = (pairs >= 0) & (pairs < n_pairs)
+            self.__add_issue(region, 'bipolar_electrodes_range', ~in_range,
+                             offset, 'bipolar_electrodes must be rows of %s, '
+                             'which has %d rows' % (table.name, n_pairs))
+            records[pairs[in_range]] = True
+
+        data = group['data']
+        n_columns = data.shape[1] if data.ndim > 1 else 1
+        if n_columns != len(region):
+            self.__issues.append(ValidationIssue(
+                data.name, 'data_columns', 1, [],
+                'data has %d columns but there are %d bipolar_electrodes'
+                % (n_columns, len(region))))
+
+        n_samples = group.attrs.get('num_dense_samples', len(data))
+        if 'timestamps' in group:
+            timestamps = group['timestamps']
+            first = float(timestamps[0]) if len(timestamps) else 0.
+            last = float(timestamps[-1]) if len(timestamps) else 0.
+            # the last sample lasts as long as the mean sample
+            end = last + (last - first) / (len(timestamps) - 1) \
+                if len(timestamps) > 1 else last
+        else:
+            starting_time = group['starting_time']
+            first = float(starting_time[()])
+            end = first + n_samples / float(starting_time.attrs['rate'])
+        return table.name, records, first, end
+
+    def __validate_stim_table(self, group, series):
+        bipolar_pair = group['bipolar_pair']
+        table, n_pairs = self.__get_table(bipolar_pair)
+        columns = [group['start_time'], group['stop_time'], bipolar_pair]
+        for offset, (starts, stops, pairs) in self.__iter_chunks(*columns):
+            in_range = (pairs >= 0) & (pairs < n_pairs)
+            self.__add_issue(bipolar_pair, 'bipolar_pair_range', ~in_range,
+                             offset, 'bipolar_pair must be a row of %s, which '
+                             'has %d rows' % (table.name, n_pairs))
+            self.__validate_times(group, starts, stops,
+                                  np.where(in_range, pairs, -1), table.name,
+                                  series, offset)
+
+    def __validate_compact_stim_table(self, group, series):
+        parameter_set = group['parameter_set']
+        parameter_sets, n_sets = self.__get_table(parameter_set)
+        # parameter sets are few, so their pairs are read at once
+        bipolar_pair = parameter_sets['bipolar_pair']
+        table, n_pairs = self.__get_table(bipolar_pair)
+        set_pairs = bipolar_pair[:]
+        in_range = (set_pairs >= 0) & (set_pairs < n_pairs)
+        self.__add_issue(bipolar_pair, 'bipolar_pair_range', ~in_range, 0,
+                         'bipolar_pair must be a row of %s, which has %d rows'
+                         % (table.name, n_pairs))
+        set_pairs = np.r_[np.where(in_range, set_pairs, -1), -1]
+        columns = [group['start_time'], group['stop_time'], parameter_set]
+        for offset, (starts, stops, sets) in self.__iter_chunks(*columns):
+            in_range = (sets >= 0) & (sets < n_sets)
+            self.__add_issue(parameter_set, 'parameter_set_range', ~in_range,
+                             offset, 'parameter_set must be a row of %s, '
+                             'which has %d rows' % (parameter_sets.name,
+                                                    n_sets))
+            # runs with an invalid parameter set have the pair -1
+            self.__validate_times(group, starts, stops,
+                                  set_pairs[np.where(in_range, sets, -1)],
+                                  table.name, series, offset)
+
+    def __validate_times(self, group, starts, stops, pairs, table, series,
+                         offset):
+        """
+        Check the times of a chunk of runs, whose pairs are rows of *table*,
+        or -1 if they are not valid.
+        """
+        with np.errstate(invalid='ignore'):
+            self.__add_issue(group, 'start_stop_order', starts >= stops,
+                             offset, 'runs must start before they stop')
+        timed = np.isfinite(starts) & np.isfinite(stops)
+        checked = np.zeros(len(pairs), dtype=bool)
+        covered = np.zeros(len(pairs), dtype=bool)
+        for series_table, records, first, end in series:
+            if series_table != table:
+                continue
+            recorded = timed & (pairs >= 0)
+            recorded[recorded] = records[pairs[recorded]]
+            checked |= recorded
+            covered |= recorded & (starts >= first) & (stops <= end)
+        self.__add_issue(group, 'run_time_range', checked & ~covered, offset,
+                         'runs must lie within the time range of a StimSeries '
+                         'that records their bipolar pair')
+
+
+def main(argv=None):
+    """
+    Validate the NWB files of a directory from the command line. Returns 1
+    if any file is invalid or could not be read, 0 otherwise.
+    """
+    parser = argparse.ArgumentParser(
+        description='Check the consistency of the StimTables and StimSeries '
+                    'of NWB files in parallel.')
+    parser.add_argument('paths', nargs='+',
+                        help='NWB files, or directories to validate the NWB '
+                             'files of')
+    parser.add_argument('--pattern', default='*.nwb',
+                        help='file name pattern of NWB files in directories')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of worker processes (default: one per '
+                             'CPU, 0 to validate in this process)')
+    parser.add_argument('--json', action='store_true',
+                        help='print the result of every file as one JSON '
+                             'object per line')
+    args = parser.parse_args(argv)
+    paths = list()
+    for path in args.paths:
+        paths.extend(_find_files(path, args.pattern) if os.path.isdir(path)
+                     else [path])
+    results = validate_files(paths=paths, n_workers=args.workers)
+    for result in results:
+        if args.json:
+            record = result._asdict()
+            record['issues'] = [issue._asdict() for issue in result.issues]
+            print(json.dumps(record))
+            continue
+        print('%s: %s' % (result.path, result.status))
+        for issue in result.issues:
+            rows = ' (rows %s)' % ', '.join(str(row) for row in issue.rows) \
+                if issue.rows else ''
+            print('  %s %s, %d failing%s: %s'
+                  % (issue.object, issue.check, issue.count, rows,
+                     issue.message))
+        if result.error is not None:
+            print(result.error, file=sys.stderr)
+    return int(any(result.status != 'valid' for result in results))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,90 @@
+from contextlib import contextmanager
+from datetime import datetime
+
+import numpy as np
+import pytest
+from hdmf.common import DynamicTableRegion
+from ndx_bipolar_scheme import BipolarSchemeTable, EcephysExt
+from pynwb import NWBFile, NWBHDF5IO
+
+
+def make_nwbfile(lab_meta_data_name='ecephys_ext'):
+    """
+    An NWBFile with 4 electrodes and, unless *lab_meta_data_name* is None, a
+    BipolarSchemeTable of 2 pairs in that lab metadata: pair 0 is electrode
+    0 to 1, pair 1 is electrodes 0, 1 to 2, 3.
+    """
+    nwbfile = NWBFile('description', 'id', datetime.now().astimezone())
+    device = nwbfile.create_device('device_test')
+    group = nwbfile.create_electrode_group(
+        name='electrodes',
+        description='label',
+        device=device,
+        location='brain')
+
+    for i in range(4):
+        nwbfile.add_electrode(x=float(i), y=float(i), z=float(i), imp=np.nan,
+                              location='', filtering='', group=group)
+    if lab_meta_data_name is not None:
+        add_bipolar_scheme_table(nwbfile, lab_meta_data_name)
+    return nwbfile
+
+
+def add_bipolar_scheme_table(nwbfile, lab_meta_data_name='ecephys_ext'):
+    """
+    Add the BipolarSchemeTable of *make_nwbfile* to the lab metadata
+    *lab_meta_data_name* of *nwbfile*, and return it.
+    """
+    bipolar_scheme_table = BipolarSchemeTable(name='bipolar_scheme_table',
+                                              description='desc')
+
+    bipolar_scheme_table.anodes.table = nwbfile.electrodes
+    bipolar_scheme_table.cathodes.table = nwbfile.electrodes
+
+    bipolar_scheme_table.add_row(anodes=[0], cathodes=[1])
+    bipolar_scheme_table.add_row(anodes=[0, 1], cathodes=[2, 3])
+
+    ecephys_ext = EcephysExt(name=lab_meta_data_name)
+    ecephys_ext.bipolar_scheme_table = bipolar_scheme_table
+    nwbfile.add_lab_meta_data(ecephys_ext)
+    return bipolar_scheme_table
+
+
+def make_region(bipolar_scheme_table, pairs=(0, 1)):
+    """
+    The bipolar_electrodes of a StimSeries with one column per pair of
+    *pairs*.
+    """
+    return DynamicTableRegion(name='bipolar_electrodes', data=list(pairs),
+                              description='desc', table=bipolar_scheme_table)
+
+
+@pytest.fixture
+def nwbfile():
+    return make_nwbfile()
+
+
+@pytest.fixture
+def bipolar_scheme_table(nwbfile):
+    return nwbfile.lab_meta_data['ecephys_ext'].bipolar_scheme_table
+
+
+@pytest.fixture
+def region(bipolar_scheme_table):
+    return make_region(bipolar_scheme_table)
+
+
+@pytest.fixture
+def roundtrip(tmp_path):
+    """
+    Write an NWBFile to *name* in tmp_path and re-open it, in mode 'r' or
+    'a'. The path of the file is the *source* of the NWBHDF5IO.
+    """
+    @contextmanager
+    def roundtrip(nwbfile, name='test.nwb', mode='r', **kwargs):
+        path = str(tmp_path / name)
+        with NWBHDF5IO(path, 'w') as io:
+            io.write(nwbfile, **kwargs)
+        with NWBHDF5IO(path, mode, load_namespaces=True) as io:
+            yield io
+    return roundtrip
@@ -1,14 +1,41 @@
+import json
+import os
+import subprocess
+import sys
 from datetime import datetime
 
+import h5py
 import numpy as np
+import pandas as pd
+import pytest
+from hdmf.backends.hdf5 import H5DataIO, HDF5IO
 from pynwb import NWBFile, NWBHDF5IO
-from ndx_electrical_stim import StimSeries
+from pynwb.ecephys import ElectricalSeries
+from ndx_electrical_stim import SparseStimSeries, StimSeries
 
 from ndx_bipolar_scheme import BipolarSchemeTable, EcephysExt
-from ndx_electrical_stim import StimTable
+from ndx_electrical_stim import (BipolarTableNotFoundError, CompactStimTable,
+                                 StimTable)
+from ndx_electrical_stim.artifacts import (get_artifact_windows,
+                                           iter_clean_blocks, remove_artifacts)
+from ndx_electrical_stim.append import (StimSeriesAppender, StimTableAppender,
+                                        create_appendable_stim_series,
+                                        make_appendable)
+from ndx_electrical_stim.catalog import StimCatalog
+from ndx_electrical_stim.convert import convert_sessions, main
+from ndx_electrical_stim.data_utils import read_segments
+from ndx_electrical_stim.detection import detect_runs
+from ndx_electrical_stim.instrumentation import instrument, merge_reports
+from ndx_electrical_stim.parallel import ChunkedStimData, iter_read_segments
+from ndx_electrical_stim.ring import StimRingBuffer, StimRingReader
+from ndx_electrical_stim.summary import summarize_runs
+from ndx_electrical_stim.synthesis import synthesize_stim_series
+from ndx_electrical_stim.validation import validate_file, validate_files
 
+from .conftest import add_bipolar_scheme_table, make_nwbfile, make_region
 
-def test_io():
+
+def test_io(tmp_path):
     nwbfile = NWBFile('description', 'id', datetime.now().astimezone())
     device = nwbfile.create_device('device_test')
     group = nwbfile.create_electrode_group(
@@ -40,8 +67,9 @@ def test_io():
         # bipolar_table=bipolar_scheme_table
     )
 
-    # calling this before `add_run` obviates bipolar_table=bipolar_scheme_table above.
-    # You can add it to the NWBFile later, but you'll need to specify bipolar_table manually
+    # without bipolar_table, the bipolar_pair column indexes the
+    # BipolarSchemeTable of the 'ecephys_ext' lab metadata, which is looked up
+    # once, when the table is added to the file or written
 
     nwbfile.add_time_intervals(st)
 
@@ -59,9 +87,1083 @@ def test_io():
             bipolar_pair=i
         )
 
-    with NWBHDF5IO('test_file.nwb', 'w') as io:
+    with NWBHDF5IO(str(tmp_path / 'test_file.nwb'), 'w') as io:
         io.write(nwbfile)
 
     # Make a 300 timepoint waveform time series for 2 electrodes (one
     # cathode, and one anode).
     current_data = np.random.randn(300, 2)
+
+
+def test_add_runs(nwbfile, bipolar_scheme_table):
+    looped = StimTable(name='looped', bipolar_table=bipolar_scheme_table)
+    looped.add_column(name='other_param', description='some other parameter')
+    bulk = StimTable(name='bulk')
+    nwbfile.add_time_intervals(bulk)
+    bulk.add_column(name='other_param', description='some other parameter')
+
+    runs = dict(
+        start_time=np.arange(6.),
+        stop_time=np.arange(6.) + .5,
+        frequency=np.full(6, 10.),
+        amplitude=np.linspace(1., 6., 6),
+        pulse_width=np.full(6, 2e-4),
+        bipolar_pair=np.array([0, 1, 0, 1, 0, 1]),
+        other_param=np.zeros(6)
+    )
+    for i in range(6):
+        looped.add_run(**{k: v[i].item() for k, v in runs.items()})
+    bulk.add_runs(**runs)
+
+    assert bulk['bipolar_pair'].table is bipolar_scheme_table
+    pd.testing.assert_frame_equal(
+        bulk.to_dataframe(index=True), looped.to_dataframe(index=True))
+
+    with pytest.raises(ValueError):
+        bulk.add_runs(**{k: v for k, v in runs.items() if k != 'other_param'})
+    with pytest.raises(ValueError):
+        bulk.add_runs(**dict(runs, frequency=np.zeros(5)))
+    assert len(bulk) == 6
+
+
+def test_stim_table_from_dataframe(bipolar_scheme_table):
+    df = pd.DataFrame(dict(
+        start_time=[0., 1.],
+        stop_time=[.5, 1.5],
+        frequency=[10., 20.],
+        amplitude=[1., 2.],
+        pulse_width=[2e-4, 3e-4],
+        bipolar_pair=[1, 0],
+        other_param=[3., 4.]
+    ), index=pd.Index([10, 11], name='id'))
+
+    st = StimTable.from_dataframe(
+        df=df, name='stimtable', bipolar_table=bipolar_scheme_table,
+        column_descriptions={'other_param': 'some other parameter'})
+
+    assert list(st.id.data) == [10, 11]
+    assert st['other_param'].description == 'some other parameter'
+    np.testing.assert_array_equal(st['frequency'].data, [10., 20.])
+    np.testing.assert_array_equal(st['bipolar_pair'].data, [1, 0])
+
+
+def test_stim_series_from_blocks(nwbfile, region, roundtrip):
+    waveform = np.random.randn(1000, 2)
+
+    ss = StimSeries.from_blocks(
+        blocks=(waveform[i:i + 300] for i in range(0, 1000, 300)),
+        name='stim',
+        bipolar_electrodes=region,
+        chunk_shape=(256, 2),
+        compression='gzip',
+        compression_opts=4,
+        rate=200.
+    )
+    nwbfile.add_acquisition(ss)
+
+    with roundtrip(nwbfile) as io:
+        data = io.read().acquisition['stim'].data
+        assert data.chunks == (256, 2)
+        assert data.compression == 'gzip'
+        assert data.maxshape == (None, 2)
+        np.testing.assert_array_equal(data[:], waveform)
+
+
+def test_append(nwbfile, bipolar_scheme_table, region, roundtrip):
+    ss = create_appendable_stim_series(
+        name='stim',
+        bipolar_electrodes=region,
+        chunk_rows=64,
+        rate=1000.
+    )
+    nwbfile.add_acquisition(ss)
+    with pytest.raises(ValueError):
+        create_appendable_stim_series(
+            name='stim_timestamps', bipolar_electrodes=ss.bipolar_electrodes,
+            starting_time=1.)
+
+    st = StimTable(name='stimtable', bipolar_table=bipolar_scheme_table)
+    nwbfile.add_time_intervals(st)
+    st.add_run(start_time=0., stop_time=1., frequency=10., amplitude=1.,
+               pulse_width=1e-4, bipolar_pair=0)
+    make_appendable(st)
+
+    waveform = np.random.randn(1000, 2)
+    with roundtrip(nwbfile, mode='a') as io:
+        path = io.source
+        read_nwbfile = io.read()
+        with StimSeriesAppender(read_nwbfile.acquisition['stim'],
+                                flush_samples=128) as appender:
+            for i in range(0, 1000, 100):
+                appender.append(waveform[i:i + 100])
+            assert appender.n_samples == 1000
+            with pytest.raises(ValueError):
+                appender.append(np.zeros((10, 3)))
+
+        with StimTableAppender(read_nwbfile.intervals['stimtable'],
+                               flush_runs=2) as appender:
+            for i in range(3):
+                appender.add_run(start_time=i + 1., stop_time=i + 1.5,
+                                 frequency=20., amplitude=2.,
+                                 pulse_width=2e-4, bipolar_pair=i % 2)
+            with pytest.raises(IndexError):
+                appender.add_run(start_time=5., stop_time=5.5,
+                                 frequency=20., amplitude=2.,
+                                 pulse_width=2e-4, bipolar_pair=2)
+            assert appender.n_runs == 4
+
+    with NWBHDF5IO(path, 'r', load_namespaces=True) as io:
+        read_nwbfile = io.read()
+        np.testing.assert_array_equal(
+            read_nwbfile.acquisition['stim'].data[:], waveform)
+        st = read_nwbfile.intervals['stimtable']
+        np.testing.assert_array_equal(st.id.data[:], np.arange(4))
+        np.testing.assert_array_equal(st['start_time'].data[:],
+                                      [0., 1., 2., 3.])
+        np.testing.assert_array_equal(st['bipolar_pair'].data[:],
+                                      [0, 0, 1, 0])
+
+
+def test_runs_in_window(nwbfile, roundtrip):
+    st = StimTable(name='stimtable')
+    nwbfile.add_time_intervals(st)
+
+    rng = np.random.default_rng(0)
+    starts = rng.uniform(0, 100, 200)
+    stops = starts + rng.exponential(2, 200)
+    stops[5] = np.nan
+    st.add_runs(start_time=starts, stop_time=stops,
+                frequency=np.full(200, 10.), amplitude=np.ones(200),
+                pulse_width=np.full(200, 1e-4),
+                bipolar_pair=rng.integers(0, 2, 200))
+
+    windows = np.sort(rng.uniform(0, 100, (50, 2)), axis=1)
+    expected = [np.flatnonzero((starts <= t1) & (stops >= t0))
+                for t0, t1 in windows]
+    for (t0, t1), rows in zip(windows, expected):
+        np.testing.assert_array_equal(st.runs_in_window(t0, t1), rows)
+    for rows, batched in zip(expected, st.runs_in_windows(windows)):
+        np.testing.assert_array_equal(batched, rows)
+
+    # the index is rebuilt after runs are added
+    st.add_run(start_time=200., stop_time=201., frequency=10., amplitude=1.,
+               pulse_width=1e-4, bipolar_pair=0)
+    np.testing.assert_array_equal(st.runs_in_window(200.5, 300.), [200])
+
+    with roundtrip(nwbfile) as io:
+        st = io.read().intervals['stimtable']
+        t0, t1 = windows[0]
+        df = st.runs_in_window(t0, t1, df=True)
+        np.testing.assert_array_equal(df.index, expected[0])
+        np.testing.assert_array_equal(df['start_time'], starts[expected[0]])
+
+
+def test_stim_series_windows_and_epochs(nwbfile, bipolar_scheme_table,
+                                        region, roundtrip):
+    waveform = np.random.randn(1000, 2)
+    ss = StimSeries(
+        name='stim',
+        data=waveform,
+        bipolar_electrodes=region,
+        starting_time=1.,
+        rate=100.
+    )
+    nwbfile.add_acquisition(ss)
+
+    with roundtrip(nwbfile) as io:
+        ss = io.read().acquisition['stim']
+        np.testing.assert_array_equal(ss.get_data_in_window(1.1, 1.2),
+                                      waveform[10:21])
+        np.testing.assert_array_equal(
+            ss.get_data_in_window(0., 1.05, pairs=[1]), waveform[:6, [1]])
+
+        onsets = np.array([2., 2.05, 5., 1.])
+        epochs = ss.extract_epochs(onsets, .1, .2, pairs=[1, 0])
+        assert epochs.shape == (4, 30, 2)
+        np.testing.assert_array_equal(epochs[0], waveform[90:120, [1, 0]])
+        np.testing.assert_array_equal(epochs[1], waveform[95:125, [1, 0]])
+        np.testing.assert_array_equal(epochs[2], waveform[390:420, [1, 0]])
+        # the first 10 samples of the last epoch precede the recording
+        assert np.isnan(epochs[3, :10]).all()
+        np.testing.assert_array_equal(epochs[3, 10:], waveform[:20, [1, 0]])
+
+    timestamps = np.cumsum(np.random.uniform(.005, .015, 1000))
+    ss = StimSeries(
+        name='stim',
+        data=waveform,
+        bipolar_electrodes=make_region(bipolar_scheme_table),
+        timestamps=timestamps
+    )
+    t0, t1 = timestamps[100], timestamps[200]
+    np.testing.assert_array_equal(ss.get_data_in_window(t0, t1),
+                                  waveform[100:201])
+    epochs = ss.extract_epochs([t0], 0., t1 - t0)
+    np.testing.assert_array_equal(epochs[0], waveform[100:200])
+
+
+def test_get_bipolar_electrodes(nwbfile, bipolar_scheme_table, roundtrip):
+    nwbfile.add_acquisition(StimSeries(
+        name='stim',
+        data=np.random.randn(10, 3),
+        bipolar_electrodes=make_region(bipolar_scheme_table, [1, 0, 1]),
+        rate=100.
+    ))
+    st = StimTable(name='stimtable')
+    nwbfile.add_time_intervals(st)
+    st.add_run(start_time=0., stop_time=1., frequency=10., amplitude=1.,
+               pulse_width=1e-4, bipolar_pair=0)
+
+    resolved = st.get_bipolar_electrodes()
+    np.testing.assert_array_equal(resolved.anode_offsets, [0, 1])
+    assert st.get_bipolar_electrodes() is resolved
+    st.add_run(start_time=1., stop_time=2., frequency=10., amplitude=1.,
+               pulse_width=1e-4, bipolar_pair=1)
+    resolved = st.get_bipolar_electrodes()
+    np.testing.assert_array_equal(resolved.anodes(1), [0, 1])
+    np.testing.assert_array_equal(resolved.cathodes(1), [2, 3])
+
+    with roundtrip(nwbfile) as io:
+        resolved = io.read().acquisition['stim'].get_bipolar_electrodes()
+        np.testing.assert_array_equal(resolved.anode_offsets, [0, 2, 3, 5])
+        np.testing.assert_array_equal(resolved.anode_indices,
+                                      [0, 1, 0, 0, 1])
+        np.testing.assert_array_equal(resolved.cathode_offsets, [0, 2, 3, 5])
+        np.testing.assert_array_equal(resolved.cathode_indices,
+                                      [2, 3, 1, 2, 3])
+
+
+def test_lazy_data(nwbfile, bipolar_scheme_table, roundtrip):
+    waveform = np.random.randn(5000, 2)
+    for name, data in [('contiguous', waveform),
+                       ('chunked', H5DataIO(waveform, chunks=(100, 2),
+                                            compression='gzip'))]:
+        nwbfile.add_acquisition(StimSeries(
+            name=name,
+            data=data,
+            bipolar_electrodes=make_region(bipolar_scheme_table),
+            rate=100.
+        ))
+
+    with roundtrip(nwbfile) as io:
+        read_nwbfile = io.read()
+        for name, is_memmap in [('contiguous', True), ('chunked', False)]:
+            lazy = read_nwbfile.acquisition[name].get_lazy_data(cache_blocks=4)
+            assert lazy.is_memmap == is_memmap
+            assert lazy.shape == waveform.shape
+            np.testing.assert_array_equal(lazy[10:4000:7, 1],
+                                          waveform[10:4000:7, 1])
+            np.testing.assert_array_equal(lazy[-1], waveform[-1])
+            np.testing.assert_array_equal(lazy[[5, 3000, 5]],
+                                          waveform[[5, 3000, 5]])
+            np.testing.assert_array_equal(np.asarray(lazy), waveform)
+            np.testing.assert_allclose(lazy.mean(), waveform.mean(axis=0))
+            np.testing.assert_allclose(
+                lazy.rms(), np.sqrt(np.mean(waveform ** 2, axis=0)))
+            np.testing.assert_array_equal(lazy.min(), waveform.min(axis=0))
+            np.testing.assert_array_equal(lazy.max(), waveform.max(axis=0))
+            np.testing.assert_array_equal(lazy.abs_max(),
+                                          np.abs(waveform).max(axis=0))
+
+
+def test_synthesize_stim_series(nwbfile, bipolar_scheme_table, roundtrip):
+    st = StimTable(name='stimtable', bipolar_table=bipolar_scheme_table)
+    nwbfile.add_time_intervals(st)
+    runs = dict(start_time=[.1, .5, 1.2], stop_time=[.4, .9, 1.5],
+                frequency=[50., 100., 20.], amplitude=[1e-3, 2e-3, 3e-3],
+                pulse_width=[2e-3, 1e-3, 5e-3], bipolar_pair=[0, 1, 1])
+    st.add_runs(**runs)
+
+    rate = 10000.
+    expected = np.zeros((int(1.6 * rate), 2))
+    for i in range(3):
+        onset = runs['start_time'][i]
+        while onset < runs['stop_time'][i]:
+            first = int(round(onset * rate))
+            width = int(round(runs['pulse_width'][i] * rate))
+            pair = runs['bipolar_pair'][i]
+            expected[first:first + width, pair] += runs['amplitude'][i]
+            expected[first + width:first + 2 * width, pair] -= runs['amplitude'][i]
+            onset += 1. / runs['frequency'][i]
+
+    ss = synthesize_stim_series(stim_table=st, rate=rate, name='stim',
+                                n_samples=len(expected), block_size=777,
+                                chunk_shape=(500, 2))
+    np.testing.assert_allclose(ss.data, expected, atol=1e-12)
+    nwbfile.add_acquisition(ss)
+    np.testing.assert_array_equal(ss.bipolar_electrodes.data, [0, 1])
+
+    streamed = synthesize_stim_series(stim_table=st, rate=rate,
+                                      name='streamed', stream=True,
+                                      bipolar_electrodes=make_region(
+                                          bipolar_scheme_table, [1]),
+                                      block_size=1000)
+    nwbfile.add_acquisition(streamed)
+    with roundtrip(nwbfile) as io:
+        read_nwbfile = io.read()
+        # the waveform rendered up front is chunked and compressed too
+        dset = read_nwbfile.acquisition['stim'].data
+        assert dset.chunks == (500, 2) and dset.compression == 'gzip'
+        data = read_nwbfile.acquisition['streamed'].data[:]
+        n = min(len(data), len(expected))
+        np.testing.assert_allclose(data[:n], expected[:n, [1]], atol=1e-12)
+        assert not data[n:].any()
+
+
+def test_detect_runs(nwbfile, bipolar_scheme_table, roundtrip):
+    st = StimTable(name='stimtable', bipolar_table=bipolar_scheme_table)
+    runs = dict(start_time=[.1, .5, 1.2, 3.], stop_time=[.4, .9, 1.5, 3.01],
+                frequency=[50., 100., 20., 100.],
+                amplitude=[1e-3, 2e-3, 3e-3, 1e-3],
+                pulse_width=[2e-3, 1e-3, 5e-3, 1e-3],
+                bipolar_pair=[0, 1, 1, 0])
+    st.add_runs(**runs)
+    nwbfile.add_acquisition(synthesize_stim_series(
+        stim_table=st, rate=10000., name='stim',
+        n_samples=40000, stream=True, chunk_shape=(300, 2), block_size=1000))
+
+    with roundtrip(nwbfile) as io:
+        detected = detect_runs(io.read().acquisition['stim'],
+                               threshold=5e-4, max_interval=.2,
+                               block_rows=1700)
+        np.testing.assert_array_equal(detected['bipolar_pair'].data,
+                                      runs['bipolar_pair'])
+        for name in ('start_time', 'amplitude', 'pulse_width'):
+            np.testing.assert_allclose(detected[name].data, runs[name],
+                                       atol=1e-9)
+        np.testing.assert_allclose(detected['frequency'].data[:3],
+                                   runs['frequency'][:3])
+        np.testing.assert_allclose(detected['stop_time'].data[:3],
+                                   runs['stop_time'][:3])
+        # a single pulse has no frequency and stops when it ends
+        assert np.isnan(detected['frequency'].data[3])
+        np.testing.assert_allclose(detected['stop_time'].data[3], 3.002)
+
+    # pulses of a train slower than 1 / max_interval Hz form one run each
+    waveform = np.zeros((10000, 1))
+    waveform[500::2000] = 1.
+    slow = StimSeries(name='slow', data=waveform, rate=1000.,
+                      bipolar_electrodes=make_region(bipolar_scheme_table, [0]))
+    detected = detect_runs(slow, threshold=.5)
+    np.testing.assert_allclose(detected['start_time'].data, [.5, 2.5, 4.5, 6.5, 8.5])
+    assert np.isnan(detected['frequency'].data).all()
+    # the default threshold is half of the peak
+    np.testing.assert_array_equal(detect_runs(slow)['start_time'].data,
+                                  detected['start_time'].data)
+    detected = detect_runs(slow, threshold=.5, max_interval=3.)
+    np.testing.assert_allclose(detected['frequency'].data, [.5])
+    np.testing.assert_allclose(detected['stop_time'].data, [10.5])
+
+
+def _build_session(session):
+    if session.get('fail'):
+        raise RuntimeError('bad session')
+    nwbfile = make_nwbfile()
+    bipolar_scheme_table = nwbfile.lab_meta_data['ecephys_ext'].bipolar_scheme_table
+    st = StimTable(name='stimtable', bipolar_table=bipolar_scheme_table)
+    st.add_runs(start_time=[0.], stop_time=[1.], frequency=[session['frequency']],
+                amplitude=[1.], pulse_width=[1e-3], bipolar_pair=[0])
+    nwbfile.add_time_intervals(st)
+    return nwbfile
+
+
+def test_convert_sessions(tmp_path):
+    sessions = [dict(session_id='s%d' % i, frequency=10. * (i + 1))
+                for i in range(3)]
+    sessions.append(dict(session_id='bad', fail=True))
+    manifest = tmp_path / 'sessions.jsonl'
+    manifest.write_text('\n'.join(json.dumps(s) for s in sessions) + '\n\n')
+
+    progress = list()
+    results = convert_sessions(sessions=str(manifest), build=_build_session,
+                               output_dir=str(tmp_path / 'out'), n_workers=2,
+                               progress=progress.append)
+    assert [r.status for r in results] == ['converted'] * 3 + ['failed']
+    assert 'bad session' in results[3].error
+    assert [p.done for p in progress] == [1, 2, 3, 4]
+    assert progress[-1].failed == 1
+    assert not os.path.exists(results[3].path)
+    assert not os.path.exists(results[3].path + '.partial')
+    with NWBHDF5IO(results[1].path, 'r', load_namespaces=True) as io:
+        st = io.read().intervals['stimtable']
+        np.testing.assert_array_equal(st['frequency'].data[:], [20.])
+
+    # completed sessions are not converted again
+    assert main([str(manifest), '--build',
+                 _build_session.__module__ + ':_build_session',
+                 '--output-dir', str(tmp_path / 'out'), '--workers', '0']) == 1
+    results = convert_sessions(sessions=sessions[:3], build=_build_session,
+                               output_dir=str(tmp_path / 'out'), n_workers=0)
+    assert [r.status for r in results] == ['skipped'] * 3
+
+    # the output of a session can be in a new directory
+    nested = str(tmp_path / 'nested' / 'subject' / 's4.nwb')
+    results = convert_sessions(
+        sessions=[dict(session_id='s4', frequency=50., output=nested)],
+        build=_build_session, output_dir=str(tmp_path / 'out'), n_workers=0)
+    assert results[0].status == 'converted' and os.path.exists(nested)
+
+
+def test_import_registers_classes(nwbfile, roundtrip):
+    nwbfile.add_time_intervals(StimTable(name='stimtable'))
+    with roundtrip(nwbfile) as io:
+        path = io.source
+    # a plain import is enough to read the file, with or without the cached
+    # namespace
+    for load_namespaces in (False, True):
+        code = ('import sys, ndx_electrical_stim; '
+                'from pynwb import NWBHDF5IO; '
+                'io = NWBHDF5IO(sys.argv[1], "r", load_namespaces=%s); '
+                'st = io.read().intervals["stimtable"]; '
+                'assert type(st) is ndx_electrical_stim.StimTable, type(st)'
+                % load_namespaces)
+        subprocess.run([sys.executable, '-c', code, path], check=True,
+                       env=dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path)))
+
+
+def test_parquet_export(tmp_path, bipolar_scheme_table, region):
+    pytest.importorskip('pyarrow')
+    from ndx_electrical_stim.columnar import (
+        read_stim_runs, write_stim_series_summary_parquet,
+        write_stim_table_parquet)
+
+    for session in range(2):
+        st = StimTable(name='stimtable', bipolar_table=bipolar_scheme_table)
+        st.add_column(name='train', description='pulse train label')
+        st.add_runs(start_time=[0., 2., 4.], stop_time=[1., 3., 5.],
+                    frequency=[10., 50. + session, 100.], amplitude=[1., 2., 3.],
+                    pulse_width=[1e-4, 1e-4, 2e-4], bipolar_pair=[0, 1, 0],
+                    train=['a', 'b', 'c'])
+        write_stim_table_parquet(st, str(tmp_path / ('s%d.parquet' % session)),
+                                 session_id='s%d' % session, batch_size=2)
+
+    runs = read_stim_runs(str(tmp_path), frequency=(20., None),
+                          time=(1.5, 4.5)).to_pydict()
+    assert sorted(zip(runs['session_id'], runs['frequency'])) == [
+        ('s0', 50.), ('s0', 100.), ('s1', 51.), ('s1', 100.)]
+    i = runs['frequency'].index(51.)
+    assert runs['anodes'][i] == [0, 1]
+    assert runs['cathodes'][i] == [2, 3]
+    assert runs['train'][i] == 'b'
+    runs = read_stim_runs(str(tmp_path / 's1.parquet'), amplitude=(None, 1.5),
+                          columns=['id', 'bipolar_pair'])
+    assert runs.to_pydict() == {'id': [0], 'bipolar_pair': [0]}
+
+    data = np.random.randn(2500, 2)
+    ss = StimSeries(name='stim', data=data, bipolar_electrodes=region,
+                    rate=1000., starting_time=10.)
+    path = str(tmp_path / 'summary.parquet')
+    write_stim_series_summary_parquet(ss, path, decimation=1000, block_rows=2000)
+    import pyarrow.parquet as pq
+    summary = pq.read_table(path).to_pydict()
+    np.testing.assert_allclose(summary['time'], [10., 10., 11., 11., 12., 12.])
+    assert summary['bipolar_pair'] == [0, 1] * 3
+    np.testing.assert_allclose(summary['max'][4:], data[2000:].max(axis=0))
+    np.testing.assert_allclose(summary['mean'][2:4], data[1000:2000].mean(axis=0))
+
+
+def test_catalog(tmp_path):
+    for session, frequency in enumerate([10., 50.]):
+        nwbfile = make_nwbfile()
+        st = StimTable(name='stimtable')
+        nwbfile.add_time_intervals(st)
+        st.add_runs(start_time=[0., 2.], stop_time=[1., 3.],
+                    frequency=[frequency, 100.], amplitude=[1e-3, 3e-3],
+                    pulse_width=[1e-4, 1e-4], bipolar_pair=[0, 1])
+        with NWBHDF5IO(str(tmp_path / ('s%d.nwb' % session)), 'w') as io:
+            io.write(nwbfile)
+    (tmp_path / 'broken.nwb').write_bytes(b'not hdf5')
+
+    with StimCatalog(str(tmp_path / 'catalog.sqlite')) as catalog:
+        assert tuple(catalog.update(str(tmp_path))) == (3, 0, 0, 0, 1)
+        assert [path for path, _ in catalog.failed_files()] == [
+            str(tmp_path / 'broken.nwb')]
+        runs = catalog.query(frequency=(20., None), amplitude=(2e-3, None))
+        assert [(os.path.basename(r.path), r.row) for r in runs] == [
+            ('s0.nwb', 1), ('s1.nwb', 1)]
+        assert runs[0].stim_table == '/intervals/stimtable'
+        # pair 0 is electrode 0 to 1, pair 1 is electrodes 0, 1 to 2, 3
+        runs = catalog.query(electrodes=[3], time=(0.5, 1.5))
+        assert runs == []
+        runs = catalog.query(electrodes=[1], role='anode')
+        assert [(r.frequency, r.bipolar_pair) for r in runs] == [(100., 1)] * 2
+        assert len(catalog.query(electrodes=[1])) == 4
+
+        assert tuple(catalog.update(str(tmp_path))) == (0, 0, 3, 0, 0)
+        os.remove(str(tmp_path / 's0.nwb'))
+        os.utime(str(tmp_path / 's1.nwb'), (0, 0))
+        assert tuple(catalog.update(str(tmp_path), verify_hash=True)) == (0, 1, 1, 1, 0)
+        os.utime(str(tmp_path / 's1.nwb'), (1, 1))
+        assert tuple(catalog.update(str(tmp_path), verify_hash=True)) == (0, 0, 2, 0, 0)
+        assert [r.frequency for r in catalog.query()] == [50., 100.]
+
+
+def test_add_run_buffers(nwbfile, bipolar_scheme_table, roundtrip):
+    st = StimTable(name='stimtable', parameter_dtype='float32')
+    nwbfile.add_time_intervals(st)
+    for i in range(3000):
+        st.add_run(start_time=float(i), stop_time=i + .5, frequency=50.,
+                   amplitude=1e-3, pulse_width=1e-4, bipolar_pair=i % 2)
+    st.add_runs(start_time=[3000.], stop_time=[3000.5], frequency=[10.],
+                amplitude=[2e-3], pulse_width=[1e-4], bipolar_pair=[1])
+    st.add_run(start_time=3001., stop_time=3001.5, frequency=20.,
+               amplitude=3e-3, pulse_width=1e-4, bipolar_pair=0, id=5000)
+    assert isinstance(st['frequency'].data[:], np.ndarray)
+    assert st['frequency'].data.dtype == np.float32
+    assert st['start_time'].data.dtype == np.float64
+    assert st['bipolar_pair'].data.dtype == np.int32
+    assert len(st) == 3002
+    np.testing.assert_array_equal(st.id.data[-3:], [2999, 3000, 5000])
+
+    with roundtrip(nwbfile) as io:
+        st = io.read().intervals['stimtable']
+        assert st['frequency'].data.dtype == np.float32
+        assert st['bipolar_pair'].data.dtype == np.int32
+        np.testing.assert_allclose(st['frequency'].data[-3:], [50., 10., 20.])
+        np.testing.assert_array_equal(st['bipolar_pair'].data[-3:], [1, 1, 0])
+
+    # tables with ragged columns still add runs row by row
+    st = StimTable(name='stimtable', bipolar_table=bipolar_scheme_table)
+    st.add_column(name='labels', description='labels', index=True)
+    st.add_run(start_time=0., stop_time=1., frequency=1., amplitude=1.,
+               pulse_width=1., bipolar_pair=0, labels=['a', 'b'])
+    assert st['labels'][0] == ['a', 'b']
+    with pytest.raises(ValueError):
+        StimTable(name='stimtable', parameter_dtype='int8')
+
+
+def test_compact_stim_table(nwbfile, bipolar_scheme_table, roundtrip):
+    runs = dict(
+        start_time=np.arange(7.),
+        stop_time=np.arange(7.) + .5,
+        frequency=np.full(7, 50.),
+        amplitude=np.array([1., 2., 1., 2., 1., 2., 3.]) * 1e-3,
+        pulse_width=np.full(7, 1e-4),
+        bipolar_pair=np.array([1, 0, 1, 0, 1, 0, 1])
+    )
+    stim_table = StimTable(name='stimtable', bipolar_table=bipolar_scheme_table)
+    stim_table.add_runs(**runs)
+
+    ct = CompactStimTable(name='compact')
+    nwbfile.add_time_intervals(ct)
+    ct.add_run(**{k: v[0].item() for k, v in runs.items()})
+    ct.add_runs(**{k: v[1:] for k, v in runs.items()})
+    assert len(ct) == 7
+    assert len(ct.parameter_sets) == 3
+    np.testing.assert_array_equal(ct['parameter_set'].data, [0, 1, 0, 1, 0, 1, 2])
+    assert ct.parameter_sets['bipolar_pair'].table is bipolar_scheme_table
+    expected = stim_table.to_dataframe(index=True)
+    pd.testing.assert_frame_equal(ct.to_dataframe(), expected, check_dtype=False)
+    np.testing.assert_allclose(ct.get_parameters('amplitude'), runs['amplitude'])
+    with pytest.raises(ValueError):
+        ct.get_parameters('start_time')
+
+    with roundtrip(nwbfile) as io:
+        ct = io.read().intervals['compact']
+        assert isinstance(ct, CompactStimTable)
+        assert len(ct.parameter_sets) == 3
+        assert ct.parameter_sets['bipolar_pair'].table.name == 'bipolar_scheme_table'
+        pd.testing.assert_frame_equal(ct.to_dataframe(), expected,
+                                      check_dtype=False)
+        expanded = ct.to_stim_table(name='stimtable')
+        assert expanded['bipolar_pair'].table is ct.parameter_sets['bipolar_pair'].table
+        pd.testing.assert_frame_equal(expanded.to_dataframe(index=True),
+                                      expected, check_dtype=False)
+
+    compact = CompactStimTable.from_stim_table(stim_table)
+    assert compact.name == 'stimtable'
+    assert len(compact.parameter_sets) == 3
+    pd.testing.assert_frame_equal(compact.to_dataframe(), expected,
+                                  check_dtype=False)
+    stim_table.add_column(name='other_param', description='other',
+                          data=np.zeros(7))
+    with pytest.raises(ValueError):
+        CompactStimTable.from_stim_table(stim_table)
+
+    # NaN parameters are equal to each other
+    ct = CompactStimTable(name='nan', bipolar_table=bipolar_scheme_table)
+    ct.add_runs(start_time=[0., 1., 2.], stop_time=[.5, 1.5, 2.5],
+                frequency=[np.nan, 10., np.nan], amplitude=np.full(3, 1e-3),
+                pulse_width=np.full(3, 1e-4), bipolar_pair=[1, 1, 1])
+    np.testing.assert_array_equal(ct['parameter_set'].data, [0, 1, 0])
+
+
+def test_sparse_stim_series(nwbfile, bipolar_scheme_table, region, roundtrip):
+    dense = np.zeros((3000, 2))
+    dense[100:110, 0] = 1.
+    dense[113:120, 1] = -1.
+    dense[2990:, 1] = 2.
+    stim_series = SparseStimSeries.from_dense(
+        data=dense, name='stim', bipolar_electrodes=region, rate=1000.,
+        min_gap=3)
+    np.testing.assert_array_equal(stim_series.segment_starts, [100, 2990])
+    np.testing.assert_array_equal(stim_series.segment_index, [20, 30])
+    assert stim_series.data.shape == (30, 2)
+    assert stim_series.num_samples == 3000
+    nwbfile.add_acquisition(stim_series)
+
+    with roundtrip(nwbfile) as io:
+        stim_series = io.read().acquisition['stim']
+        assert isinstance(stim_series, SparseStimSeries)
+        data = stim_series.get_lazy_data()
+        assert data.shape == (3000, 2)
+        np.testing.assert_array_equal(data[:], dense)
+        np.testing.assert_array_equal(data[95:2995:7, 1], dense[95:2995:7, 1])
+        np.testing.assert_array_equal(data[[2999, 0, 105]], dense[[2999, 0, 105]])
+        np.testing.assert_array_equal(data.max(), [1., 2.])
+        np.testing.assert_array_equal(data.min(), [0., -1.])
+        np.testing.assert_array_equal(data.abs_max(), [1., 2.])
+        np.testing.assert_allclose(data.mean(), dense.mean(axis=0))
+        np.testing.assert_array_equal(
+            stim_series.get_data_in_window(.1, .115), dense[100:116])
+        np.testing.assert_array_equal(
+            stim_series.extract_epochs([.1, 2.99], .005, .015)[:, :, 1],
+            [dense[95:115, 1], np.r_[dense[2985:, 1], np.full(5, np.nan)]])
+        dense_series = StimSeries(name='dense', data=dense,
+                                  bipolar_electrodes=stim_series.bipolar_electrodes,
+                                  rate=1000.)
+        pd.testing.assert_frame_equal(
+            detect_runs(stim_series, max_interval=.002).to_dataframe(index=True),
+            detect_runs(dense_series, max_interval=.002).to_dataframe(index=True))
+
+    with pytest.raises(ValueError):
+        SparseStimSeries(name='stim', data=np.ones((5, 2)),
+                         segment_starts=[10, 12], segment_index=[3, 5],
+                         num_dense_samples=100,
+                         bipolar_electrodes=make_region(bipolar_scheme_table),
+                         rate=1000.)
+    with pytest.raises(ValueError):
+        SparseStimSeries(name='stim', data=np.ones((4, 2)),
+                         segment_starts=[10, 20], segment_index=[3, 5],
+                         num_dense_samples=100,
+                         bipolar_electrodes=make_region(bipolar_scheme_table),
+                         rate=1000.)
+
+
+def test_stim_series_overview(region, roundtrip):
+    waveform = np.random.randn(10000, 2)
+    in_memory = StimSeries(name='in_memory', data=waveform,
+                           bipolar_electrodes=region, rate=1000.)
+    expected = in_memory.add_overview(bin_size=16, factor=4).data
+    with pytest.raises(ValueError):
+        in_memory.add_overview()
+
+    for exhaust_dci in (True, False):
+        nwbfile = make_nwbfile()
+        bipolar_scheme_table = \
+            nwbfile.lab_meta_data['ecephys_ext'].bipolar_scheme_table
+        stim_series = StimSeries.from_blocks(
+            blocks=(waveform[i:i + 300] for i in range(0, 10000, 300)),
+            name='stim', bipolar_electrodes=make_region(bipolar_scheme_table),
+            rate=1000., overview_bin_size=16, overview_factor=4)
+        # the waveform is not written yet
+        with pytest.raises(ValueError):
+            stim_series.add_overview()
+        nwbfile.add_acquisition(stim_series)
+        with roundtrip(nwbfile, exhaust_dci=exhaust_dci) as io:
+            stim_series = io.read().acquisition['stim']
+            np.testing.assert_array_equal(stim_series.overview.data[:],
+                                          expected)
+            assert stim_series.overview.get_level(1, 10000) == (625, 157)
+
+            # windows aligned on the bins of the level that is read
+            for t0, t1, n_points in ((0., 10., 100), (1.024, 5.119, 50)):
+                overview = stim_series.get_overview(t0, t1, n_points=n_points)
+                assert 0 < len(overview.timestamps) <= n_points
+                indices = np.round(overview.timestamps * 1000.).astype(int)
+                window = waveform[indices[0]:int(round(t1 * 1000.)) + 1]
+                np.testing.assert_array_equal(
+                    overview.min,
+                    np.minimum.reduceat(window, indices - indices[0]))
+                np.testing.assert_array_equal(
+                    overview.max,
+                    np.maximum.reduceat(window, indices - indices[0]))
+
+            # short windows are drawn from the samples themselves
+            overview = stim_series.get_overview(1., 1.05)
+            np.testing.assert_array_equal(overview.min, waveform[1000:1051])
+            np.testing.assert_allclose(overview.timestamps,
+                                       np.arange(1000, 1051) / 1000.)
+            with pytest.raises(ValueError):
+                stim_series.get_overview(0., 1., n_points=0)
+
+
+def test_parallel_reads(nwbfile, bipolar_scheme_table, roundtrip, tmp_path):
+    waveform = np.random.randn(20000, 3)
+    nwbfile.add_acquisition(StimSeries(
+        name='stim', rate=1000.,
+        bipolar_electrodes=make_region(bipolar_scheme_table, [0, 1, 0]),
+        data=H5DataIO(waveform, compression='gzip', shuffle=True,
+                      chunks=(256, 2))))
+
+    onsets = np.random.uniform(-1., 21., 300)
+    with roundtrip(nwbfile) as io:
+        stim_series = io.read().acquisition['stim']
+        data = ChunkedStimData(stim_series.data)
+        assert data.is_direct
+        np.testing.assert_array_equal(data[1000:5003], waveform[1000:5003])
+        np.testing.assert_array_equal(data[10:300, [0, 2]], waveform[10:300, [0, 2]])
+
+        expected = stim_series.extract_epochs(onsets, .05, .1, pairs=[2, 0])
+        for n_workers in (0, 3):
+            np.testing.assert_array_equal(
+                stim_series.extract_epochs(onsets, .05, .1, pairs=[2, 0],
+                                           n_workers=n_workers),
+                expected)
+            np.testing.assert_array_equal(
+                stim_series.get_data_in_window(1., 19.5, n_workers=n_workers),
+                waveform[1000:19501])
+        epochs = dict(stim_series.iter_epochs(onsets, .05, .1, pairs=[2, 0],
+                                              n_workers=2))
+        assert sorted(epochs) == list(range(300))
+        np.testing.assert_array_equal(epochs[42], expected[42])
+
+        # many small tasks, read by several threads
+        starts = np.round((onsets - .05) * 1000.).astype(int)
+        expected = read_segments(stim_series.data, starts, starts + 150, 150,
+                                 columns=[2, 0])
+        segments = np.empty_like(expected)
+        for indices, task_segments in iter_read_segments(
+                stim_series.data, starts, starts + 150, 150, columns=[2, 0],
+                n_workers=3, task_rows=500):
+            segments[indices] = task_segments
+        np.testing.assert_array_equal(segments, expected)
+        # stopping early cancels the remaining reads
+        tasks = iter_read_segments(stim_series.data, starts, starts + 150, 150,
+                                   n_workers=2, task_rows=500)
+        next(tasks)
+        tasks.close()
+
+    with pytest.raises(ValueError):
+        next(StimSeries(name='stim', data=waveform, rate=1000.,
+                        bipolar_electrodes=make_region(bipolar_scheme_table,
+                                                       [0, 1, 0])
+                        ).iter_epochs(onsets, .05, .1, n_workers=-1))
+
+    # other filter pipelines are read through h5py, big-endian shuffled
+    # data is decoded directly
+    with h5py.File(str(tmp_path / 'filters.h5'), 'w') as f:
+        datasets = [
+            (f.create_dataset('lzf', data=waveform, chunks=(256, 2),
+                              compression='lzf'), False),
+            (f.create_dataset('fletcher32', data=waveform, chunks=(256, 2),
+                              compression='gzip', fletcher32=True), False),
+            (f.create_dataset('big_endian', data=waveform.astype('>f4'),
+                              chunks=(300, 2), shuffle=True), True),
+        ]
+        for dset, is_direct in datasets:
+            data = ChunkedStimData(dset)
+            assert data.is_direct == is_direct
+            np.testing.assert_array_equal(data[1000:5003], dset[1000:5003])
+            np.testing.assert_array_equal(data[19900:, [2]], dset[19900:, [2]])
+
+
+def test_bind_bipolar_table(roundtrip):
+    runs = dict(start_time=np.arange(3.), stop_time=np.arange(3.) + .5,
+                frequency=np.full(3, 50.), amplitude=np.full(3, 1e-3),
+                pulse_width=np.full(3, 1e-4), bipolar_pair=np.array([1, 0, 1]))
+
+    # runs can be added before the table is in an NWBFile
+    st = StimTable(name='stimtable', lab_meta_data_name='bipolar')
+    st.add_run(**{k: v[0].item() for k, v in runs.items()})
+    st.add_runs(**{k: v[1:] for k, v in runs.items()})
+    assert st['bipolar_pair'].table is None
+    with pytest.raises(ValueError):
+        st.get_bipolar_electrodes()
+    ct = CompactStimTable(name='compact', lab_meta_data_name='bipolar')
+    ct.add_runs(**runs)
+
+    nwbfile = make_nwbfile(lab_meta_data_name=None)
+    nwbfile.add_time_intervals(st)
+    nwbfile.add_time_intervals(ct)
+    with pytest.raises(BipolarTableNotFoundError):
+        st.bind_bipolar_table()
+    # runs added in the NWBFile before its BipolarSchemeTable are warned about
+    with pytest.warns(UserWarning, match='does not yet exist'):
+        st.add_run(start_time=3., stop_time=3.5, frequency=50.,
+                   amplitude=1e-3, pulse_width=1e-4, bipolar_pair=0)
+    bipolar_scheme_table = add_bipolar_scheme_table(nwbfile, 'bipolar')
+
+    # the tables are bound when they are written
+    with roundtrip(nwbfile) as io:
+        assert st.bind_bipolar_table() is bipolar_scheme_table
+        assert ct.parameter_sets['bipolar_pair'].table is bipolar_scheme_table
+        with pytest.raises(ValueError) as excinfo:
+            st.bind_bipolar_table(BipolarSchemeTable(name='other',
+                                                     description='desc'))
+        assert not isinstance(excinfo.value, BipolarTableNotFoundError)
+
+        read_nwbfile = io.read()
+        read_st = read_nwbfile.intervals['stimtable']
+        assert read_st.bind_bipolar_table() is \
+            read_nwbfile.lab_meta_data['bipolar'].bipolar_scheme_table
+        df = read_st.to_dataframe()
+        assert df['bipolar_pair'].iloc[0]['anodes'].iloc[0].index[0] == 0
+        np.testing.assert_array_equal(
+            read_st.get_bipolar_electrodes().cathode_indices,
+            st.get_bipolar_electrodes().cathode_indices)
+        np.testing.assert_array_equal(
+            read_nwbfile.intervals['compact'].get_parameters('bipolar_pair'),
+            runs['bipolar_pair'])
+
+
+def test_summarize_runs(nwbfile, bipolar_scheme_table, roundtrip):
+    waveform = np.zeros((1000, 2))
+    waveform[100:400:50, 0] = 2.     # 6 pulses on pair 1
+    waveform[101:400:50, 0] = -1.
+    waveform[500:900:100, 1] = 3.    # 4 pulses on pair 0
+    nwbfile.add_acquisition(StimSeries(
+        name='stim', data=H5DataIO(waveform, chunks=(64, 2)),
+        bipolar_electrodes=make_region(bipolar_scheme_table, [1, 0]),
+        rate=1000.))
+    st = StimTable(name='stimtable', bipolar_table=bipolar_scheme_table)
+    nwbfile.add_time_intervals(st)
+    st.add_runs(start_time=np.array([.1, .5, .101, .7, np.nan]),
+                stop_time=np.array([.399, .899, .2, .75, 1.]),
+                frequency=np.full(5, 20.), amplitude=np.ones(5),
+                pulse_width=np.full(5, 1e-3),
+                bipolar_pair=np.array([1, 0, 1, 1, 0]))
+
+    with roundtrip(nwbfile, mode='a') as io:
+        path = io.source
+        read_nwbfile = io.read()
+        stim_table = read_nwbfile.intervals['stimtable']
+        summary = summarize_runs(read_nwbfile.acquisition['stim'], stim_table,
+                                 threshold=.5, block_rows=70)
+        # the third run starts in the second phase of a pulse, which counts
+        np.testing.assert_array_equal(summary.pulse_count, [6, 4, 3, 0, 0])
+        np.testing.assert_allclose(summary.charge, [.018, .012, .006, 0., 0.])
+        np.testing.assert_array_equal(summary.peak[:3], [2., 3., 2.])
+        np.testing.assert_allclose(summary.rms[1], np.sqrt(36. / 400))
+        assert summary.peak[3] == 0. and np.isnan(summary.peak[4])
+        with pytest.raises(ValueError):
+            summarize_runs(read_nwbfile.acquisition['stim'], stim_table,
+                           threshold=.5)
+        io.write(read_nwbfile)
+
+    with NWBHDF5IO(path, 'r') as io:
+        df = io.read().intervals['stimtable'].to_dataframe(index=True)
+        np.testing.assert_array_equal(df['pulse_count'], [6, 4, 3, 0, 0])
+        np.testing.assert_allclose(df['charge'], summary.charge)
+
+
+def test_validate_files(tmp_path, nwbfile, bipolar_scheme_table, roundtrip):
+    nwbfile.add_acquisition(StimSeries(
+        name='stim', data=np.zeros((100, 1)), rate=10.,
+        bipolar_electrodes=make_region(bipolar_scheme_table, [0])))
+    st = StimTable(name='stimtable')
+    nwbfile.add_time_intervals(st)
+    # runs of pair 1 are not recorded, so only their order is checked
+    st.add_runs(start_time=[1., 3., np.nan, 5., 20.],
+                stop_time=[2., 2., np.nan, 9., 30.],
+                frequency=np.full(5, 50.), amplitude=np.full(5, 1e-3),
+                pulse_width=np.full(5, 1e-4), bipolar_pair=[0, 1, 0, 0, 1])
+    ct = CompactStimTable(name='compact')
+    nwbfile.add_time_intervals(ct)
+    ct.add_runs(start_time=[1., 8.], stop_time=[2., 12.],
+                frequency=[50., 50.], amplitude=[1e-3, 1e-3],
+                pulse_width=[1e-4, 1e-4], bipolar_pair=[0, 0])
+    with roundtrip(nwbfile, 'valid.nwb') as io:
+        path = io.source
+
+    result = validate_file(path, chunk_rows=2)
+    assert result.status == 'invalid'
+    assert [(i.object, i.check, i.count, i.rows) for i in result.issues] == [
+        ('/intervals/stimtable', 'start_stop_order', 1, [1]),
+        ('/intervals/compact', 'run_time_range', 1, [1])]
+
+    with h5py.File(path, 'r+') as f:
+        f['intervals/stimtable/bipolar_pair'][3] = 2
+        f['intervals/stimtable/stop_time'][0] = 11.
+        f['intervals/compact/parameter_set'][1] = 1
+        attrs = dict(f['acquisition/stim/bipolar_electrodes'].attrs)
+        del f['acquisition/stim/bipolar_electrodes']
+        f['acquisition/stim/bipolar_electrodes'] = [0, -1]
+        f['acquisition/stim/bipolar_electrodes'].attrs.update(attrs)
+    (tmp_path / 'broken.nwb').write_bytes(b'not hdf5')
+
+    results = validate_files(str(tmp_path), n_workers=2, chunk_rows=3)
+    assert [(os.path.basename(r.path), r.status) for r in results] == [
+        ('broken.nwb', 'failed'), ('valid.nwb', 'invalid')]
+    assert 'OSError' in results[0].error
+    assert [(i.object, i.check, i.count, i.rows)
+            for i in results[1].issues] == [
+        ('/acquisition/stim/bipolar_electrodes', 'bipolar_electrodes_range',
+         1, [1]),
+        ('/acquisition/stim/data', 'data_columns', 1, []),
+        ('/intervals/stimtable/bipolar_pair', 'bipolar_pair_range', 1, [3]),
+        ('/intervals/compact/parameter_set', 'parameter_set_range', 1, [1]),
+        ('/intervals/stimtable', 'start_stop_order', 1, [1]),
+        ('/intervals/stimtable', 'run_time_range', 1, [0])]
+
+
+def test_remove_artifacts(nwbfile, bipolar_scheme_table, roundtrip):
+    runs = dict(start_time=np.array([.1, .5, np.nan]),
+                stop_time=np.array([.3, .6, 1.]),
+                frequency=np.array([50., 100., 10.]),
+                amplitude=np.array([1e-3, 2e-3, 1e-3]),
+                pulse_width=np.full(3, 1e-4), bipolar_pair=np.array([0, 1, 0]))
+    st = StimTable(name='stimtable', bipolar_table=bipolar_scheme_table)
+    st.add_runs(**runs)
+    nwbfile.add_time_intervals(st)
+    # the pulses are delivered 1 ms after they are commanded
+    delivered = StimTable(name='delivered', bipolar_table=bipolar_scheme_table)
+    delivered.add_runs(**dict(runs, start_time=runs['start_time'] + 1e-3))
+    stim_series = synthesize_stim_series(delivered, rate=1000., name='stim')
+    nwbfile.add_acquisition(stim_series)
+
+    # 20 ms of signal around every pulse, zero where the artifacts are
+    signal = np.tile(np.arange(1000, dtype=np.int16)[:, None] % 20 + 100,
+                     (1, 4))
+    recording = signal.copy()
+    shapes = [np.arange(1, 9)[:, None] * np.ones(4, dtype=np.int16),
+              -np.arange(1, 9)[:, None] * np.arange(1, 5)]
+    onsets = [(i, 0) for i in range(101, 300, 20)] + \
+        [(i, 1) for i in range(501, 600, 10)]
+    for onset, group in onsets:
+        signal[onset - 2:onset + 6] = 0
+        recording[onset - 2:onset + 6] = shapes[group]
+    nwbfile.add_acquisition(ElectricalSeries(
+        name='recording', data=H5DataIO(recording, chunks=(64, 4),
+                                        compression='gzip'),
+        electrodes=nwbfile.create_electrode_table_region([0, 1, 2, 3], 'all'),
+        rate=1000.))
+
+    with roundtrip(nwbfile, mode='a') as io:
+        path = io.source
+        read_nwbfile = io.read()
+        recording_series = read_nwbfile.acquisition['recording']
+        stim_table = read_nwbfile.intervals['stimtable']
+        windows = get_artifact_windows(recording_series, stim_table,
+                                       post=.006, pre=.002)
+        np.testing.assert_array_equal(
+            windows.starts, [onset - 3 for onset, _ in onsets])
+        np.testing.assert_array_equal(windows.groups, [0] * 10 + [1] * 10)
+        windows = get_artifact_windows(
+            recording_series, stim_table, post=.006, pre=.002,
+            stim_series=read_nwbfile.acquisition['stim'], threshold=5e-4)
+        np.testing.assert_array_equal(
+            windows.starts, [onset - 2 for onset, _ in onsets])
+        assert windows.n_samples == 8 and windows.n_groups == 2
+
+        module = read_nwbfile.create_processing_module('ecephys', 'cleaned')
+        for method, n_workers in (('blank', None), ('template', 2)):
+            module.add(remove_artifacts(
+                recording_series, stim_table, post=.006, pre=.002,
+                stim_series=read_nwbfile.acquisition['stim'], threshold=5e-4,
+                method=method,
+                fill_value=-1., name=method, block_rows=70,
+                channel_block=3, n_workers=n_workers))
+        io.write(read_nwbfile)
+        # stopping early cancels the remaining blocks
+        blocks = iter_clean_blocks(signal, windows, block_rows=10,
+                                   n_workers=2)
+        next(blocks)
+        blocks.close()
+
+    with NWBHDF5IO(path, 'r') as io:
+        module = io.read().processing['ecephys']
+        assert module['template'].data.dtype == np.int16
+        assert module['template'].rate == 1000.
+        np.testing.assert_array_equal(module['template'].data[:], signal)
+        blanked = np.where(signal == 0, -1, signal)
+        np.testing.assert_array_equal(module['blank'].data[:], blanked)
+    with pytest.raises(ValueError):
+        remove_artifacts(recording_series, stim_table, post=.006,
+                         method='interpolate')
+
+
+def test_stim_ring_buffer(nwbfile, bipolar_scheme_table, roundtrip):
+    nwbfile.add_acquisition(create_appendable_stim_series(
+        name='stim',
+        bipolar_electrodes=make_region(bipolar_scheme_table, [1, 0]),
+        rate=1000., starting_time=2.))
+
+    waveform = np.random.randn(500, 2)
+    with roundtrip(nwbfile, mode='a') as io:
+        stim_series = io.read().acquisition['stim']
+        with StimRingBuffer(stim_series, 256) as ring, \
+                StimRingReader(ring.name) as reader, \
+                StimSeriesAppender(stim_series, ring=ring) as appender:
+            assert reader.rate == 1000.
+            np.testing.assert_array_equal(reader.pairs, [1, 0])
+            np.testing.assert_array_equal(reader.bipolar_electrodes.anodes(0),
+                                          [0, 1])
+            appender.append(waveform[:200])
+            block = reader.read(max_samples=150)
+            assert block.start == 0
+            np.testing.assert_array_equal(block.data, waveform[:150])
+            np.testing.assert_allclose(reader.get_times(block)[[0, -1]],
+                                       [2., 2.149])
+
+            # a consumer in another process reads the samples in place
+            script = (
+                'import json, sys\n'
+                'from ndx_electrical_stim.ring import StimRingReader\n'
+                'reader = StimRingReader(sys.argv[1])\n'
+                'block = reader.read()\n'
+                'print(json.dumps([block.start, block.data.sum(axis=0).tolist()]))\n'
+                'reader.close()\n')
+            output = subprocess.run(
+                [sys.executable, '-c', script, ring.name], check=True,
+                capture_output=True, text=True,
+                env=dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path)))
+            start, sums = json.loads(output.stdout)
+            assert start == 0
+            np.testing.assert_allclose(sums, waveform[:200].sum(axis=0))
+
+            # the reader falls behind and loses the overwritten samples
+            appender.append(waveform[200:])
+            assert not reader.is_intact(block)
+            block = reader.read()
+            assert reader.n_lost == 94 and block.start == 244
+            np.testing.assert_array_equal(block.data, waveform[244:256])
+            block = reader.read()
+            np.testing.assert_array_equal(block.data, waveform[256:])
+            assert reader.is_intact(block)
+
+
+def test_instrumentation(tmp_path, nwbfile, region, roundtrip):
+    waveform = np.random.randn(1000, 2)
+    write_dataset = HDF5IO.write_dataset
+    with instrument() as instrumentation:
+        st = StimTable(name='stimtable')
+        nwbfile.add_time_intervals(st)
+        for i in range(3):
+            st.add_run(start_time=float(i), stop_time=i + .5, frequency=10.,
+                       amplitude=1., pulse_width=1e-4, bipolar_pair=i % 2)
+        nwbfile.add_acquisition(StimSeries.from_blocks(
+            blocks=(waveform[i:i + 300] for i in range(0, 1000, 300)),
+            name='stim', rate=200., bipolar_electrodes=region))
+        # in-memory waveforms are recorded as one write
+        nwbfile.add_acquisition(StimSeries(
+            name='plain', data=waveform[:200], rate=200.,
+            bipolar_electrodes=make_region(region.table)))
+        with roundtrip(nwbfile) as io:
+            read_segments(io.read().acquisition['stim'].data, [0, 500],
+                          [100, 600], 100)
+    # HDF5IO is only wrapped while instrumentation is enabled
+    assert HDF5IO.write_dataset is write_dataset
+    operations = instrumentation.report()['operations']
+    assert operations['StimTable.add_run']['calls'] == 3
+    assert operations['bipolar.bind_table']['calls'] >= 1
+    assert operations['StimTableMap.bipolar_column']['calls'] == 1
+    assert operations['StimSeries.hdf5_write']['calls'] == 5
+    assert operations['StimSeries.hdf5_write']['bytes_written'] \
+        == waveform.nbytes + waveform[:200].nbytes
+    assert operations['StimSeries.hdf5_write']['peak_buffer_bytes'] \
+        == waveform[:300].nbytes
+    assert operations['StimSeries.read_segments']['bytes_read'] == 3200
+
+    # with the environment variable, every process writes its own report
+    code = ('from ndx_electrical_stim.instrumentation import record; '
+            'record("test", seconds=1., bytes_read=10)')
+    report_dir = str(tmp_path / 'reports')
+    for _ in range(2):
+        subprocess.run([sys.executable, '-c', code], check=True,
+                       env=dict(os.environ, NDX_ELECTRICAL_STIM_INSTRUMENT=report_dir,
+                                PYTHONPATH=os.pathsep.join(sys.path)))
+    merged = merge_reports(report_dir)
+    assert merged['processes'] == 2
+    assert merged['operations']['test'] == dict(
+        calls=2, seconds=2., bytes_read=20, bytes_written=0,
+        peak_buffer_bytes=0)
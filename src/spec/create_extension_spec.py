@@ -3,7 +3,8 @@
 import os.path
 
 # Third party libraries
-from pynwb.spec import NWBNamespaceBuilder, export_spec, NWBGroupSpec
+from pynwb.spec import (NWBNamespaceBuilder, export_spec, NWBGroupSpec,
+                        NWBAttributeSpec, NWBDatasetSpec)
 
 
 # TODO: import the following spec classes as needed
@@ -24,8 +25,10 @@ def main():
     # as in which namespace they are found
     # this is similar to specifying the Python modules that need to be imported
     # to use your new data types
+    ns_builder.include_type('NWBData', namespace='core')
     ns_builder.include_type('TimeSeries', namespace='core')
     ns_builder.include_type('TimeIntervals', namespace='core')
+    ns_builder.include_type('DynamicTable', namespace='hdmf-common')
     ns_builder.include_type('DynamicTableRegion', namespace='hdmf-common')
     ns_builder.include_type('VectorData', namespace='hdmf-common')
 
@@ -33,6 +36,28 @@ def main():
     # see https://pynwb.readthedocs.io/en/latest/extensions.html#extending-nwb
     # for more information
 
+    stim_overview = NWBDatasetSpec(
+        neurodata_type_def='StimOverview',
+        neurodata_type_inc='NWBData',
+        doc=('Min/max decimation pyramid of a stimulation waveform. Level 0 '
+             'holds the minimum and maximum of each pair over every bin_size '
+             'samples, and each following level combines factor bins of the '
+             'level below, up to a level with a single bin. The levels are '
+             'stored one after the other.'),
+        dtype='numeric',
+        dims=['num_bins', 'min_max', 'num_pairs'],
+        shape=[None, 2, None],
+        attributes=[
+            NWBAttributeSpec(name='bin_size',
+                             dtype='int64',
+                             doc='Number of samples per bin of level 0.'),
+            NWBAttributeSpec(name='factor',
+                             dtype='int64',
+                             doc='Number of bins of a level combined into '
+                                 'each bin of the next level.')
+        ]
+    )
+
     stim_series = NWBGroupSpec(
         neurodata_type_def='StimSeries',
         neurodata_type_inc='TimeSeries',
@@ -44,6 +69,37 @@ def main():
                             doc='DynamicTableRegion pointer to the '
                                 'bipolar electrode pairs corresponding to the '
                                 'stimulation waveforms.')
+    stim_series.add_dataset(name='overview',
+                            neurodata_type_inc='StimOverview',
+                            quantity='?',
+                            doc='Min/max decimation pyramid of the waveform.')
+
+    # waveforms that are zero most of the time can store only their non-zero
+    # segments
+    sparse_stim_series = NWBGroupSpec(
+        neurodata_type_def='SparseStimSeries',
+        neurodata_type_inc='StimSeries',
+        doc=('A StimSeries that stores only the non-zero segments of its '
+             'waveform. data holds the samples of all segments one after the '
+             'other, and every other sample of the waveform is zero.'),
+        attributes=[
+            NWBAttributeSpec(name='num_dense_samples',
+                             dtype='int64',
+                             doc='Number of samples of the dense waveform.')
+        ]
+    )
+    sparse_stim_series.add_dataset(name='segment_starts',
+                                   dtype='int64',
+                                   dims=['num_segments'],
+                                   shape=[None],
+                                   doc='Index of the first sample of each '
+                                       'segment in the dense waveform.')
+    sparse_stim_series.add_dataset(name='segment_index',
+                                   dtype='int64',
+                                   dims=['num_segments'],
+                                   shape=[None],
+                                   doc='Index of the end of each segment in '
+                                       'data.')
 
     stim_table = NWBGroupSpec(
         neurodata_type_def='StimTable',
@@ -51,23 +107,94 @@ def main():
         doc=('An extension of TimeIntervals to hold parameters used for '
              'various stimulation events.'),
     )
+    # times are always stored in double precision, while the stimulation
+    # parameters may be stored in single precision to save space
+    stim_table.add_dataset(name='start_time',
+                           neurodata_type_inc='VectorData',
+                           dtype='float64',
+                           doc='Start time of stimulation, in seconds.')
+    stim_table.add_dataset(name='stop_time',
+                           neurodata_type_inc='VectorData',
+                           dtype='float64',
+                           doc='Stop time of stimulation, in seconds.')
     stim_table.add_dataset(name='bipolar_pair',
                            neurodata_type_inc='DynamicTableRegion',
+                           dtype='int32',
                            doc='DynamicTableRegion pointer to the '
                                'bipolar electrode pair used for this '
                                'stimulation event.')
     stim_table.add_dataset(name='frequency',
                            neurodata_type_inc='VectorData',
+                           dtype='float32',
                            doc='Frequency of stimulation waveform, in Hz.')
     stim_table.add_dataset(name='amplitude',
                            neurodata_type_inc='VectorData',
+                           dtype='float32',
                            doc='Amplitude of stimulation waveform, in Amps.')
     stim_table.add_dataset(name='pulse_width',
                            neurodata_type_inc='VectorData',
+                           dtype='float32',
                            doc='Pulse width of stimulation waveform, '
                                'in seconds/phase')
 
-    new_data_types = [stim_series, stim_table]
+    # repeated parameters can instead be stored once per distinct parameter
+    # set, with each run indexing its set
+    stim_parameter_table = NWBGroupSpec(
+        neurodata_type_def='StimParameterTable',
+        neurodata_type_inc='DynamicTable',
+        doc=('The distinct sets of stimulation parameters used by the runs '
+             'of a CompactStimTable.'),
+    )
+    stim_parameter_table.add_dataset(name='frequency',
+                                     neurodata_type_inc='VectorData',
+                                     dtype='float32',
+                                     doc='Frequency of stimulation waveform, '
+                                         'in Hz.')
+    stim_parameter_table.add_dataset(name='amplitude',
+                                     neurodata_type_inc='VectorData',
+                                     dtype='float32',
+                                     doc='Amplitude of stimulation waveform, '
+                                         'in Amps.')
+    stim_parameter_table.add_dataset(name='pulse_width',
+                                     neurodata_type_inc='VectorData',
+                                     dtype='float32',
+                                     doc='Pulse width of stimulation '
+                                         'waveform, in seconds/phase')
+    stim_parameter_table.add_dataset(name='bipolar_pair',
+                                     neurodata_type_inc='DynamicTableRegion',
+                                     dtype='int32',
+                                     doc='DynamicTableRegion pointer to the '
+                                         'bipolar electrode pair used with '
+                                         'this parameter set.')
+
+    compact_stim_table = NWBGroupSpec(
+        neurodata_type_def='CompactStimTable',
+        neurodata_type_inc='TimeIntervals',
+        doc=('An extension of TimeIntervals to hold stimulation events whose '
+             'parameters are stored once per distinct parameter set.'),
+    )
+    compact_stim_table.add_dataset(name='start_time',
+                                   neurodata_type_inc='VectorData',
+                                   dtype='float64',
+                                   doc='Start time of stimulation, in '
+                                       'seconds.')
+    compact_stim_table.add_dataset(name='stop_time',
+                                   neurodata_type_inc='VectorData',
+                                   dtype='float64',
+                                   doc='Stop time of stimulation, in seconds.')
+    compact_stim_table.add_dataset(name='parameter_set',
+                                   neurodata_type_inc='DynamicTableRegion',
+                                   dtype='int32',
+                                   doc='DynamicTableRegion pointer to the '
+                                       'parameter set used for this '
+                                       'stimulation event.')
+    compact_stim_table.add_group(name='parameter_sets',
+                                 neurodata_type_inc='StimParameterTable',
+                                 doc='The distinct parameter sets of the '
+                                     'stimulation events.')
+
+    new_data_types = [stim_overview, stim_series, sparse_stim_series, stim_table,
+                      stim_parameter_table, compact_stim_table]
 
     # export the spec to yaml files in the spec folder
     output_dir = os.path.abspath(